@@ -15,15 +15,20 @@ import traceback
 import logging
 import os, os.path
 import datetime
-import gzip
 import time
 
 from collections import defaultdict
+import compression
+from compression import open_file
 from gimethod import gimethod_subclasses, GIMethod
-from dataset import Dataset, posts2dataset
+from dataset import Dataset, posts2dataset, append_posts, compact_dataset
 from sparse_dataset import SparseDataset
-from geopy.distance import vincenty
-from geopy.distance import great_circle
+from columnar import DEFAULT_FIELDS, ColumnarDataset, default_format, export_columnar
+from sqlite_dataset import build_sqlite_dataset
+from geocoder import GAZETTEER_SOURCES, Geocoder, build_gazetteer
+from home_locations import HOME_LOCATION_SOURCES, LOCATION_POLICIES, build_home_locations
+from regions import assign_counties
+from geodesy import pairwise
 from shuffle import random
 
 logger = logging.getLogger(__name__)
@@ -118,7 +123,7 @@ def create_folds(args):
                 print line
 
     idToLoc = {}
-    with gzip.open(os.path.join(args.dataset_dir, ground_truth_locs), "r") as gt_file:
+    with open_file(os.path.join(args.dataset_dir, ground_truth_locs), "r") as gt_file:
         gt_file.next()
         for line in gt_file:
             uid, lat, lon = line.split('\t')
@@ -231,6 +236,10 @@ def cross_validate(args):
                         help='runs just that fold from the cross-fold dataset')
     parser.add_argument('--location-source', nargs=1, 
                         help='specifies the source of ground-truth locations')
+    parser.add_argument('--results_codec', choices=['gz','zst','lz4'], default='gz',
+                        help='the compression codec of the results files')
+    parser.add_argument('--columnar', action='store_true',
+                        help='read the users from the columns written by export_columnar, when they hold the fields the method reads')
 
     args = parser.parse_args(args)
 
@@ -247,7 +256,7 @@ def cross_validate(args):
     method = get_method_by_name(args.method_name)
 
     gold_location = {}
-    with gzip.open(ground_truth_file, 'r') as fh:
+    with open_file(ground_truth_file, 'r') as fh:
         fh.next()
         for line in fh:
             user_id, lat, lon = line.split('\t')
@@ -304,10 +313,11 @@ def cross_validate(args):
 
         # load the dataset
         training_data = None
+        dataset_class = ColumnarDataset if args.columnar else SparseDataset
         if not location_source is None:
-            training_data = SparseDataset(args.dataset_dir, args.fold_dir, default_location_source=location_source)
+            training_data = dataset_class(args.dataset_dir, args.fold_dir, default_location_source=location_source)
         else:
-            training_data = SparseDataset(args.dataset_dir, args.fold_dir)
+            training_data = dataset_class(args.dataset_dir, args.fold_dir)
                 
         # load the method
         method = get_method_by_name(args.method_name)
@@ -328,9 +338,10 @@ def cross_validate(args):
 
         #testing_data = Dataset(args.fold_dir, users_file=os.path.join(args.fold_dir,testing_users_file))
 
-        print("Writing results to %s" % (os.path.join(args.results_dir, fold_name + ".results.tsv.gz")))
+        results_fname = os.path.join(args.results_dir, fold_name + ".results.tsv." + args.results_codec)
+        print("Writing results to %s" % results_fname)
                 
-        out_fh = gzip.open(os.path.join(args.results_dir, fold_name + ".results.tsv.gz"), 'w')
+        out_fh = open_file(results_fname, 'w')
 
         initial_users = set(started.keys())
         final_users = set(finished.keys())
@@ -341,14 +352,11 @@ def cross_validate(args):
         print("Reporting results of %d users with known locations and predicted locations" % (len(test_users)))
 
         out_fh.write("%s\t%s\t%s\t%s\t%s\t%s\n" % ("user_id", "known_lat", "known_lon", "pred_lat", "pred_lon", "distance (km)"))
-        for user in test_users:
+        test_users = list(test_users)
+        distances = pairwise([gold_location[user] for user in test_users],
+                             [finished[user] for user in test_users], metric='vincenty')
+        for user, distance in zip(test_users, distances):
             #print('%s\t%s\t%s\t%s\t%s\n' % (user, gold_location[user][0], gold_location[user][1].strip(), finished[user][1], finished[user][0]))
-            prevMedian = (gold_location[user][0], gold_location[user][1])
-            testMedian = finished[user]
-            try:
-                distance = vincenty(prevMedian, testMedian).kilometers
-            except:
-                distance = great_circle(prevMedian, testMedian).kilometers
             out_fh.write('%s\t%s\t%s\t%s\t%s\t%d\n' % (user, gold_location[user][0], gold_location[user][1], finished[user][0], finished[user][1], distance))
 
         for user in (predicted_users - gold_standard_users):
@@ -398,6 +406,8 @@ def train(args):
     parser.add_argument('model_dir',help='a (non-existing) directory where the trained model will be stored')
     parser.add_argument('--location-source', nargs=1, 
                         help='specifies the source of ground-truth locations')
+    parser.add_argument('--columnar', action='store_true',
+                        help='read the users from the columns written by export_columnar, when they hold the fields the method reads')
         
     args = parser.parse_args(args)
 
@@ -424,10 +434,11 @@ def train(args):
 
     # load the dataset
     ds = None #Dataset(args.dataset_dir)
+    dataset_class = ColumnarDataset if args.columnar else SparseDataset
     if not location_source is None:
-            ds = SparseDataset(args.dataset_dir, default_location_source=location_source)
+            ds = dataset_class(args.dataset_dir, default_location_source=location_source)
     else:
-            ds = SparseDataset(args.dataset_dir)
+            ds = dataset_class(args.dataset_dir)
 
 
     # load the method
@@ -463,6 +474,8 @@ def infer(args,by_user=False):
     parser.add_argument('model_dir',help='the directory of a model that was constructed using the train procedure')
     parser.add_argument('dataset',help='a json specification for the dataset to infer locations on')
     parser.add_argument('infer_file',help='the file that the inferences will be written to')
+    parser.add_argument('--columnar', action='store_true',
+                        help='read the users from the columns written by export_columnar, when they hold the fields the method reads')
         
     logger.debug('infer args = %s' % str(args))
     args = parser.parse_args(args)
@@ -483,7 +496,8 @@ def infer(args,by_user=False):
     model = method_inst.load_model(args.model_dir,settings)
 
     # load the dataset
-    ds = SparseDataset(args.dataset)
+    dataset_class = ColumnarDataset if args.columnar else SparseDataset
+    ds = dataset_class(args.dataset)
 
     # get the output file ready
     outfh = open(args.infer_file,'w')
@@ -499,7 +513,7 @@ def infer(args,by_user=False):
     if by_user:
         num_posts_seen = 0
         num_posts_located = 0
-        num_users_seen = 0
+        progress = ds.user_progress('Inferring locations by user',logger)
         for user in ds.user_iter():
             user_id = user['user_id']
             posts = user['posts']
@@ -507,28 +521,27 @@ def infer(args,by_user=False):
             locs = model.infer_posts_locations_by_user(user_id,posts)
 
             assert len(locs) == len(posts)
-            num_users_seen += 1
+            progress.update()
 
             for loc,post in zip(locs,posts):
                 num_posts_seen += 1
                 if not loc is None:
                     num_posts_located += 1
                     outfh.write('%s\t%f\t%f\n' % (post['id'],loc[0],loc[1]))
-
-                if num_posts_seen % 10000 == 0:
-                        logger.debug("Saw %d users, %d posts, %d of which were located" % (num_users_seen, num_posts_seen, num_posts_located))
+        progress.done()
+        logger.info("Saw %d posts, %d of which were located" % (num_posts_seen, num_posts_located))
     else:
-        num_posts_seen = 0
         num_posts_located = 0
+        progress = ds.post_progress('Inferring locations by post',logger)
         for post in ds.post_iter():
             user_id = post['user']['id_str']
             loc = model.infer_post_location(post)
-            num_posts_seen += 1
+            progress.update()
             if not loc is None:
                 outfh.write('%s\t%f\t%f\n' % (post['id'],loc[0],loc[1]))
                 num_posts_located += 1
-            if num_posts_seen % 10000 == 0:
-                    logger.debug("Saw %d posts, %d of which were located" % (num_posts_seen, num_posts_located))
+        progress.done()
+        logger.info("Saw %d posts, %d of which were located" % (progress.count, num_posts_located))
 
     outfh.close()
 
@@ -543,8 +556,12 @@ def get_mention_users(post):
 def build_dataset(args):
     parser = argparse.ArgumentParser(prog='geoinf build_dataset',description='build a new dataset')
     parser.add_argument('-f','--force',action='store_true')
+    parser.add_argument('-n','--num_workers',type=int,default=None,
+                        help='the number of processes used to build the users file (default: one per core)')
+    parser.add_argument('-b','--backend',choices=['files','sqlite'],default='files',
+                        help='also build an SQLite store of the dataset for indexed lookups (sqlite)')
     parser.add_argument('dataset_dir',help='the directory to put the dataset in')
-    parser.add_argument('posts_file',help='the posts.json.gz file to use')
+    parser.add_argument('posts_file',help='the posts.json.gz (or .zst or .lz4) file to use')
     parser.add_argument('user_id_field',help='the field name holding the user id of the post author')
     parser.add_argument('mention_field',help='the field name holding the list of user ids mentioned in a post')
 
@@ -556,17 +573,156 @@ def build_dataset(args):
     posts2dataset(args.dataset_dir,args.posts_file,
                   get_uid_field,
                   get_mention_users,
-                  force=args.force)
+                  force=args.force,
+                  num_workers=args.num_workers)
+
+    if args.backend == 'sqlite':
+        build_sqlite_dataset(args.dataset_dir)
     
     # done
 
+def append_dataset_posts(args):
+    parser = argparse.ArgumentParser(prog='geoinf append_posts',description='add new posts to an existing dataset')
+    parser.add_argument('-n','--num_workers',type=int,default=None,
+                        help='the number of processes used to build the users file (default: one per core)')
+    parser.add_argument('dataset_dir',help='the directory of the dataset')
+    parser.add_argument('posts_file',help='the .json.gz file with the new posts')
+    parser.add_argument('user_id_field',help='the field name holding the user id of the post author')
+    parser.add_argument('mention_field',help='the field name holding the list of user ids mentioned in a post')
+
+    args = parser.parse_args(args)
+
+    segment_dir = append_posts(args.dataset_dir,args.posts_file,
+                               get_uid_field,
+                               get_mention_users,
+                               num_workers=args.num_workers)
+    logger.info('added the posts as %s' % segment_dir)
+
+    # done
+
+def compact(args):
+    parser = argparse.ArgumentParser(prog='geoinf compact',description='fold the posts added with append_posts into the dataset files')
+    parser.add_argument('dataset_dir',help='the directory of the dataset')
+
+    args = parser.parse_args(args)
+
+    compact_dataset(args.dataset_dir)
+
+    # done
+
+def export_columns(args):
+    parser = argparse.ArgumentParser(prog='geoinf export_columnar',description='write the per-user columns of a dataset for bulk loading')
+    parser.add_argument('--fields',nargs='+',default=DEFAULT_FIELDS,
+                        help='the post fields to export (default: %s)' % ' '.join(DEFAULT_FIELDS))
+    parser.add_argument('--format',choices=['parquet','npz'],default=default_format(),
+                        help='the format of the column files (parquet requires pyarrow)')
+    parser.add_argument('dataset_dir',help='the directory of the dataset')
+    parser.add_argument('columns_dir',nargs='?',default=None,
+                        help='the directory to write the columns to (default: dataset_dir/columns)')
+
+    args = parser.parse_args(args)
+
+    export_columnar(args.dataset_dir,args.fields,args.format,args.columns_dir)
+
+    # done
+
+def build_gazetteers(args):
+    parser = argparse.ArgumentParser(prog='geoinf build_gazetteer',description='compile gazetteers into memory-mapped indices that the geocoder loads instead of the source files')
+    parser.add_argument('--memory_report',action='store_true',
+                        help='report the memory used by each gazetteer, compared with plain dictionaries')
+    parser.add_argument('datasets',nargs='+',choices=sorted(GAZETTEER_SOURCES.keys()),
+                        help='the gazetteers to compile')
+
+    args = parser.parse_args(args)
+
+    for dataset in args.datasets:
+        build_gazetteer(dataset)
+
+    if args.memory_report:
+        mb = lambda num_bytes: num_bytes / float(1 << 20)
+        print 'gazetteer\tnames\tdicts (MB)\theap (MB)\tmapped (MB)\tsaved'
+        for dataset in args.datasets:
+            report = Geocoder(dataset, use_gazetteer=False).memory_report()
+            mapped = Geocoder(dataset).memory_report()
+            print '%s\t%d\t%.1f\t%.1f\t%.1f\t%.0f%%' % \
+                (dataset, report['names'], mb(report['dicts']), mb(report['heap']),
+                 mb(mapped['mapped']), 100.0 * (1 - report['heap'] / float(report['dicts'])))
+
+    # done
+
+def home_locations(args):
+    parser = argparse.ArgumentParser(prog='geoinf build_home_locations',description='write the home locations of the users in a dataset, to be used as ground truth')
+    parser.add_argument('-s','--source',choices=HOME_LOCATION_SOURCES,default='loc-field',
+                        help='how the home locations are found (loc-field: geocode the location field of the user profiles; geo-median: the geometric median of the GPS points of their posts)')
+    parser.add_argument('-p','--policy',choices=LOCATION_POLICIES,default='first',
+                        help='which of the location strings of a user to geocode')
+    parser.add_argument('-g','--gazetteer',choices=sorted(GAZETTEER_SOURCES.keys()),default='geonames',
+                        help='the gazetteer used to geocode the location strings')
+    parser.add_argument('-n','--num_workers',type=int,default=None,
+                        help='the number of processes used to geocode or to compute the medians (default: one per core)')
+    parser.add_argument('-c','--cache',default=None,
+                        help='a file of geocoded location strings that is reused and extended across runs')
+    parser.add_argument('-w','--weiszfeld',action='store_true',
+                        help='use the geometric median found by Weiszfeld\'s algorithm, rather than the user\'s point closest to it (geo-median)')
+    parser.add_argument('-r','--restart',action='store_true',
+                        help='discard the checkpoint of an interrupted run rather than resuming it (geo-median)')
+    parser.add_argument('dataset_dir',help='the directory of the dataset')
+
+    args = parser.parse_args(args)
+
+    stats = build_home_locations(args.dataset_dir,args.source,args.policy,
+                                 gazetteer=args.gazetteer,
+                                 num_workers=args.num_workers,
+                                 cache_fname=args.cache,
+                                 snap=not args.weiszfeld,
+                                 restart=args.restart)
+    if args.source == 'geo-median':
+        print("Located %d of %d users (%.1f%%; %d users were done by an earlier run)"
+              % (stats['located'], stats['users'], 100 * stats['hit_rate'], stats['resumed']))
+        print("Took %(seconds).1f seconds (%(users_per_sec).1f users/sec)" % stats)
+        return
+
+    print("Located %d of %d users (%d with a location string, %.1f%% of those located)"
+          % (stats['located'], stats['users'], stats['with_location'], 100 * stats['hit_rate']))
+    print("Geocoded %d of %d distinct location strings (%.1f%% cached, %d located)"
+          % (stats['geocoded'], stats['names'], 100 * stats['cache_hit_rate'], stats['located_names']))
+    print("Took %(seconds).1f seconds (%(users_per_sec).1f users/sec, %(names_per_sec).1f strings/sec)" % stats)
+
+    # done
+
+def counties(args):
+    parser = argparse.ArgumentParser(prog='geoinf assign_counties',description='write the county of the home location of each user in a dataset, to stratify users by urban/rural level')
+    parser.add_argument('-s','--source',default='geo-median',
+                        help='the source of the home locations, as in users.home-locations.<source>.tsv.gz (default: geo-median)')
+    parser.add_argument('-p','--id_property',default='FIPS',
+                        help='the property of the county features that identifies them (default: FIPS)')
+    parser.add_argument('-n','--num_workers',type=int,default=None,
+                        help='the number of processes used to assign the users (default: one per core)')
+    parser.add_argument('dataset_dir',help='the directory of the dataset')
+    parser.add_argument('counties_file',help='a GeoJSON file of the county polygons')
+
+    args = parser.parse_args(args)
+
+    num_users, num_assigned = assign_counties(args.dataset_dir,args.counties_file,
+                                              source=args.source,
+                                              id_property=args.id_property,
+                                              num_workers=args.num_workers)
+    print("Assigned %d of %d users to a county" % (num_assigned, num_users))
+
+    # done
+
 def main():
     parser = argparse.ArgumentParser(prog='geoinf',description='run a geolocation inference method on a dataset')
     parser.add_argument('-l','--log_level',
                         choices=['DEBUG','INFO','WARN','ERROR','FATAL'],
                         default='INFO',help='set the logging level')
+    parser.add_argument('-t','--decompress_threads',type=int,default=None,
+                        help='decompress dataset files in a separate process using up to this many threads')
     parser.add_argument('action',choices=['train','infer_by_post','infer_by_user',
-                          'ls_methods','build_dataset','create_folds','cross_validate'],
+                          'ls_methods','build_dataset','append_posts','compact',
+                          'export_columnar','build_gazetteer','build_home_locations',
+                          'assign_counties',
+                          'create_folds','cross_validate'],
             help='indicate whether to train a new model or infer locations')
     parser.add_argument('action_args',nargs=argparse.REMAINDER,
             help='arguments specific to the chosen action')
@@ -575,6 +731,8 @@ def main():
 
     logging.basicConfig(level=eval('logging.%s' % args.log_level),
                         format='%(message)s')
+    if args.decompress_threads is not None:
+        compression.DEFAULT_THREADS = args.decompress_threads
 
     try:
         if args.action == 'train':
@@ -587,6 +745,18 @@ def main():
             infer(args.action_args,True)
         elif args.action == 'build_dataset':
             build_dataset(args.action_args)
+        elif args.action == 'append_posts':
+            append_dataset_posts(args.action_args)
+        elif args.action == 'compact':
+            compact(args.action_args)
+        elif args.action == 'export_columnar':
+            export_columns(args.action_args)
+        elif args.action == 'build_gazetteer':
+            build_gazetteers(args.action_args)
+        elif args.action == 'build_home_locations':
+            home_locations(args.action_args)
+        elif args.action == 'assign_counties':
+            counties(args.action_args)
         elif args.action == 'create_folds':
             create_folds(args.action_args)
         elif args.action == 'cross_validate':
@@ -0,0 +1,142 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Support for block-compressed gzip files, in the spirit of BGZF.  A block gzip
+file is a sequence of independent gzip members, each holding a run of complete
+lines of roughly `BLOCK_SIZE` uncompressed bytes.  Since concatenated gzip
+members form a valid gzip stream, these files can still be read front-to-back
+with `gzip.open` (or `zcat`), but any line can also be read directly by seeking
+to the start of its block and decompressing only that block.
+
+A line's location is a pair (block_offset, line_offset), where block_offset is
+the byte offset of the block in the compressed file and line_offset is the
+offset of the line within the decompressed block.
+"""
+
+import os, os.path
+import logging
+import zlib
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# The number of uncompressed bytes buffered before a block is written
+BLOCK_SIZE = 64 * 1024
+
+# zlib window bits for reading and writing gzip-wrapped deflate streams
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+class BlockGzipWriter(object):
+    """
+    Writes lines to a block gzip file, reporting the location of each line as
+    it is written so that callers can build an index over the file.
+    """
+
+    def __init__(self, fname, block_size=BLOCK_SIZE, compresslevel=6):
+        self._fh = open(fname, 'wb')
+        self._block_size = block_size
+        self._compresslevel = compresslevel
+        self._block = []
+        self._block_len = 0
+        self._block_offset = 0
+        self.num_blocks = 0
+
+    def write_line(self, line):
+        """
+        Writes the line (which should not contain a newline) and returns its
+        (block_offset, line_offset) location.
+        """
+        if self._block_len >= self._block_size:
+            self.flush()
+        location = (self._block_offset, self._block_len)
+        self._block.append(line)
+        self._block.append('\n')
+        self._block_len += len(line) + 1
+        return location
+
+    def flush(self):
+        """
+        Compresses and writes out the current block, if it has any lines.
+        """
+        if self._block_len == 0:
+            return
+        compressor = zlib.compressobj(self._compresslevel, zlib.DEFLATED, GZIP_WBITS)
+        data = compressor.compress(''.join(self._block)) + compressor.flush()
+        self._fh.write(data)
+        self._block_offset += len(data)
+        self._block = []
+        self._block_len = 0
+        self.num_blocks += 1
+
+    def close(self):
+        self.flush()
+        self._fh.close()
+
+
+def read_block(fh, block_offset, chunk_size=BLOCK_SIZE):
+    """
+    Returns the decompressed contents of the block starting at block_offset
+    in the open (binary) file handle.
+    """
+    fh.seek(block_offset)
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    parts = []
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            break
+        parts.append(decompressor.decompress(chunk))
+        # Anything past the end of this member belongs to the next block
+        if decompressor.unused_data:
+            break
+    return ''.join(parts)
+
+def read_lines(fh, locations):
+    """
+    Yields the lines at the (block_offset, line_offset) locations in the open
+    (binary) file handle.  Locations are read in file order, and each block is
+    decompressed at most once.
+    """
+    block_offset = None
+    block = None
+    for loc in sorted(locations):
+        if loc[0] != block_offset:
+            block_offset = loc[0]
+            block = read_block(fh, block_offset)
+        end = block.find('\n', loc[1])
+        if end < 0:
+            end = len(block)
+        yield block[loc[1]:end]
+
+def read_blocks(fh, start, end, chunk_size=BLOCK_SIZE):
+    """
+    Yields the decompressed contents of each block that starts at or after
+    byte offset `start` and before byte offset `end` in the open (binary) file
+    handle, where `start` must be the offset of a block.
+    """
+    fh.seek(start)
+    offset = start
+    data = ''
+    while offset < end:
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        parts = []
+        consumed = 0
+        while True:
+            if not data:
+                data = fh.read(chunk_size)
+                if not data:
+                    break
+            parts.append(decompressor.decompress(data))
+            # Anything past the end of this member belongs to the next block
+            unused = len(decompressor.unused_data)
+            consumed += len(data) - unused
+            data = decompressor.unused_data
+            if unused > 0:
+                break
+        if consumed == 0:
+            break
+        yield ''.join(parts)
+        offset += consumed
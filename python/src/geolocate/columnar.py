@@ -0,0 +1,506 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Columnar copies of the per-user data of a dataset.  Most methods use only a
+few fields of each post, so `export_columnar` writes those fields as columns
+of a table with one row per post (grouped by user), along with a table with
+one row per user, to `ds_root/columns/`:
+
+    columns.json    - the exported fields, the kind of each column, and the
+                      signature of the users file the columns were built from
+    users.<format>  - `user_id`, `user_index` (in the `UserIdTable`),
+                      `post_start` and `post_count` (the user's rows in the
+                      posts table), `home_lat` and `home_lon` (NaN if the
+                      user has no home location) and, if `user.location` is
+                      exported, `location` (the user's last non-empty
+                      self-reported location)
+    posts.<format>  - one column per exported field, and `geo.lat` and
+                      `geo.lon` (NaN for posts without GPS) if `geo` is
+                      exported
+
+The tables are written as Parquet files if the optional `pyarrow` package is
+installed, and as numpy `.npz` files otherwise.  A field's column holds ints,
+floats or strings if all of its values are of that type, and JSON text
+otherwise (e.g., for `place`), with a separate `<field>#state` column telling
+whether the field was missing, null or set in each post, or whether one of
+the dicts along its path was null (e.g., `user.location` in a post whose
+`user` is null).  In `.npz` files,
+string columns are stored as utf-8 bytes with the offset of each value.
+
+`ColumnarDataset` reads the columns in bulk, either as arrays (see `columns`,
+`user_table` and `gps_points`) or as users with posts reduced to the requested
+fields, and falls back to the `SparseDataset` it extends for fields that were
+not exported or if the users file has changed since the export.
+"""
+
+import json
+import os, os.path
+import logging
+
+import numpy
+
+from csr_graph import source_signature
+from sparse_dataset import SparseDataset, project_post
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# The fields exported by default, which are those read by the methods
+DEFAULT_FIELDS = ['text', 'geo', 'place', 'user.id', 'user.id_str', 'user.location']
+
+# The values of a field's state column.  A state of NULL_PARENT + d means
+# that the value of the d'th key on the field's path was null, so the post
+# is rebuilt with that null, as `project_post` would keep it.
+MISSING, NULL, PRESENT, NULL_PARENT = 0, 1, 2, 3
+
+def default_format():
+    """
+    Returns the format columns are written in: 'parquet' if `pyarrow` is
+    installed, or 'npz' otherwise.
+    """
+    return 'parquet' if pyarrow is not None else 'npz'
+
+def export_columnar(dataset_dir, fields=None, fmt=None, columns_dir=None):
+    """
+    Writes the fields (by default, `DEFAULT_FIELDS`) of every post in the
+    dataset, and the per-user columns, to `columns_dir` (by default,
+    `dataset_dir/columns`) in the format `fmt` ('parquet' or 'npz').  Posts
+    appended since the dataset was last compacted are included.
+
+    Returns the metadata written to `columns.json`.
+    """
+    if fields is None:
+        fields = DEFAULT_FIELDS
+    fields = sorted(set(fields))
+    if fmt is None:
+        fmt = default_format()
+    if fmt == 'parquet' and pyarrow is None:
+        raise Exception('writing parquet files requires the pyarrow package')
+    if columns_dir is None:
+        columns_dir = os.path.join(dataset_dir, 'columns')
+    if not os.path.exists(columns_dir):
+        os.mkdir(columns_dir)
+
+    ds = SparseDataset(dataset_dir)
+    id_table = ds.user_ids()
+    paths = [f.split('.') for f in fields]
+
+    user_ids = []
+    post_counts = []
+    locations = []
+    values = dict((f, []) for f in fields)
+    for user in ds.user_iter(fields=fields):
+        user_ids.append(user['user_id'])
+        post_counts.append(len(user['posts']))
+        location = None
+        for post in user['posts']:
+            for field, path in zip(fields, paths):
+                values[field].append(_get_path(post, path))
+            if 'user.location' in values:
+                loc = values['user.location'][-1]
+                if isinstance(loc, basestring) and len(loc.strip()) > 0:
+                    location = loc
+        locations.append(location)
+
+    # Users are kept in the order of the users file, so each user's posts are
+    # a contiguous run of rows
+    post_counts = numpy.array(post_counts, dtype=numpy.int64)
+    post_starts = numpy.zeros(len(post_counts), dtype=numpy.int64)
+    if len(post_counts) > 0:
+        post_starts[1:] = numpy.cumsum(post_counts)[:-1]
+    user_indices = numpy.array([id_table.intern(u) for u in user_ids], dtype=numpy.int32)
+    if id_table.is_dirty():
+        id_table.save()
+
+    home_lats = numpy.empty(len(user_ids))
+    home_lats.fill(numpy.nan)
+    home_lons = home_lats.copy()
+    if os.path.exists(ds._users_with_locations_fname):
+        users, lats, lons = ds.user_home_locations()
+        rows = numpy.empty(len(id_table), dtype=numpy.int64)
+        rows.fill(-1)
+        rows[user_indices] = numpy.arange(len(user_indices))
+        found = rows[users] >= 0
+        home_lats[rows[users[found]]] = lats[found]
+        home_lons[rows[users[found]]] = lons[found]
+
+    user_columns = { 'user_id': ('string', user_ids),
+                     'user_index': ('int', user_indices),
+                     'post_start': ('int', post_starts),
+                     'post_count': ('int', post_counts),
+                     'home_lat': ('float', home_lats),
+                     'home_lon': ('float', home_lons) }
+    if 'user.location' in values:
+        user_columns['location'] = ('string', locations)
+
+    post_columns = {}
+    kinds = {}
+    for field in fields:
+        kind, state, column = _encode_field(values[field])
+        post_columns[field] = (kind, column)
+        post_columns[field + '#state'] = ('int', state)
+        kinds[field] = kind
+    if 'geo' in values:
+        lats, lons = _gps_coordinates(values['geo'])
+        post_columns['geo.lat'] = ('float', lats)
+        post_columns['geo.lon'] = ('float', lons)
+
+    ext = '.' + fmt
+    _write_table(os.path.join(columns_dir, 'users' + ext), user_columns, fmt)
+    _write_table(os.path.join(columns_dir, 'posts' + ext), post_columns, fmt)
+
+    meta = { 'format': fmt,
+             'fields': fields,
+             'kinds': kinds,
+             'num_users': len(user_ids),
+             'num_posts': int(post_counts.sum()),
+             'source': source_signature(ds._users_fname),
+             'num_deltas': len(ds.deltas()) }
+    with open(os.path.join(columns_dir, 'columns.json'), 'w') as fh:
+        json.dump(meta, fh, indent=1)
+    logger.info('exported %d fields of %d posts by %d users to %s'
+                % (len(fields), meta['num_posts'], meta['num_users'], columns_dir))
+    return meta
+
+def _get_path(post, path):
+    """
+    Returns the value at the path of keys into the post's nested dicts,
+    `_Missing` if the post has no such field, or a `_NullParent` if one of the
+    dicts along the path is null.
+    """
+    value = post
+    for depth, key in enumerate(path):
+        if not isinstance(value, dict) or not key in value:
+            return _Missing
+        value = value[key]
+        if value is None and depth < len(path) - 1:
+            return _NullParent(depth)
+    return value
+
+class _Missing(object):
+    """
+    The value of a field a post does not have.
+    """
+    pass
+
+class _NullParent(object):
+    """
+    The value of a field whose parent at the depth on its path is null.
+    """
+    def __init__(self, depth):
+        self.depth = depth
+
+def _field_state(value):
+    if value is _Missing:
+        return MISSING
+    if value is None:
+        return NULL
+    if isinstance(value, _NullParent):
+        return NULL_PARENT + value.depth
+    return PRESENT
+
+def _encode_field(values):
+    """
+    Returns the (kind, state, column) of the field with the values, where the
+    kind is 'int', 'float', 'string' or 'json' depending on the types of the
+    values that are set.
+    """
+    state = numpy.array([_field_state(v) for v in values], dtype=numpy.int8)
+    set_values = [v for v, s in zip(values, state) if s == PRESENT]
+    types = set(type(v) for v in set_values)
+
+    if len(types) > 0 and types <= set([int, long]):
+        column = numpy.zeros(len(values), dtype=numpy.int64)
+        column[state == PRESENT] = set_values
+        return 'int', state, column
+    if len(types) > 0 and types <= set([int, long, float]):
+        column = numpy.empty(len(values))
+        column.fill(numpy.nan)
+        column[state == PRESENT] = set_values
+        return 'float', state, column
+    if types <= set([str, unicode]):
+        return 'string', state, [v if s == PRESENT else None for v, s in zip(values, state)]
+    return 'json', state, [json.dumps(v) if s == PRESENT else None
+                           for v, s in zip(values, state)]
+
+def _gps_coordinates(geos):
+    """
+    Returns the (lats, lons) arrays of the GPS point of each post's `geo`
+    field, with NaN for posts without one.
+    """
+    lats = numpy.empty(len(geos))
+    lats.fill(numpy.nan)
+    lons = lats.copy()
+    for i, geo in enumerate(geos):
+        if not isinstance(geo, dict) or not isinstance(geo.get('coordinates'), list):
+            continue
+        coords = geo['coordinates']
+        if len(coords) < 2:
+            continue
+        try:
+            lats[i] = float(coords[0])
+            lons[i] = float(coords[1])
+        except (TypeError, ValueError):
+            continue
+    return lats, lons
+
+def _write_table(fname, columns, fmt):
+    """
+    Writes the columns, a dict from name to (kind, values), to the file.
+    """
+    if fmt == 'parquet':
+        names = sorted(columns)
+        arrays = []
+        for name in names:
+            kind, values = columns[name]
+            if kind in ('string', 'json'):
+                arrays.append(pyarrow.array(values, type=pyarrow.string()))
+            else:
+                arrays.append(pyarrow.array(values))
+        table = pyarrow.Table.from_arrays(arrays, names)
+        pyarrow.parquet.write_table(table, fname + '.tmp')
+    elif fmt == 'npz':
+        arrays = {}
+        for name, (kind, values) in columns.iteritems():
+            if kind in ('string', 'json'):
+                data, offsets = _encode_strings(values)
+                arrays[name + '#data'] = data
+                arrays[name + '#offsets'] = offsets
+            else:
+                arrays[name] = values
+        with open(fname + '.tmp', 'wb') as fh:
+            numpy.savez(fh, **arrays)
+    else:
+        raise ValueError('unknown columnar format: %s' % fmt)
+    os.rename(fname + '.tmp', fname)
+
+def _encode_strings(values):
+    """
+    Returns the (data, offsets) arrays of the strings, where string i is the
+    utf-8 bytes data[offsets[i]:offsets[i+1]].  Null strings are encoded as
+    empty strings, since their state column tells them apart.
+    """
+    encoded = [v.encode('utf-8') if isinstance(v, unicode) else (v or '') for v in values]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    if len(encoded) > 0:
+        offsets[1:] = numpy.cumsum([len(v) for v in encoded])
+    data = numpy.frombuffer(''.join(encoded), dtype=numpy.uint8)
+    return data, offsets
+
+def _read_table(fname, fmt, names):
+    """
+    Returns a dict from the name of each column in `names` to its values, as
+    an array for numeric columns and as a list of unicode strings (or None)
+    for string columns.
+    """
+    columns = {}
+    if fmt == 'parquet':
+        table = pyarrow.parquet.read_table(fname, columns=names)
+        for name in names:
+            column = table.column(name)
+            if column.type == pyarrow.string():
+                columns[name] = column.to_pylist()
+            else:
+                columns[name] = column.to_numpy()
+    elif fmt == 'npz':
+        with numpy.load(fname) as npz:
+            for name in names:
+                if name in npz.files:
+                    columns[name] = npz[name]
+                else:
+                    data = npz[name + '#data'].tobytes()
+                    offsets = npz[name + '#offsets'].tolist()
+                    columns[name] = [data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                                     for i in xrange(len(offsets) - 1)]
+    else:
+        raise ValueError('unknown columnar format: %s' % fmt)
+    return columns
+
+class ColumnarDataset(SparseDataset):
+    """
+    A dataset whose users are read from the columns written by
+    `export_columnar`, when all the requested fields were exported.  Other
+    requests, and everything else (networks, home locations, etc.), are
+    handled by `SparseDataset`.  The arguments are those of `SparseDataset`,
+    along with `columns_dir` (by default, `dataset_dir/columns`).
+    """
+
+    def __init__(self, dataset_dir, *args, **kwargs):
+        columns_dir = kwargs.pop('columns_dir', None)
+        super(ColumnarDataset, self).__init__(dataset_dir, *args, **kwargs)
+        if columns_dir is None:
+            columns_dir = os.path.join(dataset_dir, 'columns')
+        self._columns_dir = columns_dir
+        self._columns_meta = None
+        meta_fname = os.path.join(columns_dir, 'columns.json')
+        if os.path.exists(meta_fname):
+            with open(meta_fname, 'r') as fh:
+                self._columns_meta = json.load(fh)
+        self._columns_current = None
+        self._columns = {}
+
+    def has_columns(self, fields=None):
+        """
+        Returns True if the columns are current and hold the fields (each of
+        which may be an exported field or a field nested inside one).
+        """
+        meta = self._columns_meta
+        if meta is None:
+            return False
+        if self._columns_current is None:
+            self._columns_current = meta['source'] == source_signature(self._users_fname) \
+                and len(self.deltas()) == meta['num_deltas']
+            if not self._columns_current:
+                logger.warn('the columns in %s are out of date' % self._columns_dir)
+        if not self._columns_current:
+            return False
+        if fields is None:
+            return True
+        return all(self._exported_field(f) is not None for f in fields)
+
+    def _exported_field(self, field):
+        """
+        Returns the exported field that holds the field, or None.
+        """
+        for exported in self._columns_meta['fields']:
+            if field == exported or field.startswith(exported + '.'):
+                return exported
+        return None
+
+    def columns(self, names, table='posts'):
+        """
+        Returns a dict from the name of each column of the table ('users' or
+        'posts') to its values, which are arrays for numeric columns and lists
+        of strings otherwise.  Columns are cached once read.
+        """
+        missing = [n for n in names if not (table, n) in self._columns]
+        if len(missing) > 0:
+            fmt = self._columns_meta['format']
+            fname = os.path.join(self._columns_dir, table + '.' + fmt)
+            for name, values in _read_table(fname, fmt, missing).iteritems():
+                self._columns[(table, name)] = values
+        return dict((n, self._columns[(table, n)]) for n in names)
+
+    def user_table(self):
+        """
+        Returns the columns of the users table as a dict of arrays (and lists,
+        for the string columns).
+        """
+        names = ['user_id', 'user_index', 'post_start', 'post_count', 'home_lat', 'home_lon']
+        if 'user.location' in self._columns_meta['fields']:
+            names.append('location')
+        return self.columns(names, 'users')
+
+    def gps_points(self):
+        """
+        Returns the (users, lats, lons) arrays of the GPS points of all posts,
+        where users are given by their index in the `UserIdTable`.  The points
+        of users in `excluded_users` are left out.
+        """
+        users = self.columns(['user_index', 'post_count'], 'users')
+        posts = self.columns(['geo.lat', 'geo.lon'])
+        post_users = numpy.repeat(users['user_index'], users['post_count'])
+        has_gps = ~numpy.isnan(posts['geo.lat'])
+        if len(self.excluded_users) > 0:
+            excluded = self.user_ids().indices(self.excluded_users)
+            has_gps &= ~numpy.in1d(post_users, excluded)
+        return post_users[has_gps], posts['geo.lat'][has_gps], posts['geo.lon'][has_gps]
+
+    def user_iter(self, fields=None, shard=None, num_shards=None):
+        if fields is None or not self.has_columns(fields):
+            return super(ColumnarDataset, self).user_iter(fields, shard, num_shards)
+        return self.iter_users(None, fields, shard, num_shards)
+
+    def iter_users(self, user_ids, fields=None, shard=None, num_shards=None):
+        """
+        Returns an iterator over the users with the specified ids (or all
+        users), as in `SparseDataset.iter_users`.  If the fields were
+        exported, the users are built from the columns, with shards being
+        contiguous runs of rows.
+        """
+        if fields is None or not self.has_columns(fields):
+            return super(ColumnarDataset, self).iter_users(user_ids, fields, shard, num_shards)
+        return self._iter_column_users(user_ids, fields, shard, num_shards)
+
+    def _indexed_users_file(self, fields):
+        # The columns are read before workers are forked by `map_users`
+        if fields is not None and self.has_columns(fields):
+            self._load_columns(fields)
+            return None
+        return super(ColumnarDataset, self)._indexed_users_file(fields)
+
+    def _load_columns(self, fields):
+        """
+        Returns the users columns and the columns of the exported fields that
+        hold the fields.
+        """
+        exported = sorted(set(self._exported_field(f) for f in fields))
+        names = []
+        for field in exported:
+            names.extend([field, field + '#state'])
+        users = self.columns(['user_id', 'post_start', 'post_count'], 'users')
+        return users, exported, self.columns(names)
+
+    def _iter_column_users(self, user_ids, fields, shard, num_shards):
+        users, exported, columns = self._load_columns(fields)
+        user_id_column = users['user_id']
+        paths = [f.split('.') for f in sorted(set(fields))]
+        exported_paths = [(f.split('.'), columns[f], columns[f + '#state'],
+                           self._columns_meta['kinds'][f]) for f in exported]
+        # The fields are exported whole, so only nested fields need projecting
+        needs_projection = sorted(set(fields)) != exported
+
+        rows = xrange(len(user_id_column))
+        if shard is not None:
+            rows = numpy.array_split(numpy.arange(len(user_id_column)), num_shards)[shard].tolist()
+        wanted = None
+        if user_ids is not None:
+            wanted = user_ids if isinstance(user_ids, (set, frozenset, dict)) \
+                else set(user_ids)
+
+        for row in rows:
+            user_id = user_id_column[row]
+            if wanted is not None and not user_id in wanted:
+                continue
+            start = int(users['post_start'][row])
+            posts = []
+            for i in xrange(start, start + int(users['post_count'][row])):
+                post = {}
+                for path, column, state, kind in exported_paths:
+                    if state[i] == MISSING:
+                        continue
+                    if state[i] >= NULL_PARENT:
+                        depth = int(state[i]) - NULL_PARENT
+                        dest = post
+                        for key in path[:depth]:
+                            dest = dest.setdefault(key, {})
+                        dest[path[depth]] = None
+                        continue
+                    value = None
+                    if state[i] == PRESENT:
+                        value = column[i]
+                        if kind == 'json':
+                            value = json.loads(value)
+                        elif kind == 'int':
+                            value = int(value)
+                        elif kind == 'float':
+                            value = float(value)
+                    dest = post
+                    for key in path[:-1]:
+                        dest = dest.setdefault(key, {})
+                    dest[path[-1]] = value
+                if needs_projection:
+                    post = project_post(post, paths)
+                if user_id in self.excluded_users:
+                    post.pop('geo', None)
+                posts.append(post)
+            yield { 'user_id': user_id, 'posts': posts }
@@ -0,0 +1,280 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Opening compressed dataset, model and results files.  The codec of a file is
+chosen by its extension:
+
+    .gz  - gzip (the default, and the only codec for the block-indexed
+           `users.json.gz`; see `block_gzip`)
+    .zst - zstandard
+    .lz4 - lz4
+    anything else - uncompressed
+
+zstd and lz4 files are handled by the `zstd` and `lz4` commands if they are
+installed, or else by the optional `zstandard` and `lz4` Python packages.
+
+Decompression is the main cost of scanning a dataset, so files can also be
+read through an external decompressor running in its own process (`pigz` or
+`gzip` for gzip files), which overlaps decompression with the parsing done in
+Python and, for pigz, uses several threads.  This is enabled by passing
+`threads` to `open_file`, or for all files by setting the
+`GEOINF_DECOMPRESS_THREADS` environment variable.
+"""
+
+import os, os.path
+import logging
+import gzip
+import subprocess
+
+from distutils.spawn import find_executable
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+# The codec for each file extension
+CODECS = { '.gz': 'gzip', '.zst': 'zstd', '.lz4': 'lz4' }
+
+# The extensions tried, in order, when looking for a file by its base name
+EXTENSIONS = ['.gz', '.zst', '.lz4', '']
+
+# The number of threads used to decompress files by default, where 0 means
+# that files are decompressed in-process
+DEFAULT_THREADS = int(os.environ.get('GEOINF_DECOMPRESS_THREADS', '0'))
+
+# The size of the chunks read from a decompressor
+CHUNK_SIZE = 1 << 16
+
+def codec_of(fname):
+    """
+    Returns the name of the codec of the file, or None if it is uncompressed.
+    """
+    return CODECS.get(os.path.splitext(fname)[1])
+
+def find_file(base_fname):
+    """
+    Returns the name of the existing file that is `base_fname` with one of the
+    known codec extensions (e.g., `posts.json` finds `posts.json.zst`), or
+    `base_fname` + '.gz' if there is none.
+    """
+    for ext in EXTENSIONS:
+        if os.path.exists(base_fname + ext):
+            return base_fname + ext
+    return base_fname + '.gz'
+
+def has_codec(codec):
+    """
+    Returns True if files with the codec can be read and written.
+    """
+    if codec == 'zstd':
+        return zstandard is not None or find_executable('zstd') is not None
+    if codec == 'lz4':
+        return lz4frame is not None or find_executable('lz4') is not None
+    return True
+
+def temp_extension():
+    """
+    Returns the extension of the fastest codec that can be used for temporary
+    files written in-process, which is lz4 if the `lz4` package is installed.
+    """
+    return '.lz4' if lz4frame is not None else '.gz'
+
+def model_extension(settings):
+    """
+    Returns the extension of the model files written by a method with the
+    settings, which is given by their `model_codec` ('gz', 'zst' or 'lz4').
+    Models are written with gzip by default.
+    """
+    codec = settings.get('model_codec', 'gz') if settings else 'gz'
+    if not '.' + codec in CODECS:
+        raise ValueError('unknown model_codec: %s' % codec)
+    return '.' + codec
+
+def open_file(fname, mode='r', threads=None, level=None):
+    """
+    Opens the file for reading ('r'), writing ('w') or appending ('a') with the
+    codec given by its extension, returning a file-like object that can be
+    iterated over by line and used as a context manager.
+
+    If `threads` (or `DEFAULT_THREADS`, if it is None) is greater than zero, a
+    compressed file is read or written by an external process that uses up to
+    that many threads.  `level` is the compression level used when writing.
+    """
+    mode = mode.replace('b', '').replace('t', '')
+    if not mode in ('r', 'w', 'a'):
+        raise ValueError('unsupported mode: %s' % mode)
+    if threads is None:
+        threads = DEFAULT_THREADS
+    codec = codec_of(fname)
+
+    if codec is None:
+        return open(fname, mode + 'b')
+
+    if codec == 'gzip':
+        if threads > 0:
+            command = _gzip_command(mode, threads, level)
+            if command is not None:
+                return _open_process(fname, mode, command)
+        return gzip.open(fname, mode + 'b', 6 if level is None else level)
+
+    if find_executable(codec) is not None:
+        return _open_process(fname, mode, _command(codec, mode, threads, level))
+
+    if codec == 'zstd' and zstandard is not None:
+        if mode == 'r':
+            reader = zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'))
+            return StreamFile(reader)
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level,
+                                              threads=threads)
+        return StreamFile(compressor.stream_writer(open(fname, mode + 'b')))
+    if codec == 'lz4' and lz4frame is not None:
+        if level is None:
+            return lz4frame.open(fname, mode + 'b')
+        return lz4frame.open(fname, mode + 'b', compression_level=level)
+
+    raise IOError('cannot open %s: neither the %s command nor its Python '
+                  'package is installed' % (fname, codec))
+
+def _gzip_command(mode, threads, level):
+    """
+    Returns the command that reads or writes gzip data through a pipe, or None
+    if no gzip program is installed.
+    """
+    if find_executable('pigz') is not None:
+        command = ['pigz', '-p', str(threads)]
+    elif find_executable('gzip') is not None:
+        command = ['gzip']
+    else:
+        return None
+    if mode == 'r':
+        return command + ['-dc']
+    return command + ['-c', '-%d' % (6 if level is None else level)]
+
+def _command(codec, mode, threads, level):
+    """
+    Returns the zstd or lz4 command that reads or writes data through a pipe.
+    """
+    if mode == 'r':
+        return [codec, '-dcq']
+    command = [codec, '-cq']
+    if level is not None:
+        command.append('-%d' % level)
+    if codec == 'zstd' and threads > 0:
+        command.append('-T%d' % threads)
+    return command
+
+def _open_process(fname, mode, command):
+    """
+    Returns a `StreamFile` for the file that is read from (or written to) the
+    pipe of a process running the command.
+    """
+    if mode == 'r':
+        fh = open(fname, 'rb')
+        proc = subprocess.Popen(command, stdin=fh, stdout=subprocess.PIPE)
+        fh.close()
+        return StreamFile(proc.stdout, proc, command)
+
+    # Compressed streams can be concatenated, so appending only needs to add
+    # a new stream to the end of the file
+    fh = open(fname, mode + 'b')
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=fh)
+    fh.close()
+    return StreamFile(proc.stdin, proc, command)
+
+class StreamFile(object):
+    """
+    A file-like wrapper for a stream of (de)compressed data, which may be the
+    pipe of a (de)compression process, that supports line iteration.
+    """
+
+    def __init__(self, stream, proc=None, command=None):
+        self._stream = stream
+        self._proc = proc
+        self._command = command
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.closed = False
+
+    def _fill(self):
+        """
+        Reads another chunk into the buffer, dropping the data that has
+        already been returned, and returns False at the end of the stream.
+        """
+        if self._eof:
+            return False
+        chunk = self._stream.read(CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self._buffer) - self._pos
+        while len(self._buffer) - self._pos < size and self._fill():
+            pass
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self):
+        start = self._pos
+        while True:
+            end = self._buffer.find('\n', start)
+            if end >= 0:
+                line = self._buffer[self._pos:end + 1]
+                self._pos = end + 1
+                return line
+            start = len(self._buffer) - self._pos
+            if not self._fill():
+                line = self._buffer[self._pos:]
+                self._pos = len(self._buffer)
+                return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def write(self, data):
+        self._stream.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._stream.close()
+        if self._proc is not None:
+            status = self._proc.wait()
+            # A reader that stops early closes the pipe, which ends the
+            # process with SIGPIPE or an error
+            stopped_early = self._proc.stdout is self._stream and not self._eof
+            if status != 0 and not stopped_early:
+                raise IOError('%s exited with status %d' % (' '.join(self._command), status))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,424 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+A compact, read-only representation of the mention networks stored in a
+dataset directory.  Parsing a large `.elist` file with `zen.edgelist.read` is
+slow, so the first time a network is requested, its edge list is converted to a
+compressed sparse row (CSR) cache that lives next to the source file:
+
+    mention_network.elist.csr/
+        meta.json - the size and modification time of the source edge list,
+                    along with the node and edge counts of the network
+        nodes.npy - int32 array of the indices of the nodes in the network
+        node_ids.txt - one user id per line; the line number is the node index
+                       (only when the dataset's `UserIdTable` isn't used)
+        offsets.npy - int64 array of length n+1, such that the out-neighbors of
+                      node i are neighbors[offsets[i]:offsets[i+1]]
+        neighbors.npy - int32 array of the neighbor indices, sorted per node
+        weights.npy - float64 array parallel to neighbors (weighted only)
+        in_offsets.npy, in_neighbors.npy - the transposed graph (directed only)
+
+The `.npy` files are memory-mapped on load, so opening a cached network costs
+only the time to read the node-id table.  The cache is rebuilt automatically
+whenever the size or modification time of the source edge list changes.
+
+When a dataset's `UserIdTable` is provided, node indices are the interned user
+indices, so per-user arrays indexed by the table line up with the network.  Any
+mentioned users missing from the table are interned when the cache is built.
+"""
+
+import os, os.path
+import json
+import logging
+import shutil
+from array import array
+
+import numpy
+
+from user_ids import UserIdTable
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# Bump this whenever the on-disk layout changes so that stale caches get rebuilt
+CSR_FORMAT_VERSION = 2
+
+def csr_cache_dir(elist_fname):
+    """
+    Returns the directory in which the CSR cache for the edge list is stored.
+    """
+    return elist_fname + '.csr'
+
+def source_signature(fname):
+    """
+    Returns a dict identifying the current contents of the file, which is used
+    to detect when a cache derived from it has gone stale.  The modification
+    time is kept at full precision, so that rewriting a file with the same
+    size within the same second is still noticed.
+    """
+    st = os.stat(fname)
+    return { 'size': st.st_size, 'mtime': st.st_mtime }
+
+def load_csr(elist_fname, directed, weighted, id_table=None, num_edges=None):
+    """
+    Returns the `CSRGraph` for the edge list, building (or rebuilding) its
+    on-disk cache if the cache is missing or out of date.  If `id_table` is
+    provided, nodes are indexed by their index in the table.  `num_edges`, if
+    known (e.g., from the dataset manifest), is used to preallocate the edge
+    arrays when the cache is built.
+    """
+    cache_dir = csr_cache_dir(elist_fname)
+    if not is_csr_current(elist_fname, cache_dir, directed, weighted, id_table):
+        build_csr(elist_fname, cache_dir, directed, weighted, id_table, num_edges)
+    return CSRGraph(cache_dir, id_table)
+
+def is_csr_current(elist_fname, cache_dir, directed, weighted, id_table=None):
+    """
+    Returns True if the cache in `cache_dir` was built from the current
+    version of the edge list with the same directedness, weighting, and node
+    indexing.
+    """
+    meta_fname = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_fname):
+        return False
+    with open(meta_fname, 'r') as fh:
+        meta = json.load(fh)
+    if not (meta.get('version') == CSR_FORMAT_VERSION
+            and meta.get('source') == source_signature(elist_fname)
+            and meta.get('directed') == directed
+            and meta.get('weighted') == weighted
+            and meta.get('shared_ids') == (id_table is not None)):
+        return False
+
+    # The id table is append-only, so the cache's indices are still valid as
+    # long as the table still has the same id in the last slot the cache used
+    if id_table is not None:
+        num_ids = meta['num_nodes']
+        if num_ids > len(id_table):
+            return False
+        if num_ids > 0 and id_table.user_id(num_ids - 1) != meta['last_id']:
+            return False
+    return True
+
+def build_csr(elist_fname, cache_dir, directed, weighted, id_table=None, num_edges=None):
+    """
+    Converts the edge list into a CSR cache in `cache_dir`.  Duplicate edges
+    are ignored, keeping the weight of the first occurrence, which mirrors
+    `zen.edgelist.read(..., ignore_duplicate_edges=True)`.  If `id_table` is
+    provided, any node ids not in the table are interned into it.  If the
+    number of edges is given, the edge arrays are allocated up front rather
+    than grown as the edges are read.
+    """
+    logger.info('building CSR cache for %s' % elist_fname)
+
+    # Record the signature before reading so that a concurrent rewrite of the
+    # source invalidates the cache rather than being silently missed
+    signature = source_signature(elist_fname)
+
+    node_ids = UserIdTable() if id_table is None else id_table
+    intern = node_ids.intern
+    capacity = num_edges if num_edges else 0
+    srcs = array('i', [0]) * capacity
+    dsts = array('i', [0]) * capacity
+    wts = array('d', [0.0]) * (capacity if weighted else 0)
+    n = 0
+
+    with open(elist_fname, 'r') as fh:
+        for line in fh:
+            cols = line.split()
+            if len(cols) < 2:
+                continue
+            u = intern(cols[0])
+            v = intern(cols[1])
+            w = (float(cols[2]) if len(cols) > 2 else 1.0) if weighted else 0.0
+            if n < capacity:
+                srcs[n] = u
+                dsts[n] = v
+                if weighted:
+                    wts[n] = w
+            else:
+                # More edges than expected, so the count was stale
+                srcs.append(u)
+                dsts.append(v)
+                if weighted:
+                    wts.append(w)
+            n += 1
+
+    if n < capacity:
+        del srcs[n:]
+        del dsts[n:]
+        if weighted:
+            del wts[n:]
+
+    src = numpy.frombuffer(srcs, dtype=numpy.int32).astype(numpy.int64) \
+        if len(srcs) > 0 else numpy.zeros(0, dtype=numpy.int64)
+    dst = numpy.frombuffer(dsts, dtype=numpy.int32).astype(numpy.int64) \
+        if len(dsts) > 0 else numpy.zeros(0, dtype=numpy.int64)
+    weights = numpy.frombuffer(wts, dtype=numpy.float64) \
+        if weighted and len(wts) > 0 else numpy.zeros(len(src), dtype=numpy.float64)
+
+    write_csr(cache_dir, node_ids, src, dst, weights if weighted else None,
+              directed, signature, id_table is not None)
+
+def write_csr(cache_dir, node_ids, src, dst, weights, directed, signature,
+              shared_ids=False):
+    """
+    Writes the edges (src[i], dst[i], weights[i]) over the nodes in the
+    `UserIdTable` as a CSR cache in `cache_dir`.  For undirected networks each
+    edge is stored in both directions.  `weights` may be None for unweighted
+    networks.  If `shared_ids` is True, the table belongs to the dataset and is
+    not copied into the cache.
+    """
+    n = len(node_ids)
+    weighted = weights is not None
+
+    # Drop duplicate edges, keeping the first occurrence.  Undirected edges
+    # are canonicalized first so that (u,v) and (v,u) count as duplicates.
+    if directed:
+        keys = src * n + dst
+    else:
+        keys = numpy.minimum(src, dst) * n + numpy.maximum(src, dst)
+    keys, first = numpy.unique(keys, return_index=True)
+    src = src[first]
+    dst = dst[first]
+    if weighted:
+        weights = weights[first]
+    num_edges = len(keys)
+
+    if not directed:
+        # Store both directions of every edge, except for self-loops
+        not_loop = src != dst
+        src, dst = numpy.concatenate((src, dst[not_loop])), \
+                   numpy.concatenate((dst, src[not_loop]))
+        if weighted:
+            weights = numpy.concatenate((weights, weights[not_loop]))
+
+    # Write into a fresh directory and then swap it in place so that readers
+    # never see a half-written cache
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+
+    numpy.save(os.path.join(tmp_dir, 'nodes.npy'),
+               numpy.union1d(src, dst).astype(numpy.int32))
+
+    order = numpy.lexsort((dst, src))
+    offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(src, minlength=n), out=offsets[1:])
+    numpy.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+    numpy.save(os.path.join(tmp_dir, 'neighbors.npy'), dst[order].astype(numpy.int32))
+    if weighted:
+        numpy.save(os.path.join(tmp_dir, 'weights.npy'), weights[order])
+
+    if directed:
+        order = numpy.lexsort((src, dst))
+        in_offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(dst, minlength=n), out=in_offsets[1:])
+        numpy.save(os.path.join(tmp_dir, 'in_offsets.npy'), in_offsets)
+        numpy.save(os.path.join(tmp_dir, 'in_neighbors.npy'), src[order].astype(numpy.int32))
+
+    if not shared_ids:
+        with open(os.path.join(tmp_dir, 'node_ids.txt'), 'w') as fh:
+            for node_id in node_ids:
+                fh.write('%s\n' % node_id)
+
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fh:
+        json.dump({ 'version': CSR_FORMAT_VERSION,
+                    'source': signature,
+                    'directed': directed,
+                    'weighted': weighted,
+                    'shared_ids': shared_ids,
+                    'last_id': node_ids.user_id(n - 1) if n > 0 else None,
+                    'num_nodes': n,
+                    'num_edges': num_edges }, fh)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+    logger.info('wrote CSR cache with %d edges to %s' % (num_edges, cache_dir))
+
+
+class CSRGraph(object):
+    """
+    A read-only, memory-mapped network that supports the subset of the zen
+    graph API used by the geoinference methods (`nodes_iter`, `neighbors`,
+    `neighbors_iter`, `has_edge`, `degree`, `weight`, ...).  Nodes are the
+    string user ids from the edge list; the `*_` variants of the methods
+    operate on integer node indices instead, in the same style as zen.  When
+    the network was loaded with the dataset's `UserIdTable`, node indices are
+    the users' interned indices.
+    """
+
+    def __init__(self, cache_dir, id_table=None):
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as fh:
+            meta = json.load(fh)
+
+        self._directed = meta['directed']
+        self._weighted = meta['weighted']
+        self._num_edges = meta['num_edges']
+        self._num_indices = meta['num_nodes']
+
+        if meta['shared_ids']:
+            if id_table is None:
+                raise ValueError('%s is indexed by the dataset user id table' % cache_dir)
+            self._ids = id_table
+        else:
+            with open(os.path.join(cache_dir, 'node_ids.txt'), 'r') as fh:
+                self._ids = UserIdTable(line.rstrip('\n') for line in fh)
+
+        load = lambda name: numpy.load(os.path.join(cache_dir, name), mmap_mode='r')
+        self._nodes = load('nodes.npy')
+        self._offsets = load('offsets.npy')
+        self._neighbors = load('neighbors.npy')
+        self._weights = load('weights.npy') if self._weighted else None
+        if self._directed:
+            self._in_offsets = load('in_offsets.npy')
+            self._in_neighbors = load('in_neighbors.npy')
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, nobj):
+        return self.has_node_(self._ids.get(nobj))
+
+    def has_node_(self, nidx):
+        if nidx < 0 or nidx >= self._num_indices:
+            return False
+        if self._offsets[nidx+1] > self._offsets[nidx]:
+            return True
+        return self._directed and self._in_offsets[nidx+1] > self._in_offsets[nidx]
+
+    def is_directed(self):
+        return self._directed
+
+    def size(self):
+        """
+        Returns the number of edges in the network.
+        """
+        return self._num_edges
+
+    def nodes_(self):
+        """
+        Returns the sorted array of the indices of the nodes in the network.
+        """
+        return self._nodes
+
+    def nodes(self):
+        return self._ids.user_ids(self._nodes)
+
+    def nodes_iter(self):
+        return iter(self.nodes())
+
+    def node_idx(self, nobj):
+        nidx = self._ids.get(nobj)
+        if not self.has_node_(nidx):
+            raise KeyError(nobj)
+        return nidx
+
+    def node_object(self, nidx):
+        return self._ids.user_id(nidx)
+
+    def out_neighbors_(self, nidx):
+        """
+        Returns the sorted array of indices of the nodes that `nidx` links to.
+        """
+        return self._neighbors[self._offsets[nidx]:self._offsets[nidx+1]]
+
+    def in_neighbors_(self, nidx):
+        """
+        Returns the sorted array of indices of the nodes that link to `nidx`.
+        """
+        if not self._directed:
+            return self.out_neighbors_(nidx)
+        return self._in_neighbors[self._in_offsets[nidx]:self._in_offsets[nidx+1]]
+
+    def neighbors_(self, nidx):
+        """
+        Returns the array of indices of all nodes adjacent to `nidx`.  As in
+        zen, this includes both in- and out-neighbors for directed networks.
+        """
+        if not self._directed:
+            return self.out_neighbors_(nidx)
+        return numpy.union1d(self.out_neighbors_(nidx), self.in_neighbors_(nidx))
+
+    def neighbors(self, nobj):
+        return self._ids.user_ids(self.neighbors_(self.node_idx(nobj)))
+
+    def neighbors_iter(self, nobj):
+        return iter(self.neighbors(nobj))
+
+    def out_neighbors(self, nobj):
+        return self._ids.user_ids(self.out_neighbors_(self.node_idx(nobj)))
+
+    def in_neighbors(self, nobj):
+        return self._ids.user_ids(self.in_neighbors_(self.node_idx(nobj)))
+
+    def degree_(self, nidx):
+        return len(self.neighbors_(nidx))
+
+    def degree(self, nobj):
+        return self.degree_(self.node_idx(nobj))
+
+    def _edge_position(self, uidx, vidx):
+        start = self._offsets[uidx]
+        end = self._offsets[uidx+1]
+        pos = start + numpy.searchsorted(self._neighbors[start:end], vidx)
+        if pos < end and self._neighbors[pos] == vidx:
+            return pos
+        return -1
+
+    def has_edge_(self, uidx, vidx):
+        return self._edge_position(uidx, vidx) >= 0
+
+    def has_edge(self, u, v):
+        uidx = self._ids.get(u)
+        vidx = self._ids.get(v)
+        if not self.has_node_(uidx) or not self.has_node_(vidx):
+            return False
+        return self.has_edge_(uidx, vidx)
+
+    def weight_(self, uidx, vidx):
+        pos = self._edge_position(uidx, vidx)
+        if pos < 0:
+            raise KeyError('no edge (%d, %d)' % (uidx, vidx))
+        return float(self._weights[pos]) if self._weighted else 1.0
+
+    def weight(self, u, v):
+        return self.weight_(self.node_idx(u), self.node_idx(v))
+
+    def to_zen(self):
+        """
+        Returns a mutable zen graph with the same nodes and edges.
+        """
+        import zen
+
+        n = len(self._nodes)
+        if self._directed:
+            G = zen.DiGraph(node_capacity=n + 1, edge_capacity=self._num_edges + 1)
+        else:
+            G = zen.Graph(node_capacity=n + 1, edge_capacity=self._num_edges + 1)
+
+        # Map our indices to the zen graph's node indices
+        zen_idx = {}
+        for nidx in self._nodes:
+            zen_idx[nidx] = G.add_node(self._ids.user_id(nidx))
+
+        offsets = self._offsets
+        neighbors = self._neighbors
+        for u in self._nodes:
+            for pos in xrange(offsets[u], offsets[u+1]):
+                v = neighbors[pos]
+                # Undirected edges are stored in both directions, so only add
+                # each one once
+                if not self._directed and v < u:
+                    continue
+                if self._weighted:
+                    G.add_edge_(zen_idx[u], zen_idx[v], weight=float(self._weights[pos]))
+                else:
+                    G.add_edge_(zen_idx[u], zen_idx[v])
+        return G
@@ -11,6 +11,11 @@ A geoinference dataset is stored on disk in a directory with the following forma
         dataset.json - metadata about the dataset
         posts.json.gz - all posts in the dataset in arbitrary order
         users.json.gz - all posts in the dataset grouped by user
+        users.ids.txt.gz - the user ids, in the order of the users file
+        users.index.npy - the location of each user in the users file
+        mention_network.elist - the directed network of who mentioned whom
+        bi_mention_network*.elist - the networks of users who mentioned each other
+        deltas/ - posts appended since the dataset was built (see `append_posts`)
 
 This module provides a class for managing and accessing this directory as well
 as helper functions for building new datasets.
@@ -30,6 +35,15 @@ All three core files in the dataset directory contain data in JSON format.
         These posts should have identical format and data to those in the 
         `posts.json.gz` file.  Moreover, every post present in the `posts.json` file
         must be present in `users.json` and visa versa.
+
+    `users.json.gz` is written as a block gzip file (see `block_gzip`), so that
+    individual users can be read without decompressing the whole file.  Row i
+    of the int64 array in `users.index.npy` holds the (block offset, line
+    offset) location of the user whose index in `users.ids.txt.gz` is i.
+
+The posts file keeps the codec of the file it was built from, so it may be
+`posts.json.zst` or `posts.json.lz4` instead (see `compression`).  The users
+file is always block gzip.
 """
 
 import json
@@ -37,8 +51,23 @@ import traceback
 import os, os.path
 import logging
 import zen
-import gzip
 import zlib
+import shutil
+import hashlib
+
+from array import array
+from collections import OrderedDict
+from multiprocessing import Process, Queue, cpu_count
+
+import numpy
+
+from block_gzip import BlockGzipWriter
+from compression import codec_of, find_file, open_file, temp_extension
+from csr_graph import source_signature
+from mention_edges import MENTION_NETWORK_FILES, add_run, aggregate_edges, \
+    merge_runs, read_edges, write_mention_networks
+from sparse_dataset import SparseDataset, list_deltas
+from user_ids import UserIdTable, shard_of
 
 logger = logging.getLogger(os.path.basename(__file__))
 
@@ -56,7 +85,7 @@ class Dataset(object):
             self._settings = {}
 
         # prepare for all data
-        self._posts_fname = os.path.join(dataset_dir,'posts.json.gz')
+        self._posts_fname = find_file(os.path.join(dataset_dir,'posts.json'))
 
         if users_file is None:
             self._users_fname = os.path.join(dataset_dir,'users.json.gz')
@@ -71,7 +100,7 @@ class Dataset(object):
         Return an iterator over all the posts in the dataset. The ordering
         of the posts follows the order of posts in the dataset file.
         """
-        fh = gzip.open(self._posts_fname,'r')
+        fh = open_file(self._posts_fname,'r')
 
         for line in fh:
             post = json.loads(line.decode("ascii"))
@@ -90,7 +119,7 @@ class Dataset(object):
         user is represented by a list of their posts - so any metadata about the
         user must be aggregated from the posts it produced.
         """
-        fh = gzip.open(self._users_fname,'r')
+        fh = open_file(self._users_fname,'r')
 
         for line in fh:
             user = json.loads(line)
@@ -116,8 +145,13 @@ def posts2dataset(dataset_dir,posts_fname,extract_user_id,extract_mentions,**kwa
 
     If this function completes successfully, the directory will contain the posts,
     users, and mention network files.
+
+    The users file is built by `num_workers` processes (by default, one per
+    core); see `posts2users`.  Finally, the `dataset.json` manifest is written
+    (see `write_manifest`).
     """
     force = kwargs.pop('force',False)
+    num_workers = kwargs.pop('num_workers',None)
 
     if len(kwargs) > 0:
         #raise Exception, 'unknown named argument: %s' % ','.join(kwargs.keys())
@@ -133,25 +167,230 @@ def posts2dataset(dataset_dir,posts_fname,extract_user_id,extract_mentions,**kwa
         os.mkdir(dataset_dir)
 
     # if the post_fname isn't in the dataset_dir,
-    # copy it there.
-    if os.path.dirname(posts_fname) != dataset_dir or os.path.basename(posts_fname) != 'posts.json.gz':
+    # copy it there, keeping its codec.
+    new_posts_fname = os.path.join(dataset_dir,posts_basename(posts_fname))
+    if os.path.abspath(posts_fname) != os.path.abspath(new_posts_fname):
         logger.info('copying posts file %s' % posts_fname)
-        new_posts_fname = os.path.join(dataset_dir,'posts.json.gz')
         #os.copy(posts_fname,new_posts_fname)
         os.system('cp %s %s' % (posts_fname,new_posts_fname))
         posts_fname = new_posts_fname
 
     # now make the users file
     logger.info('building the users.json.gz file')
-    posts2users(posts_fname,extract_user_id)
+    user_stats = posts2users(posts_fname,extract_user_id,num_workers=num_workers)
 
     # now make the mention network
     logger.info('building the mention network')
-    posts2mention_network(posts_fname,extract_user_id,extract_mentions)
+    networks = posts2mention_network(posts_fname,extract_user_id,extract_mentions)
+
+    logger.info('writing the dataset manifest')
+    write_manifest(dataset_dir,user_stats['num_posts'],networks)
 
     # done!
     return
 
+def posts_basename(posts_fname):
+    """
+    Returns the name of the posts file of a dataset built from `posts_fname`,
+    which is `posts.json` with the extension of the posts file's codec.
+    """
+    if codec_of(posts_fname) is None:
+        return 'posts.json'
+    return 'posts.json' + os.path.splitext(posts_fname)[1]
+
+# The number of block offsets of the users file recorded in the manifest, which
+# bounds the number of shards that can be planned from it
+MANIFEST_BLOCK_SAMPLES = 1024
+
+def write_manifest(dataset_dir,num_posts,networks=None):
+    """
+    Writes the `dataset.json` manifest that describes the dataset's files, so
+    that readers need not scan the files to learn their sizes:
+
+      - `num_users`, `num_posts` - the number of users with posts, and of posts
+      - `user_ids` - the number of ids in `users.ids.txt.gz` (which are indexed
+        from 0 to `count` - 1) and the last of them
+      - `networks` - the number of edges in each mention network edge list
+      - `files` - the size, modification time, md5 checksum and codec (see
+        `compression.codec_of`) of each file
+      - `users_blocks` - the number of blocks in `users.json.gz`, and the
+        offsets of up to `MANIFEST_BLOCK_SAMPLES` evenly-spaced blocks, along
+        with the number of users stored before each of them.  These let the
+        users file be split into shards of similar size without its index.
+
+    `networks` maps edge list names to their number of edges; the edges of
+    lists not in it are counted.
+    """
+    user_ids = UserIdTable.load(os.path.join(dataset_dir,'users.ids.txt.gz'))
+    index = numpy.load(os.path.join(dataset_dir,'users.index.npy'))
+    user_blocks = numpy.sort(index[index[:,0] >= 0][:,0])
+    blocks = numpy.unique(user_blocks)
+    samples = blocks[numpy.unique(numpy.linspace(0, len(blocks) - 1,
+        min(len(blocks), MANIFEST_BLOCK_SAMPLES)).astype(numpy.int64))]
+
+    manifest = {
+        'version': 1,
+        'num_users': len(user_blocks),
+        'num_posts': num_posts,
+        'user_ids': { 'count': len(user_ids),
+                      'last_id': user_ids.user_id(len(user_ids) - 1) if len(user_ids) > 0 else None },
+        'networks': {},
+        'files': {},
+        'users_blocks': { 'count': len(blocks),
+                          'offsets': samples.tolist(),
+                          'users_before': numpy.searchsorted(user_blocks, samples).tolist() }
+        }
+
+    for fname in MENTION_NETWORK_FILES:
+        elist_fname = os.path.join(dataset_dir,fname)
+        if networks is not None and fname in networks:
+            manifest['networks'][fname] = { 'num_edges': networks[fname] }
+        elif os.path.exists(elist_fname):
+            with open(elist_fname,'r') as fh:
+                manifest['networks'][fname] = { 'num_edges': sum(1 for line in fh) }
+
+    posts_fname = os.path.basename(find_file(os.path.join(dataset_dir,'posts.json')))
+    for fname in [posts_fname,'users.json.gz','users.ids.txt.gz','users.index.npy'] \
+            + MENTION_NETWORK_FILES:
+        full_fname = os.path.join(dataset_dir,fname)
+        if not os.path.exists(full_fname):
+            continue
+        info = source_signature(full_fname)
+        md5 = hashlib.md5()
+        with open(full_fname,'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), ''):
+                md5.update(chunk)
+        info['md5'] = md5.hexdigest()
+        info['codec'] = codec_of(fname)
+        manifest['files'][fname] = info
+
+    with open(os.path.join(dataset_dir,'dataset.json.tmp'),'w') as fh:
+        json.dump(manifest,fh,indent=1)
+    os.rename(os.path.join(dataset_dir,'dataset.json.tmp'),
+              os.path.join(dataset_dir,'dataset.json'))
+    return manifest
+
+def append_posts(dataset_dir,posts_fname,extract_user_id,extract_mentions,
+                 num_workers=None):
+    """
+    Adds the posts in the file `posts_fname` to the dataset as a new delta
+    segment in `dataset_dir/deltas/`, without rebuilding the existing files.
+    The segment holds the users file and mention network of only the new
+    posts (built with `posts2users` and `posts2mention_network`), so the cost
+    of an append grows with the number of new posts.  `SparseDataset` merges
+    the segments with the base files when reading, and `compact_dataset`
+    folds them into the base files.
+
+    Returns the directory of the new segment.
+    """
+    deltas_dir = os.path.join(dataset_dir,'deltas')
+    if not os.path.exists(deltas_dir):
+        os.mkdir(deltas_dir)
+
+    segments = list_deltas(deltas_dir)
+    if len(segments) > 0:
+        name = '%05d' % (int(os.path.basename(segments[-1])) + 1)
+    else:
+        name = '%05d' % 1
+
+    # Build the segment under a temporary name, so that readers never see a
+    # partially-written segment
+    tmp_dir = os.path.join(deltas_dir,'.tmp-' + name)
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+
+    logger.info('copying posts file %s' % posts_fname)
+    delta_posts_fname = os.path.join(tmp_dir,posts_basename(posts_fname))
+    shutil.copyfile(posts_fname,delta_posts_fname)
+
+    logger.info('building the users.json.gz file of delta %s' % name)
+    user_stats = posts2users(delta_posts_fname,extract_user_id,num_workers=num_workers)
+
+    logger.info('building the mention network of delta %s' % name)
+    networks = posts2mention_network(delta_posts_fname,extract_user_id,extract_mentions)
+    write_manifest(tmp_dir,user_stats['num_posts'],networks)
+
+    segment_dir = os.path.join(deltas_dir,name)
+    os.rename(tmp_dir,segment_dir)
+    return segment_dir
+
+def compact_dataset(dataset_dir):
+    """
+    Folds the delta segments of the dataset (see `append_posts`) into its base
+    files: the merged users are written to a new `users.json.gz` (with its
+    index), the mention networks are rebuilt from the merged edge weights, the
+    new posts are appended to `posts.json.gz`, and the segments are removed.
+    Users who were new in the segments are appended to the user id table, so
+    existing user indices remain valid.
+    """
+    ds = SparseDataset(dataset_dir)
+    deltas = ds.deltas()
+    if len(deltas) == 0:
+        logger.info('%s has no deltas to compact' % dataset_dir)
+        return
+
+    # Write the new files to a temporary directory, and only move them into
+    # place once they are complete
+    tmp_dir = os.path.join(dataset_dir,'.compact')
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+
+    logger.info('compacting %d deltas into users.json.gz' % len(deltas))
+    user_ids = ds.user_ids()
+    user_fh = BlockGzipWriter(os.path.join(tmp_dir,'users.json.gz'))
+    user_locations = {}
+    num_posts = 0
+    for user in ds.user_iter():
+        loc = user_fh.write_line(json.dumps(user))
+        user_locations[user_ids.intern(user['user_id'])] = loc
+        num_posts += len(user['posts'])
+    user_fh.close()
+
+    # Rows of users without posts (e.g., those who were only mentioned) are
+    # marked with a block offset of -1
+    index = numpy.empty((len(user_ids), 2), dtype=numpy.int64)
+    index.fill(-1)
+    for idx, loc in user_locations.iteritems():
+        index[idx] = loc
+    numpy.save(os.path.join(tmp_dir,'users.index.npy'), index)
+
+    logger.info('compacting %d deltas into the mention networks' % len(deltas))
+    runs = [read_edges(os.path.join(dataset_dir,'mention_network.elist'), user_ids)]
+    for delta in deltas:
+        runs.append(read_edges(delta.mention_network_fname, user_ids))
+    edges, weights = merge_runs(runs)
+    networks = write_mention_networks(tmp_dir, user_ids, edges, weights)
+
+    # The id table is append-only, so it can be updated in place
+    if user_ids.is_dirty():
+        user_ids.save()
+    for fname in ['users.json.gz','users.index.npy'] + MENTION_NETWORK_FILES:
+        os.rename(os.path.join(tmp_dir,fname), os.path.join(dataset_dir,fname))
+    os.rmdir(tmp_dir)
+
+    # Concatenated gzip (or zstd or lz4) files are a valid file of the same
+    # codec, so delta posts with the base file's codec are copied as-is
+    posts_fname = find_file(os.path.join(dataset_dir,'posts.json'))
+    for delta in deltas:
+        delta_posts_fname = find_file(os.path.join(delta.segment_dir,'posts.json'))
+        if codec_of(delta_posts_fname) == codec_of(posts_fname):
+            with open(posts_fname,'ab') as posts_fh:
+                with open(delta_posts_fname,'rb') as delta_fh:
+                    shutil.copyfileobj(delta_fh, posts_fh)
+        else:
+            with open_file(posts_fname,'a') as posts_fh:
+                with open_file(delta_posts_fname,'r') as delta_fh:
+                    shutil.copyfileobj(delta_fh, posts_fh)
+
+    shutil.rmtree(os.path.join(dataset_dir,'deltas'))
+    write_manifest(dataset_dir,num_posts,networks)
+
+# The number of (user, mentioned user) pairs buffered before they are merged
+# into the edge weights
+MENTIONS_CHUNK_SIZE = 1 << 22
+
 def posts2mention_network(posts_fname,extract_user_id,
                           extract_mentions,working_dir=None):
     """
@@ -165,64 +404,83 @@ def posts2mention_network(posts_fname,extract_user_id,
 
     `extract_mentions` is a function that accepts a post and returns a list of
     string user_ids mentioned in the post.
-    """
-    G = zen.DiGraph()
 
+    In the same pass, the networks of users who have mentioned each other are
+    written as well:
+
+      - `bi_mention_network.elist` - undirected and unweighted
+      - `bi_mention_network.weighted.elist` - undirected, where an edge's
+        weight is the number of times the two users mentioned each other
+      - `bi_mention_network.directed.weighted.elist` - both directions of each
+        edge, weighted by the number of times the source mentioned the target
+
+    User ids are interned into integers as the posts are read, and mentions are
+    buffered as integer arrays that are periodically merged into the weights
+    of the distinct edges, so memory grows with the number of edges rather
+    than with the number of mentions.  If the working directory has a user id
+    table (see `posts2users`), it is used and extended with any users who were
+    only mentioned.
+
+    Returns a dict from the name of each edge list to its number of edges.
+    """
     # figure out the working dir
     if not working_dir:
         working_dir = os.path.dirname(posts_fname)
 
+    user_ids_fname = os.path.join(working_dir,'users.ids.txt.gz')
+    if os.path.exists(user_ids_fname):
+        user_ids = UserIdTable.load(user_ids_fname)
+    else:
+        user_ids = UserIdTable()
+    intern = user_ids.intern
+
     # bin the user data
-    logging.info('building the network')
+    logger.info('building the network')
 
+    # The distinct edges of each chunk of mentions, encoded as
+    # (src << 32) | dst and sorted, and the number of times each was seen
+    runs = []
+    srcs = array('i')
+    dsts = array('i')
+    error_count = 0
 
-    fh = gzip.open(posts_fname,'r')
+    fh = open_file(posts_fname,'r')
     for line in fh:
         try:            
             line = line.strip().replace(r'\\"', r'\"')
             post = json.loads(line)
-            uid = extract_user_id(post)
-            mentions = extract_mentions(post)
-            print(mentions)
-            for m in mentions:
-                if G.has_edge(uid,m):
-                    G.set_weight(uid,m,G.weight(uid,m)+1)
-                else:
-                    G.add_edge(uid,m,weight=1)
+            uid = intern(extract_user_id(post))
+            for m in extract_mentions(post):
+                srcs.append(uid)
+                dsts.append(intern(m))
         except:
             print("Invalid JSON")
+            error_count += 1
             continue
 
-    zen.io.edgelist.write(G, os.path.join(working_dir, 'mention_network.elist'), use_weights=True)
-
-    BiMentionG = zen.Graph()
+        if len(srcs) >= MENTIONS_CHUNK_SIZE:
+            add_run(runs, aggregate_edges(srcs, dsts))
+            srcs = array('i')
+            dsts = array('i')
+    fh.close()
+    add_run(runs, aggregate_edges(srcs, dsts))
+    edges, weights = merge_runs(runs)
+    logger.debug('found %d edges (%d invalid posts)' % (len(edges), error_count))
 
-    potentialBiMentions = {}
-    exploredNodes = set()
-
-    for node in G.nodes_iter():
-        potentialEdges = potentialBiMentions.get(node, set())
-        for neighbor in G.neighbors(node):
-            if neighbor in potentialEdges:
-                BiMentionG.add_edge(node, neighbor)
-            elif neighbor not in exploredNodes:
-                neighborPotentialEdges = potentialBiMentions.get(neighbor, set())
-                neighborPotentialEdges.add(node)
-                potentialBiMentions[neighbor] = neighborPotentialEdges
-
-
-
-    # save the graph
+    # save the graphs
     logging.info('writing network')
-    # TODO: Add compression to this...
-    zen.io.edgelist.write(G,os.path.join(working_dir,'mention_network.elist'),use_weights=True)
-    zen.io.edgelist.write(BiMentionG, os.path.join(working_dir, 'bi_mention_network.elist'))
+    networks = write_mention_networks(working_dir, user_ids, edges, weights)
+
+    if user_ids.is_dirty() and os.path.exists(user_ids_fname):
+        user_ids.save()
     # done
-    return
+    return networks
 
+# The number of lines of the posts file handed to a worker at a time
+POSTS_CHUNK_SIZE = 10000
 
 def posts2users(posts_fname,extract_user_id,
-                working_dir=None,max_open_temp_files=256):
+                working_dir=None,max_open_temp_files=256,num_workers=None):
     """ 
     This method builds a valid `users.json.gz` file from the `posts.json.gz` file
     specified.  Unless indicated otherwise, the directory containing the posts
@@ -231,109 +489,250 @@ def posts2users(posts_fname,extract_user_id,
 
     `extract_user_id` is a function that accepts a post and returns a string
     user_id.
+
+    The build is done in parallel by `num_workers` processes (by default, one
+    per core) in three steps:
+
+      1. map: workers parse chunks of the posts file and write each post to
+         one of `max_open_temp_files` shard files, picked by hashing its user
+         id (see `shard_of`), so that all of a user's posts land in one shard.
+      2. reduce: workers group the posts of each shard by user and write them
+         out as a block gzip part of the users file.
+      3. the parts are concatenated into `users.json.gz`, and the user id
+         table and index are built from the users each part holds.
+
+    Since the workers are forked, `extract_user_id` may be any callable,
+    including a lambda.
+
+    Returns a dict with the number of users (`num_users`) and posts
+    (`num_posts`) written, and of invalid posts skipped (`num_invalid_posts`).
     """
     
     # figure out the working dir
     if not working_dir:
         working_dir = os.path.dirname(posts_fname)
+    if not num_workers:
+        num_workers = cpu_count()
+    num_shards = max_open_temp_files
+    temp_ext = temp_extension()
 
     # bin the user data
-    logger.info('binning user posts')
-
-    curr_temp_file_idx = -1
-
-    # A dict from a user-id to the file handle-id 
-    user_assignments = {}
-    # A dict from the file handle-id to the actual file handle
-    file_handles = {}
+    logger.info('binning user posts into %d shards with %d workers' 
+                % (num_shards, num_workers))
+
+    # Open the posts before forking, so that a missing file fails before
+    # there are workers waiting for its chunks
+    fh = open_file(posts_fname,'r')
+    chunks = Queue(2 * num_workers)
+    results = Queue()
+    workers = [Process(target=_bin_posts_worker,
+                       args=(w, chunks, results, extract_user_id,
+                             working_dir, num_shards, temp_ext))
+               for w in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    finished = False
+    try:
+        try:
+            chunk = []
+            for line in fh:
+                chunk.append(line)
+                if len(chunk) >= POSTS_CHUNK_SIZE:
+                    chunks.put(chunk)
+                    chunk = []
+            if len(chunk) > 0:
+                chunks.put(chunk)
+        finally:
+            fh.close()
+        finished = True
+    finally:
+        # The workers stop at the first None they receive
+        for worker in workers:
+            chunks.put(None)
+        if not finished:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+            for shard in range(num_shards):
+                for w in range(num_workers):
+                    tmp_fname = os.path.join(working_dir,'tmp-%03d-%03d.json%s'
+                                             % (shard, w, temp_ext))
+                    if os.path.exists(tmp_fname):
+                        os.remove(tmp_fname)
 
     # Sanity check methods for ensuring we're reading and writing
     # all the data.
     posts_seen = 0
-    user_posts_written = 0
     error_count = 0
-    
-    fh = gzip.open(posts_fname,'rt')
-    for line in fh:
-        try:
-            line = line.strip().replace(r'\\"', r'\"')
-            post = json.loads(line)
-            uid = extract_user_id(post)
-            posts_seen += 1
-
-            if uid not in user_assignments:
-                
-                # Get the temp file this user should be in.
-                # Assume that user-ids are randomly distribued
-                # in some range such that the last three
-                # digits of the id serve as a uniformly
-                # distributed hash
-                tmp_file_assignment = int(uid) % max_open_temp_files
-                if not tmp_file_assignment in file_handles:
-                    # Write the temp file as gzipped files
-                    # because this splitting process gets
-                    # very expensive when processing large
-                    # datasets
-                    tmp_fname = os.path.join(working_dir,'tmp-%03d.json.gz'
-                                 % tmp_file_assignment)
-                    logger.debug('creating temp file %s' % tmp_fname)
-
-                    tmp_fh = gzip.open(tmp_fname,'w')
-
-                    file_handles[tmp_file_assignment] = tmp_fh
-                user_assignments[uid] = tmp_file_assignment
-
-            file_handles[user_assignments[uid]].write(line + "\n")
-        except Exception as error:
-            print("Invalid JSON")
-            error_count += 1
-            continue
-
-    for idx,tmp_fh in file_handles.items():
-        tmp_fh.close()
+    for result in _collect_results(results, workers):
+        posts_seen += result[0]
+        error_count += result[1]
 
     # aggregate the users
     logger.info('aggregating user data')
 
-    user_fh = gzip.open(os.path.join(working_dir,'users.json.gz'),'w')
-    for i in range(max_open_temp_files):
-        try:
-            logging.debug('processing file %d' % i)
-            tmp_fname = os.path.join(working_dir,'tmp-%03d.json.gz' % i)
-            tmp_fh = gzip.open(tmp_fname,'r')
-
-            error_count = 0
-
-            # aggregate data by tweets
-            user_posts = {}
-            for line in tmp_fh:
-                try:
-                    post = json.loads(line)
-                except:
-                    print(line)
-                uid = extract_user_id(post)
-
-                if uid not in user_posts:
-                    user_posts[uid] = []
-
-                user_posts[uid].append(post)
-
-
-
-            # write out the tweets by user
-            for uid,posts in user_posts.items():
-                user_fh.write('%s\n' % json.dumps({'user_id':uid,'posts':posts}))
-                user_posts_written += len(posts)
+    shards = Queue()
+    for shard in range(num_shards):
+        shards.put(shard)
+    workers = [Process(target=_aggregate_shard_worker,
+                       args=(shards, results, working_dir, num_workers, temp_ext))
+               for w in range(num_workers)]
+    for worker in workers:
+        shards.put(None)
+        worker.start()
+    for result in _collect_results(results, workers):
+        pass
+
+    # Concatenate the parts, interning the user ids in the same order as
+    # they appear in the users file and shifting each user's location by the
+    # offset at which their part starts
+    logger.info('writing users.json.gz')
+    user_ids = UserIdTable()
+    user_locations = []
+    user_posts_written = 0
+    user_fh = open(os.path.join(working_dir,'users.json.gz'),'wb')
+    for shard in range(num_shards):
+        part_fname = os.path.join(working_dir,'users-%03d.json.gz.part' % shard)
+        ids_fname = os.path.join(working_dir,'users-%03d.ids.part' % shard)
+        if not os.path.exists(part_fname):
+            # no user was hashed to this shard
+            continue
 
-            # delete the temporary file
-            tmp_fh.close();
-            os.remove(tmp_fname)
-        except Exception as error:
-            traceback.print_exc()
-            break
+        part_offset = user_fh.tell()
+        with open(part_fname,'rb') as part_fh:
+            shutil.copyfileobj(part_fh, user_fh)
+        with open(ids_fname,'r') as ids_fh:
+            for line in ids_fh:
+                uid, block_offset, line_offset, num_posts = json.loads(line)
+                user_ids.intern(uid)
+                user_locations.append((part_offset + block_offset, line_offset))
+                user_posts_written += num_posts
+        os.remove(part_fname)
+        os.remove(ids_fname)
 
     # done
     user_fh.close()
-    logger.debug("Read %s posts, wrote %s posts to users.json.gz" 
-            % (posts_seen, user_posts_written))
-
+    user_ids.save(os.path.join(working_dir,'users.ids.txt.gz'))
+    numpy.save(os.path.join(working_dir,'users.index.npy'),
+               numpy.array(user_locations, dtype=numpy.int64).reshape(-1, 2))
+    logger.debug("Read %s posts (%d invalid), wrote %s posts to users.json.gz" 
+            % (posts_seen, error_count, user_posts_written))
+    return { 'num_users': len(user_locations), 'num_posts': user_posts_written,
+             'num_invalid_posts': error_count }
+
+def _collect_results(results, workers):
+    """
+    Returns the results reported by the workers once all have finished,
+    raising an exception if any of them failed.
+    """
+    collected = []
+    failed = False
+    for worker in workers:
+        result = results.get()
+        if result is None:
+            failed = True
+        else:
+            collected.append(result)
+    for worker in workers:
+        worker.join()
+    if failed:
+        raise Exception('a worker failed while building users.json.gz')
+    return collected
+
+def _bin_posts_worker(worker_id, chunks, results, extract_user_id,
+                      working_dir, num_shards, temp_ext):
+    """
+    Writes the posts in each chunk of lines to the shard file of their user,
+    until a None chunk is received.  Each line is written prefixed by its
+    JSON-encoded user id so that the posts need not be parsed again when the
+    shards are aggregated.  The shard files are compressed with the codec of
+    `temp_ext`, at its fastest level.
+    """
+    try:
+        file_handles = {}
+        posts_seen = 0
+        error_count = 0
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            for line in chunk:
+                try:
+                    line = line.strip().replace(r'\\"', r'\"')
+                    post = json.loads(line)
+                    uid = extract_user_id(post)
+                except Exception as error:
+                    print("Invalid JSON")
+                    error_count += 1
+                    continue
+                posts_seen += 1
+
+                shard = shard_of(uid, num_shards)
+                if not shard in file_handles:
+                    # Write the temp file as compressed files
+                    # because this splitting process gets
+                    # very expensive when processing large
+                    # datasets
+                    tmp_fname = os.path.join(working_dir,'tmp-%03d-%03d.json%s'
+                                             % (shard, worker_id, temp_ext))
+                    file_handles[shard] = open_file(tmp_fname,'w',threads=0,level=1)
+                file_handles[shard].write('%s\t%s\n' % (json.dumps(uid), line))
+
+        for tmp_fh in file_handles.values():
+            tmp_fh.close()
+        results.put((posts_seen, error_count))
+    except:
+        traceback.print_exc()
+        results.put(None)
+        # Keep consuming chunks so that the reader is not blocked
+        while chunks.get() is not None:
+            pass
+
+def _aggregate_shard_worker(shards, results, working_dir, num_map_workers, temp_ext):
+    """
+    Groups the posts in each shard by user, until a None shard is received.
+    A shard's users are written to a block gzip part file, and each user's id,
+    location in the part and number of posts are written to an ids file.
+    """
+    try:
+        while True:
+            shard = shards.get()
+            if shard is None:
+                break
+
+            # aggregate data by user, keeping the users in the order in which
+            # they were first seen.  The posts are kept as raw JSON.
+            user_posts = OrderedDict()
+            for w in range(num_map_workers):
+                tmp_fname = os.path.join(working_dir,'tmp-%03d-%03d.json%s'
+                                         % (shard, w, temp_ext))
+                if not os.path.exists(tmp_fname):
+                    continue
+                tmp_fh = open_file(tmp_fname,'r',threads=0)
+                for line in tmp_fh:
+                    uid, post = line.rstrip('\n').split('\t', 1)
+                    if uid not in user_posts:
+                        user_posts[uid] = []
+                    user_posts[uid].append(post)
+                tmp_fh.close()
+                os.remove(tmp_fname)
+
+            if len(user_posts) == 0:
+                continue
+
+            # write out the posts by user
+            part_fname = os.path.join(working_dir,'users-%03d.json.gz.part' % shard)
+            ids_fname = os.path.join(working_dir,'users-%03d.ids.part' % shard)
+            part_fh = BlockGzipWriter(part_fname)
+            ids_fh = open(ids_fname,'w')
+            for uid,posts in user_posts.iteritems():
+                loc = part_fh.write_line('{"user_id": %s, "posts": [%s]}'
+                                         % (uid, ', '.join(posts)))
+                ids_fh.write('%s\n' % json.dumps([json.loads(uid), loc[0], loc[1], len(posts)]))
+            part_fh.close()
+            ids_fh.close()
+        results.put(())
+    except:
+        traceback.print_exc()
+        results.put(None)
@@ -0,0 +1,614 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+The settlement tables behind the `Geocoder`.  Every name in a gazetteer is
+interned once in a table of names, and the locations, the flags marking which
+names have a location or are cities, and the reverse-geocoding entries (each
+with the ids of its settlement's name, region and country) are kept in
+arrays indexed by those ids.  `SettlementTableBuilder` builds an
+`InternedSettlementTable` as a gazetteer is parsed, and `NameTable`,
+`CellIndex` and `CityNames` are the dict- and set-like views of a table that
+stand in for the `Geocoder`'s original dictionaries.
+
+Parsing a gazetteer takes a long time for the larger sources, and every method
+that geocodes does so again in each process, so `geoinf build_gazetteer` also
+compiles each source once into a directory of arrays:
+
+    geolocate/resources/gazetteer/<source>/
+        meta.json - the size and modification time of the source file, along
+                    with the number of names, reverse-geocoding entries and
+                    cells
+        names.npy - uint8 array of the utf-8 bytes of every name, in sorted
+                    order, where name i is names[name_offsets[i]:name_offsets[i+1]]
+        name_offsets.npy - int64 array of length n+1
+        name_prefixes.npy - uint64 array of the first eight bytes of each name
+                            (big-endian, zero-padded), which narrows a lookup
+                            to a handful of names with a single searchsorted
+        name_lats.npy, name_lons.npy - float64 arrays of the location of each
+                                       name
+        name_flags.npy - uint8 array marking which names have a location
+                         (HAS_LOCATION) and which are city names (IS_CITY)
+        cell_keys.npy - int64 array of the sorted keys of the 0.01-degree cells
+                        of the reverse geocoder (see `cell_key`)
+        cell_offsets.npy - int64 array of length c+1, such that the entries of
+                           cell j are entries[cell_offsets[j]:cell_offsets[j+1]]
+        entry_lats.npy, entry_lons.npy, entry_names.npy - the location and
+                           name id of each reverse-geocoding entry, in the
+                           order they were added to their cell
+        entry_regions.npy, entry_countries.npy - int32 arrays of the line
+                           numbers of each entry's region and country in
+                           regions.txt and countries.txt
+
+The `.npy` files are memory-mapped on load by `MappedSettlementTable`, so a
+compiled gazetteer opens in milliseconds and its pages are shared by all of
+the processes that use it.
+
+`SettlementIndex` is the spatial index of the reverse-geocoding entries of a
+table that finds the nearest settlement to each of an array of points.
+"""
+
+import os, os.path
+import json
+import logging
+import shutil
+import struct
+import sys
+from array import array
+
+import numpy
+from scipy.spatial import cKDTree
+
+from csr_graph import source_signature
+from geodesy import EARTH_RADIUS_KM
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# Bump this whenever the on-disk layout changes so that stale gazetteers get
+# rebuilt
+GAZETTEER_FORMAT_VERSION = 2
+
+# The bits of name_flags
+HAS_LOCATION = 1
+IS_CITY = 2
+
+# The number of cells spanned by each 0.01 degrees of latitude in a cell key,
+# which is larger than the number of 0.01 degree longitude cells
+CELL_SPAN = 100000
+
+def cell_key(rounded_lat, rounded_lon):
+    """
+    Returns the integer key of the reverse geocoder cell with the rounded
+    (lat, lon) coordinates.
+    """
+    return int(round(rounded_lat * 100)) * CELL_SPAN + int(round(rounded_lon * 100))
+
+def _encode(name):
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+def _prefix(name):
+    return struct.unpack('>Q', name[:8].ljust(8, '\0'))[0]
+
+def is_gazetteer_current(gazetteer_dir, source_fname):
+    """
+    Returns True if the gazetteer in `gazetteer_dir` was compiled from the
+    current version of the source file.  A gazetteer whose source file is not
+    present (e.g., one that was copied to another machine on its own) is
+    assumed to be current.
+    """
+    meta_fname = os.path.join(gazetteer_dir, 'meta.json')
+    if not os.path.exists(meta_fname):
+        return False
+    with open(meta_fname, 'r') as fh:
+        meta = json.load(fh)
+    if meta.get('version') != GAZETTEER_FORMAT_VERSION:
+        return False
+    if os.path.exists(source_fname):
+        return meta.get('source') == source_signature(source_fname)
+    return True
+
+def write_gazetteer(gazetteer_dir, table, source_fname=None):
+    """
+    Compiles the `InternedSettlementTable` of a parsed gazetteer into
+    `gazetteer_dir`, and returns its metadata.
+    """
+    names = [_encode(name) for name in table.names]
+    order = sorted(xrange(len(names)), key=names.__getitem__)
+    names = [names[i] for i in order]
+    # The ids of the names in the sorted table
+    sorted_ids = numpy.empty(len(order), dtype=numpy.int32)
+    sorted_ids[order] = numpy.arange(len(order), dtype=numpy.int32)
+
+    n = len(names)
+    offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+    if n > 0:
+        offsets[1:] = numpy.cumsum([len(name) for name in names])
+    prefixes = numpy.array([_prefix(name) for name in names], dtype=numpy.uint64)
+
+    # Write into a fresh directory and then swap it in place so that readers
+    # never see a half-written gazetteer
+    tmp_dir = gazetteer_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    save = lambda fname, a: numpy.save(os.path.join(tmp_dir, fname), a)
+    save('names.npy', numpy.frombuffer(''.join(names), dtype=numpy.uint8))
+    save('name_offsets.npy', offsets)
+    save('name_prefixes.npy', prefixes)
+    save('name_lats.npy', table.lats[order])
+    save('name_lons.npy', table.lons[order])
+    save('name_flags.npy', table.flags[order])
+    save('cell_keys.npy', table.cell_keys)
+    save('cell_offsets.npy', table.cell_offsets)
+    save('entry_lats.npy', table.entry_lats)
+    save('entry_lons.npy', table.entry_lons)
+    save('entry_names.npy', sorted_ids[table.entry_names])
+    save('entry_regions.npy', table.entry_regions)
+    save('entry_countries.npy', table.entry_countries)
+    for fname, values in [('regions.txt', table.regions), ('countries.txt', table.countries)]:
+        with open(os.path.join(tmp_dir, fname), 'w') as fh:
+            for value in values:
+                fh.write('%s\n' % _encode(value))
+
+    meta = { 'version': GAZETTEER_FORMAT_VERSION,
+             'source': source_signature(source_fname) if source_fname else None,
+             'num_names': n,
+             'num_locations': table.num_locations,
+             'num_entries': len(table.entry_names),
+             'num_cells': len(table.cell_keys) }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+
+    if os.path.exists(gazetteer_dir):
+        shutil.rmtree(gazetteer_dir)
+    os.rename(tmp_dir, gazetteer_dir)
+
+    logger.info('wrote gazetteer with %d names and %d cells to %s'
+                % (n, len(table.cell_keys), gazetteer_dir))
+    return meta
+
+
+class SettlementTableBuilder(object):
+    """
+    Collects the names, locations and reverse-geocoding entries of a
+    gazetteer as it is parsed, interning each name, region and country once.
+    The methods mirror the ways the `Geocoder` used to fill its dictionaries:
+    `add_name` sets the location of a name (the last location set wins),
+    `add_city` marks a name as a city, and `add_entry` adds a settlement to
+    the reverse geocoder.
+    """
+
+    def __init__(self):
+        self.name_ids = {}
+        self.names = []
+        self.lats = array('d')
+        self.lons = array('d')
+        self.flags = array('B')
+        self.num_locations = 0
+        self.region_ids = {}
+        self.regions = []
+        self.country_ids = {}
+        self.countries = []
+        self.entry_keys = array('l')
+        self.entry_lats = array('d')
+        self.entry_lons = array('d')
+        self.entry_names = array('i')
+        self.entry_regions = array('i')
+        self.entry_countries = array('i')
+
+    def name_id(self, name):
+        """
+        Returns the id of the name, interning it if it is new.
+        """
+        i = self.name_ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.name_ids[name] = i
+            self.names.append(name)
+            self.lats.append(0.0)
+            self.lons.append(0.0)
+            self.flags.append(0)
+        return i
+
+    def add_name(self, name, lat, lon):
+        i = self.name_id(name)
+        self.lats[i] = lat
+        self.lons[i] = lon
+        if not self.flags[i] & HAS_LOCATION:
+            self.flags[i] |= HAS_LOCATION
+            self.num_locations += 1
+
+    def add_city(self, name):
+        i = self.name_id(name)
+        self.flags[i] |= IS_CITY
+
+    def add_entry(self, lat, lon, name, region='', country=''):
+        region_id = self.region_ids.get(region)
+        if region_id is None:
+            region_id = self.region_ids[region] = len(self.regions)
+            self.regions.append(region)
+        country_id = self.country_ids.get(country)
+        if country_id is None:
+            country_id = self.country_ids[country] = len(self.countries)
+            self.countries.append(country)
+
+        self.entry_keys.append(cell_key(round(lat, 2), round(lon, 2)))
+        self.entry_lats.append(lat)
+        self.entry_lons.append(lon)
+        self.entry_names.append(self.name_id(name))
+        self.entry_regions.append(region_id)
+        self.entry_countries.append(country_id)
+
+    def build(self):
+        """
+        Returns the `InternedSettlementTable` of everything added so far.
+        """
+        return InternedSettlementTable(self)
+
+
+class SettlementTable(object):
+    """
+    The arrays of a gazetteer, indexed by name id (`lats`, `lons`, `flags`)
+    and by entry (`entry_lats`, `entry_lons`, `entry_names`, `entry_regions`,
+    `entry_countries`), with the entries laid out cell by cell according to
+    `cell_keys` and `cell_offsets`.  Subclasses provide `name(i)` and
+    `index(name)`, which is -1 for names not in the table.
+    """
+
+    def __len__(self):
+        return len(self.lats)
+
+    def entry_name(self, j):
+        return self.name(self.entry_names[j])
+
+    def entry_region(self, j):
+        return self.regions[self.entry_regions[j]]
+
+    def entry_country(self, j):
+        return self.countries[self.entry_countries[j]]
+
+    def arrays(self):
+        return [self.lats, self.lons, self.flags, self.cell_keys, self.cell_offsets,
+                self.entry_lats, self.entry_lons, self.entry_names,
+                self.entry_regions, self.entry_countries]
+
+
+class InternedSettlementTable(SettlementTable):
+    """
+    The table of a parsed gazetteer, held in memory, whose names are looked
+    up in a dict from each name to its id.
+    """
+
+    def __init__(self, builder):
+        self.name_ids = builder.name_ids
+        self.names = builder.names
+        self.num_locations = builder.num_locations
+        self.lats = numpy.frombuffer(builder.lats, dtype=numpy.float64).copy()
+        self.lons = numpy.frombuffer(builder.lons, dtype=numpy.float64).copy()
+        self.flags = numpy.frombuffer(builder.flags, dtype=numpy.uint8).copy()
+        self.regions = builder.regions
+        self.countries = builder.countries
+
+        # Lay the entries out cell by cell, keeping the order within each
+        # cell since the reverse geocoder breaks distance ties by taking the
+        # first
+        entry_keys = numpy.array(builder.entry_keys, dtype=numpy.int64)
+        order = numpy.argsort(entry_keys, kind='mergesort')
+        self.cell_keys, counts = numpy.unique(entry_keys, return_counts=True)
+        self.cell_offsets = numpy.zeros(len(self.cell_keys) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=self.cell_offsets[1:])
+        self.entry_lats = numpy.array(builder.entry_lats, dtype=numpy.float64)[order]
+        self.entry_lons = numpy.array(builder.entry_lons, dtype=numpy.float64)[order]
+        self.entry_names = numpy.array(builder.entry_names, dtype=numpy.int32)[order]
+        self.entry_regions = numpy.array(builder.entry_regions, dtype=numpy.int32)[order]
+        self.entry_countries = numpy.array(builder.entry_countries, dtype=numpy.int32)[order]
+
+    def name(self, i):
+        return self.names[i]
+
+    def index(self, name):
+        try:
+            return self.name_ids.get(name, -1)
+        except TypeError:
+            return -1
+
+    def name_bytes(self):
+        return sum(sys.getsizeof(name) for name in self.names)
+
+
+class MappedSettlementTable(SettlementTable):
+    """
+    The memory-mapped table of a compiled gazetteer, whose names are looked
+    up with a binary search of the sorted names.
+    """
+
+    def __init__(self, gazetteer_dir):
+        with open(os.path.join(gazetteer_dir, 'meta.json'), 'r') as fh:
+            self.meta = json.load(fh)
+        self.num_locations = self.meta['num_locations']
+
+        load = lambda name: numpy.load(os.path.join(gazetteer_dir, name), mmap_mode='r')
+        self.data = load('names.npy')
+        self.offsets = load('name_offsets.npy')
+        self.prefixes = load('name_prefixes.npy')
+        self.lats = load('name_lats.npy')
+        self.lons = load('name_lons.npy')
+        self.flags = load('name_flags.npy')
+        self.cell_keys = load('cell_keys.npy')
+        self.cell_offsets = load('cell_offsets.npy')
+        self.entry_lats = load('entry_lats.npy')
+        self.entry_lons = load('entry_lons.npy')
+        self.entry_names = load('entry_names.npy')
+        self.entry_regions = load('entry_regions.npy')
+        self.entry_countries = load('entry_countries.npy')
+
+        with open(os.path.join(gazetteer_dir, 'regions.txt'), 'r') as fh:
+            self.regions = [line.rstrip('\n') for line in fh]
+        with open(os.path.join(gazetteer_dir, 'countries.txt'), 'r') as fh:
+            self.countries = [line.rstrip('\n') for line in fh]
+
+    def name(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tostring()
+
+    def index(self, name):
+        """
+        Returns the index of the name in the sorted name table, or -1 if the
+        name is not in the table.
+        """
+        if not isinstance(name, basestring):
+            return -1
+        name = _encode(name)
+        prefix = numpy.uint64(_prefix(name))
+        lo = int(self.prefixes.searchsorted(prefix, 'left'))
+        hi = int(self.prefixes.searchsorted(prefix, 'right'))
+        # Names sharing the first eight bytes are still sorted, so finish with
+        # a binary search over the full names
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.name(lo) == name:
+            return lo
+        return -1
+
+    def name_bytes(self):
+        # The size the names would have as str objects
+        return sys.getsizeof('') * len(self) + int(self.offsets[-1])
+
+    def arrays(self):
+        return SettlementTable.arrays(self) + [self.data, self.offsets, self.prefixes]
+
+
+def memory_report(table):
+    """
+    Returns a dict with the number of bytes used by the settlement table,
+    split into the bytes on the heap of each process and the bytes of the
+    arrays (which are shared between processes when memory-mapped), and an
+    estimate of the bytes that the Geocoder's original dictionaries (names
+    and lower-cased names to (lat, lon) tuples, rounded cells to lists of
+    (lat, lon, name) tuples, and the set of city names) would use for the
+    same gazetteer.
+    """
+    n = len(table)
+    num_locations = table.num_locations
+    num_cities = int(numpy.count_nonzero(table.flags[:] & IS_CITY))
+    num_entries = len(table.entry_names)
+    num_cells = len(table.cell_keys)
+    name_bytes = table.name_bytes()
+    float_bytes = sys.getsizeof(0.0)
+    pair_bytes = sys.getsizeof((0.0, 0.0)) + 2 * float_bytes
+    dict_bytes = lambda size: sys.getsizeof(dict.fromkeys(xrange(size)))
+
+    array_bytes = sum(a.nbytes for a in table.arrays())
+    strings = sum(sys.getsizeof(v) for v in table.regions + table.countries)
+    if isinstance(table, InternedSettlementTable):
+        heap = name_bytes + dict_bytes(n) + sys.getsizeof(table.names) + strings + array_bytes
+        mapped = 0
+    else:
+        heap = strings
+        mapped = array_bytes
+
+    # The names are shared by the original dictionaries, except for the
+    # lower-cased copies, and are all in the name-to-location dict
+    dicts = {
+        'names': dict_bytes(num_locations) + num_locations * pair_bytes + name_bytes,
+        'lc_names': dict_bytes(num_locations) + name_bytes,
+        'cells': dict_bytes(num_cells) + num_cells * (pair_bytes + sys.getsizeof([]))
+                 + num_entries * (8 + sys.getsizeof((0.0, 0.0, '')) + 2 * float_bytes),
+        'cities': sys.getsizeof(set(xrange(num_cities))),
+    }
+    return { 'names': n, 'entries': num_entries, 'heap': heap, 'mapped': mapped,
+             'dicts': sum(dicts.itervalues()), 'dict_parts': dicts }
+
+
+class NameTable(object):
+    """
+    A read-only mapping from each name in a settlement table to its
+    (lat, lon) location, in place of the `Geocoder.geocoder` dict.
+    """
+
+    def __init__(self, table):
+        self._table = table
+
+    def _location(self, name):
+        i = self._table.index(name)
+        if i < 0 or not self._table.flags[i] & HAS_LOCATION:
+            return None
+        return (float(self._table.lats[i]), float(self._table.lons[i]))
+
+    def __len__(self):
+        return self._table.num_locations
+
+    def __contains__(self, name):
+        return self._location(name) is not None
+
+    def __getitem__(self, name):
+        location = self._location(name)
+        if location is None:
+            raise KeyError(name)
+        return location
+
+    def get(self, name, default=None):
+        location = self._location(name)
+        if location is None:
+            return default
+        return location
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        for name, location in self.iteritems():
+            yield name
+
+    def iteritems(self):
+        table = self._table
+        for i in numpy.flatnonzero(table.flags[:] & HAS_LOCATION):
+            yield table.name(i), (float(table.lats[i]), float(table.lons[i]))
+
+
+class CellIndex(object):
+    """
+    A read-only mapping from each rounded (lat, lon) cell of a settlement
+    table to its list of (lat, lon, name) entries, in place of the
+    `Geocoder.reverse_geocoder` dict.  Like the defaultdict it replaces, a
+    cell without any entries maps to an empty list.
+    """
+
+    def __init__(self, table):
+        self._table = table
+
+    def __len__(self):
+        return len(self._table.cell_keys)
+
+    def __getitem__(self, rounded_lat_lon):
+        table = self._table
+        key = cell_key(rounded_lat_lon[0], rounded_lat_lon[1])
+        j = int(table.cell_keys.searchsorted(key))
+        if j == len(table.cell_keys) or table.cell_keys[j] != key:
+            return []
+        start = table.cell_offsets[j]
+        end = table.cell_offsets[j+1]
+        return [(float(lat), float(lon), table.name(i)) for lat, lon, i in
+                zip(table.entry_lats[start:end], table.entry_lons[start:end],
+                    table.entry_names[start:end])]
+
+    def settlement_index(self):
+        """
+        Returns the `SettlementIndex` of all of the entries.
+        """
+        table = self._table
+        return SettlementIndex(table.entry_lats, table.entry_lons, table.entry_name)
+
+
+class CityNames(object):
+    """
+    A read-only set of the city names of a settlement table, in place of
+    the `Geocoder.all_city_names` set.
+    """
+
+    def __init__(self, table):
+        self._table = table
+
+    def _indices(self):
+        return numpy.flatnonzero(self._table.flags[:] & IS_CITY)
+
+    def __len__(self):
+        return len(self._indices())
+
+    def __contains__(self, name):
+        i = self._table.index(name)
+        return i >= 0 and bool(self._table.flags[i] & IS_CITY)
+
+    def __iter__(self):
+        for i in self._indices():
+            yield self._table.name(i)
+
+
+def unit_vectors(lats, lons):
+    """
+    Returns the (n, 3) array of the points on the unit sphere at the
+    latitudes and longitudes, so that the Euclidean distance between two
+    points orders them the same way as their great-circle distance.
+    """
+    lats = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+    lons = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+    cos_lats = numpy.cos(lats)
+    return numpy.column_stack((cos_lats * numpy.cos(lons),
+                               cos_lats * numpy.sin(lons),
+                               numpy.sin(lats)))
+
+
+class SettlementIndex(object):
+    """
+    A KD-tree over the reverse-geocoding entries of a gazetteer, which finds
+    the nearest settlement (by great-circle distance) to each point within a
+    maximum distance.  Entries with the same coordinates as an earlier entry
+    are dropped, so the earliest one wins, as it does in the reverse
+    geocoder's cells.  Settlements are numbered by their position in the
+    index, and `name(i)` returns the name of settlement i.
+    """
+
+    def __init__(self, lats, lons, name_of):
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        if len(lats) > 0:
+            first = numpy.unique(numpy.column_stack((lats, lons)), axis=0,
+                                 return_index=True)[1]
+            first.sort()
+        else:
+            first = numpy.zeros(0, dtype=numpy.int64)
+
+        self._entries = first
+        self._name_of = name_of
+        self.lats = lats[first]
+        self.lons = lons[first]
+        self._tree = cKDTree(unit_vectors(self.lats, self.lons)) if len(first) > 0 else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def name(self, i):
+        return self._name_of(self._entries[i])
+
+    def nearest(self, lats, lons, max_distance):
+        """
+        Returns the arrays of the index of the nearest settlement to each
+        point, or -1 if there is none within max_distance kilometers, and of
+        the great-circle distance to it, or infinity.
+        """
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        nearest = numpy.empty(len(lats), dtype=numpy.int64)
+        nearest.fill(-1)
+        distances = numpy.empty(len(lats), dtype=numpy.float64)
+        distances.fill(numpy.inf)
+
+        valid = numpy.isfinite(lats) & numpy.isfinite(lons)
+        if self._tree is None or not valid.any():
+            return nearest, distances
+
+        # The chord between two points on the unit sphere that are
+        # max_distance apart, with a little slack for rounding
+        angle = min(max_distance / EARTH_RADIUS_KM, numpy.pi)
+        bound = 2 * numpy.sin(angle / 2) * (1 + 1e-9)
+        chords, indices = self._tree.query(unit_vectors(lats[valid], lons[valid]),
+                                           k=1, distance_upper_bound=bound)
+        found = indices < len(self)
+        km = numpy.empty(len(chords), dtype=numpy.float64)
+        km.fill(numpy.inf)
+        km[found] = 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.minimum(chords[found] / 2, 1.0))
+        found &= km <= max_distance
+
+        points = numpy.flatnonzero(valid)
+        nearest[points[found]] = indices[found]
+        distances[points[found]] = km[found]
+        return nearest, distances
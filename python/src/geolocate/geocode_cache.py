@@ -0,0 +1,125 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+A cache of the results of noisy geocoding.  The location fields of social
+media profiles repeat heavily ("London", "NYC", "Los Angeles, CA"), so each
+geocoder keeps a bounded, least-recently-used cache from the normalized name to
+its (lat, lon), or None if it could not be geocoded.  A cache may also be
+backed by a file, `<name>.json.gz` (or any other codec supported by
+`compression`), with one JSON [name, result] pair per line: every result in
+the file is reused, and newly geocoded names are appended to it so that later
+runs can reuse them too.
+"""
+
+import os, os.path
+import json
+import logging
+from collections import OrderedDict
+
+from compression import open_file
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# The default number of names kept in memory by a cache
+DEFAULT_CACHE_SIZE = 100000
+
+# Returned by GeocodeCache.get for names that are not in the cache, since None
+# is a valid result
+MISSING = object()
+
+class GeocodeCache(object):
+    """
+    A bounded LRU cache of geocoding results, optionally backed by a file.
+    The number of lookups that were and were not found in the cache are kept
+    in `hits` and `misses`.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, fname=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._stored = {}
+        self._fh = None
+
+        if fname is not None:
+            if os.path.exists(fname):
+                self._stored = load_cache_file(fname)
+                logger.debug('loaded %d cached results from %s' % (len(self._stored), fname))
+            self._fh = open_file(fname, 'a')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, default=MISSING):
+        """
+        Returns the cached result for the name, or `default` if the name is
+        not cached.
+        """
+        result = self._entries.pop(name, MISSING)
+        if result is not MISSING:
+            # Move the name to the most recently used end
+            self._entries[name] = result
+        else:
+            result = self._stored.get(name, MISSING)
+
+        if result is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return result
+
+    def put(self, name, result):
+        """
+        Caches the result for the name, evicting the least recently used name
+        if the cache is full, and appending it to the cache's file if it has
+        one.
+        """
+        self._entries[name] = result
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        if self._fh is not None and not name in self._stored:
+            self._stored[name] = result
+            self._fh.write(json.dumps([name, result]) + '\n')
+
+    def close(self):
+        """
+        Closes the cache's file, if any.
+        """
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def stats(self):
+        """
+        Returns a dict of the hit and miss counts and the size of the cache.
+        """
+        return { 'hits': self.hits, 'misses': self.misses,
+                 'size': len(self._entries), 'stored': len(self._stored) }
+
+
+def load_cache_file(fname):
+    """
+    Returns the dict of the results stored in the cache file.  A file whose
+    last line was cut off (e.g., by a run that was killed) is read up to that
+    line.
+    """
+    results = {}
+    fh = open_file(fname, 'r')
+    try:
+        for line in fh:
+            try:
+                name, result = json.loads(line)
+            except ValueError:
+                break
+            results[name] = tuple(result) if result is not None else None
+    except (IOError, EOFError):
+        logger.warning('%s was not completely written; using the first %d results'
+                       % (fname, len(results)))
+    fh.close()
+    return results
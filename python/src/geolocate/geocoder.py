@@ -12,29 +12,105 @@ Allows for multiple dataset inputs
 import os, os.path
 import csv
 import re
-from collections import defaultdict
-from geopy.distance import vincenty
 import collections
 import logging
 import gzip
 
+import numpy
+
+from gazetteer import CellIndex, CityNames, MappedSettlementTable, NameTable, \
+    SettlementTableBuilder, is_gazetteer_current, memory_report, write_gazetteer
+from geocode_cache import DEFAULT_CACHE_SIZE, MISSING, GeocodeCache
+
 LOGGER = logging.getLogger(os.path.basename(__file__))
 
+# The default maximum distance, in kilometers, from a point to the settlement
+# that it is reverse geocoded to.  This is the diagonal of a 0.01-degree cell
+# at the equator, the farthest apart that a point and a settlement in the
+# same cell of the original reverse-geocoding grid could be, so that points
+# are not snapped to settlements further away than they used to be.
+REVERSE_GEOCODE_MAX_KM = 1.57
+
+# The patterns used to clean up noisy location names
+USA_REGEX = re.compile("\\bUSA\\b")
+US_REGEX = re.compile("\\bUS\\b")
+UK_REGEX = re.compile("\\bUK\\b")
+LEADING_CRUFT_REGEX = re.compile(ur'^[\W+]+')
+TRAILING_CRUFT_REGEX = re.compile(ur'[\W+]+$')
+DELIMITER_REGEX = re.compile(r'[,\-|]+')
+WHITESPACE_REGEX = re.compile(r'[ \t\n\r]+')
+SAINT_ABBV_REGEX = re.compile("st.")
+SAINT_REGEX = re.compile("saint")
+
+# The most tokens in a place name that find_mentions will match
+MAX_MENTION_TOKENS = 3
+
+# The order in which the ways of joining the tokens of a mention with spaces
+# and tabs are tried, by the number of tokens
+MENTION_SEPARATORS = {
+    1: [()],
+    2: [("\t",), (" ",)],
+    3: [(" ", " "), (" ", "\t"), ("\t", "\t"), ("\t", " ")],
+}
+
+TOKEN_REGEX = re.compile(r'\S+', re.UNICODE)
+NAME_SEPARATOR_REGEX = re.compile(r'([ \t])')
+
+RESOURCES_DIR = "geolocate/resources"
+
+# The source file of each gazetteer, relative to the resources directory
+GAZETTEER_SOURCES = {
+    "geolite": "geolite.csv",
+    "google": "google-formatted.tsv",
+    "dbpedia": "dbpedia.settlement-to-locations.localized.cleaned.uniq.tsv",
+    "geonames": "geonames.exanded-cities.tsv.gz",
+}
+
 class Geocoder(object):
 
     """
     Geocoder to be used on the Geolocation Inference Project.
     """
-    def __init__(self,dataset="geonames"):
+    def __init__(self,dataset="geonames",use_gazetteer=True,
+                 noisy_cache_size=DEFAULT_CACHE_SIZE,noisy_cache_fname=None):
         """
         Initializes the "reverse_geocoder" and "geocoder" dictionaries,
         based on the dataset selected. By default "geonames" is selected,
+        If the dataset has been compiled with build_gazetteer and
+        use_gazetteer is True, the dictionaries are memory-mapped from the
+        compiled gazetteer instead of being built from the dataset.
+        The results of geocode_noisy are cached for up to noisy_cache_size
+        names, and also stored in noisy_cache_fname, if provided.
         """
-        self.reverse_geocoder = defaultdict(list)
-        self.geocoder = {}
         self.abbv_to_state = state_abbv_data()
         self.state_abbv_regex = re.compile(r'(\b' + (r'\b|\b'.join(self.abbv_to_state.keys())) + r'\b)')
-        self.all_city_names = set()
+        self.settlements = None
+        self.mentions = None
+        self.noisy_cache = GeocodeCache(noisy_cache_size, noisy_cache_fname)
+
+        gazetteer_dir = gazetteer_path(dataset)
+        if use_gazetteer and is_gazetteer_current(gazetteer_dir, gazetteer_source(dataset)):
+            self.table = MappedSettlementTable(gazetteer_dir)
+            LOGGER.debug("Geocoder mapped %d locations from %s" %
+                         (self.table.num_locations, gazetteer_dir))
+        else:
+            self.table = self.__build_table(dataset)
+
+        self.geocoder = NameTable(self.table)
+        # All of the names are already lower case, so the noisy lookups can
+        # share the same table
+        self.lc_name_to_location = self.geocoder
+        self.reverse_geocoder = CellIndex(self.table)
+        self.all_city_names = CityNames(self.table)
+
+        LOGGER.debug("Geocoder loaded %d locations from %s" %
+                     (len(self.geocoder), dataset))
+
+    def __build_table(self, dataset):
+        """
+        Parses the dataset into an InternedSettlementTable.
+        """
+        table = SettlementTableBuilder()
 
         LOGGER.debug("Geocoder loading city-location mapping from %s" % (dataset))
 
@@ -62,42 +138,38 @@ class Geocoder(object):
                 city_name_counts[city_name] += 1
 
 
-                #sets bins of 0.01 accuracy of lat/lon for reverse_geocoding
-                rounded_lat = round(lat,2)
-                rounded_lon = round(lon,2)
-
                 #builds the geocoder dictionary based on a city\tregion\tcountry format
                 if city_name and region_name and country_name:
                     city_region_country = city_name+"\t"+region_name+"\t"+country_name
                     city_region = city_name+"\t"+region_name
                     city_country = city_name+"\t"+country_name
-                    self.geocoder[city_region_country] = (lat,lon)
-                    self.geocoder[city_region] = (lat,lon)
-                    self.geocoder[city_country] = (lat,lon)
-                    self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_region_country))
-                    self.all_city_names.add(city_region_country)
+                    table.add_name(city_region_country, lat, lon)
+                    table.add_name(city_region, lat, lon)
+                    table.add_name(city_country, lat, lon)
+                    table.add_entry(lat, lon, city_region_country, region_name, country_name)
+                    table.add_city(city_region_country)
                 elif city_name and region_name:
                     city_region = city_name+"\t"+region_name
-                    self.geocoder[city_region] = (lat,lon)
-                    self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_region))
+                    table.add_name(city_region, lat, lon)
+                    table.add_entry(lat, lon, city_region, region_name, country_name)
 
                 elif city_name and country_name:
                     if city_name == country_name:
-                        self.geocoder[city_name] = (lat,lon)
-                        self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_name))
-                        self.all_city_names.add(city_name)
+                        table.add_name(city_name, lat, lon)
+                        table.add_entry(lat, lon, city_name, region_name, country_name)
+                        table.add_city(city_name)
                     else:
                         city_country = city_name+"\t"+country_name
-                        self.geocoder[city_country] = (lat,lon)
-                        self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_country))
-                        self.all_city_names.add(city_country)
+                        table.add_name(city_country, lat, lon)
+                        table.add_entry(lat, lon, city_country, region_name, country_name)
+                        table.add_city(city_country)
 
             # If there was only ever one city with this name, allow it to be an
             # unabiguosus lookup with just the city name
             unambiguous_cities = 0
             for city_name, (lat,lon) in city_to_latlon.iteritems():
                 if city_name_counts[city_name] == 1:
-                    self.geocoder[city_name] = (lat,lon)
+                    table.add_name(city_name, lat, lon)
                     unambiguous_cities += 1
             #print "Saw %d unambiguous cities in %s" % (unambiguous_cities, dataset)
 
@@ -118,8 +190,6 @@ class Geocoder(object):
                 region_name = line[3].lower()
                 lat = float(line[0])
                 lon = float(line[1])
-                rounded_lat = round(lat,2)
-                rounded_lon = round(lon,2)
                 #self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,country_name,region_name,city_name))
 
                 # Keep track of how many times city names occur
@@ -130,35 +200,35 @@ class Geocoder(object):
                     city_region_country = city_name+"\t"+region_name+"\t"+country_name
                     city_region = city_name+"\t"+region_name
                     city_country = city_name+"\t"+country_name
-                    self.geocoder[city_region_country] = (lat,lon)
-                    self.geocoder[city_region] = (lat,lon)
-                    self.geocoder[city_country] = (lat,lon)
-                    self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_region_country))
-                    self.all_city_names.add(city_region_country)
+                    table.add_name(city_region_country, lat, lon)
+                    table.add_name(city_region, lat, lon)
+                    table.add_name(city_country, lat, lon)
+                    table.add_entry(lat, lon, city_region_country, region_name, country_name)
+                    table.add_city(city_region_country)
 
                 elif city_name and region_name:
                     city_region = city_name+"\t"+region_name
-                    self.geocoder[city_region] = (lat,lon)
-                    self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_region))
-                    self.all_city_names.add(city_region)
+                    table.add_name(city_region, lat, lon)
+                    table.add_entry(lat, lon, city_region, region_name, country_name)
+                    table.add_city(city_region)
 
                 elif city_name and country_name:
                     if city_name == country_name:
-                        self.geocoder[city_name] = (lat,lon)
-                        self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_name))
-                        self.all_city_names.add(city_name)
+                        table.add_name(city_name, lat, lon)
+                        table.add_entry(lat, lon, city_name, region_name, country_name)
+                        table.add_city(city_name)
                     else:
                         city_country = city_name+"\t"+country_name
-                        self.geocoder[city_country] = (lat,lon)
-                        self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_country))
-                    self.all_city_names.add(city_country)
+                        table.add_name(city_country, lat, lon)
+                        table.add_entry(lat, lon, city_country, region_name, country_name)
+                    table.add_city(city_country)
 
             # If there was only ever one city with this name, allow it to be an
             # unabiguosus lookup with just the city name
             unambiguous_cities = 0
             for city_name, (lat,lon) in city_to_latlon.iteritems():
                 if city_name_counts[city_name] == 1:
-                    self.geocoder[city_name] = (lat,lon)
+                    table.add_name(city_name, lat, lon)
                     unambiguous_cities += 1
             #print "Saw %d unambiguous cities in %s" % (unambiguous_cities, dataset)
 
@@ -201,16 +271,16 @@ class Geocoder(object):
                 city_to_latlon[city] = (lat,lon)
                 city_name_counts[city] += 1
 
-                self.__add_name(city + "\t" + country, lat_lon)
+                self.__add_name(table, city + "\t" + country, lat_lon, "", country)
                 if city == country:
-                    self.__add_name(city, lat_lon)
+                    self.__add_name(table, city, lat_lon, "", country)
                 for state in states:
-                    self.__add_name(city + "\t" + state + "\t" + country, lat_lon)
+                    self.__add_name(table, city + "\t" + state + "\t" + country, lat_lon, state, country)
 
             unambiguous_cities = 0
             for city_name, (lat,lon) in city_to_latlon.iteritems():
                 if city_name_counts[city_name] == 1:
-                    self.geocoder[city_name] = (lat,lon)
+                    table.add_name(city_name, lat, lon)
                     unambiguous_cities += 1
 
         elif dataset == "geonames":
@@ -235,8 +305,6 @@ class Geocoder(object):
                 region_name = line[1].lower()
                 lat = float(line[3])
                 lon = float(line[4])
-                rounded_lat = round(lat,2)
-                rounded_lon = round(lon,2)
                 
                 # Keep track of how many times city names occur
                 city_to_latlon[city_name] = (lat,lon)
@@ -246,35 +314,35 @@ class Geocoder(object):
                     city_region_country = city_name+"\t"+region_name+"\t"+country_name
                     city_region = city_name+"\t"+region_name
                     city_country = city_name+"\t"+country_name
-                    self.geocoder[city_region_country] = (lat,lon)
-                    self.geocoder[city_region] = (lat,lon)
-                    self.geocoder[city_country] = (lat,lon)
-                    self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_region_country))
-                    self.all_city_names.add(city_region_country)
+                    table.add_name(city_region_country, lat, lon)
+                    table.add_name(city_region, lat, lon)
+                    table.add_name(city_country, lat, lon)
+                    table.add_entry(lat, lon, city_region_country, region_name, country_name)
+                    table.add_city(city_region_country)
 
                 elif city_name and region_name:
                     city_region = city_name+"\t"+region_name
-                    self.geocoder[city_region] = (lat,lon)
-                    self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_region))
-                    self.all_city_names.add(city_region)
+                    table.add_name(city_region, lat, lon)
+                    table.add_entry(lat, lon, city_region, region_name, country_name)
+                    table.add_city(city_region)
 
                 elif city_name and country_name:
                     if city_name == country_name:
-                        self.geocoder[city_name] = (lat,lon)
-                        self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_name))
-                        self.all_city_names.add(city_name)
+                        table.add_name(city_name, lat, lon)
+                        table.add_entry(lat, lon, city_name, region_name, country_name)
+                        table.add_city(city_name)
                     else:
                         city_country = city_name+"\t"+country_name
-                        self.geocoder[city_country] = (lat,lon)
-                        self.reverse_geocoder[(rounded_lat,rounded_lon)].append((lat,lon,city_country))
-                    self.all_city_names.add(city_country)
+                        table.add_name(city_country, lat, lon)
+                        table.add_entry(lat, lon, city_country, region_name, country_name)
+                    table.add_city(city_country)
 
             # If there was only ever one city with this name, allow it to be an
             # unabiguosus lookup with just the city name
             unambiguous_cities = 0
             for city_name, (lat,lon) in city_to_latlon.iteritems():
                 if city_name_counts[city_name] == 1:
-                    self.geocoder[city_name] = (lat,lon)
+                    table.add_name(city_name, lat, lon)
                     unambiguous_cities += 1
             #print "Saw %d unambiguous cities in %s" % (unambiguous_cities, dataset)
 
@@ -282,24 +350,15 @@ class Geocoder(object):
         else:
             raise NotImplementedError(dataset)
 
+        return table.build()
 
-        # create a lower-case dictionary for noisy lookups
-        self.lc_name_to_location = {}
-        for name, (lat, lon) in self.geocoder.iteritems():
-            self.lc_name_to_location[name.lower()] = (lat, lon)
-
-        LOGGER.debug("Geocoder loaded %d locations from %s" %
-                     (len(self.geocoder), dataset))
-
-    def __add_name(self, name, lat_lon):
+    def __add_name(self, table, name, lat_lon, region, country):
         lat = lat_lon[0]
         lon = lat_lon[1]
-        rounded_lat = round(lat, 2)
-        rounded_lon = round(lon, 2)
 
-        self.geocoder[name] = lat_lon
-        self.reverse_geocoder[(rounded_lat, rounded_lon)].append((lat, lon, name))
-        self.all_city_names.add(name)
+        table.add_name(name, lat, lon)
+        table.add_entry(lat, lon, name, region, country)
+        table.add_city(name)
 
 
     def canonicalize(self, lat, lon):
@@ -322,6 +381,40 @@ class Geocoder(object):
             return self.geocode(location_name)
         
 
+    def canonicalize_many(self, coords, max_distance=REVERSE_GEOCODE_MAX_KM):
+        """
+        Canonicalizes a sequence of (lat, lon) pairs at once, returning an
+        (n, 2) array of the canonical (lat, lon) of each pair's settlement and
+        an array of the index of that settlement in the settlement_index, or
+        -1 for the pairs that are not in any settlement and are returned
+        unchanged.  Each distinct pair is only looked up once.
+        """
+        coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+        if len(coords) == 0:
+            return coords.copy(), numpy.zeros(0, dtype=numpy.int64)
+        unique, inverse = numpy.unique(coords, axis=0, return_inverse=True)
+
+        settlements = self.settlement_index()
+        nearest = settlements.nearest(unique[:,0], unique[:,1], max_distance)[0]
+
+        # Geocode the name of each of the settlements that were found once
+        found = numpy.flatnonzero(nearest >= 0)
+        found_settlements, which = numpy.unique(nearest[found], return_inverse=True)
+        locations = numpy.empty((len(found_settlements), 2), dtype=numpy.float64)
+        geocoded = numpy.ones(len(found_settlements), dtype=bool)
+        for i, settlement in enumerate(found_settlements):
+            lat_lon = self.geocode(settlements.name(settlement))
+            if lat_lon is None:
+                geocoded[i] = False
+            else:
+                locations[i] = lat_lon
+
+        canonical = unique.copy()
+        canonical[found[geocoded[which]]] = locations[which[geocoded[which]]]
+        nearest[found[~geocoded[which]]] = -1
+
+        return canonical[inverse], nearest[inverse]
+
     def geocode(self, location_name):
         """
         Returns the latitude and lonitude (tuple) of a city name if found
@@ -336,15 +429,29 @@ class Geocoder(object):
         Returns the latitude and lonitude (tuple) of a noisy location name
         (e.g., the location field of a social media user's profile).  If your
         input isn't cleaned, you probably want this method instead of geocode().
+        Results are cached by the stripped name.
         """
+        name = location_name.strip()
+        lat_lon = self.noisy_cache.get(name)
+        if lat_lon is MISSING:
+            lat_lon = self.__geocode_noisy(name)
+            self.noisy_cache.put(name, lat_lon)
+        return lat_lon
 
-        usaRegex = re.compile("\\bUSA\\b")
-        usRegex = re.compile("\\bUS\\b")
-        ukRegex = re.compile("\\bUK\\b")
-        
-        name = location_name
-        name = name.strip()
-
+    def geocode_noisy_many(self, location_names):
+        """
+        Returns the list of the results of geocode_noisy for each of the
+        names, geocoding each distinct name only once.
+        """
+        results = {}
+        for location_name in location_names:
+            if not location_name in results:
+                results[location_name] = self.geocode_noisy(location_name)
+        LOGGER.debug("Geocoder noisy cache: %(hits)d hits, %(misses)d misses" %
+                     self.noisy_cache.stats())
+        return [results[location_name] for location_name in location_names]
+
+    def __geocode_noisy(self, name):
         # Correct for a few common noisy prefices
         if name.startswith("the city of "):
             name = name[12:] #.substring("the city of ".length())
@@ -352,12 +459,12 @@ class Geocoder(object):
             name = name[9:] #.substring("downtown ".length())
 
         # Swap out the three common contry abbrevations
-        name = re.sub(usaRegex, "United States", name)
-        name = re.sub(usRegex, "United States", name)
-        name = re.sub(ukRegex, "United Kingdom", name)
+        name = USA_REGEX.sub("United States", name)
+        name = US_REGEX.sub("United States", name)
+        name = UK_REGEX.sub("United Kingdom", name)
 
         # Substitute out state names from the US
-        matches = re.search(self.state_abbv_regex, name)
+        matches = self.state_abbv_regex.search(name)
         if not matches is None:
             abbv = matches.group(0)
             expanded = name[:matches.start(0)] + self.abbv_to_state[abbv] + name[matches.end(0):]
@@ -372,8 +479,8 @@ class Geocoder(object):
             name = "new york, new york"
 
         # Strip off all the cruft on either side
-        name = re.sub(ur'^[\W+]+', " ", name);
-        name = re.sub(ur'[\W+]+$', " ", name);
+        name = LEADING_CRUFT_REGEX.sub(" ", name);
+        name = TRAILING_CRUFT_REGEX.sub(" ", name);
         name = name.strip();
 
         # Rename the dict for brevity since we're going to referencing it a lot
@@ -386,7 +493,7 @@ class Geocoder(object):
         # Look for some name delimeters in the name to try matching on
         # city/state, etc.
         if name.find(',') >= 0 or name.find('-') >= 0 or name.find('|') >= 0:
-            parts = re.split(r'[,\-|]+', name)
+            parts = DELIMITER_REGEX.split(name)
 
             if len(parts) == 2:
                 p1 = parts[0].strip()
@@ -400,7 +507,7 @@ class Geocoder(object):
                     lat_lon = locs[p1]
 
                 if lat_lon is None and p1.find("st.") >= 0:
-                    p1 = re.sub("st.", "saint", p1)
+                    p1 = SAINT_ABBV_REGEX.sub("saint", p1)
                     if p1 + '\t' + p2 in locs:
                         lat_lon = locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -409,7 +516,7 @@ class Geocoder(object):
                         lat_lon = locs[p1]
 
                 elif lat_lon is None and p1.find("saint") >= 0:
-                    p1 = re.sub("saint", "st.", p1)
+                    p1 = SAINT_REGEX.sub("st.", p1)
                     if p1 + '\t' + p2 in locs:
                         lat_lon = locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -430,7 +537,7 @@ class Geocoder(object):
                     lat_lon = locs[p1]
 
                 if lat_lon is None and p1.find("st.") >= 0:
-                    p1 = re.sub("st.", "saint", p1)
+                    p1 = SAINT_ABBV_REGEX.sub("saint", p1)
                     if p1 + '\t' + p2 in locs:
                         lat_lon = locs[p1 + '\t' + p2]
                     elif p1 + '\t' + p3 in locs:
@@ -438,7 +545,7 @@ class Geocoder(object):
                     elif p1 in locs:
                         lat_lon = locs[p1]
                 if lat_lon is None and p1.find("saint") >= 0:
-                    p1 = re.sub("saint", "st.", p1)
+                    p1 = SAINT_REGEX.sub("st.", p1)
                     if p1 + '\t' + p2 in locs:
                         lat_lon = locs[p1 + '\t' + p2]
                     elif p1 + '\t' + p3 in locs:
@@ -452,7 +559,7 @@ class Geocoder(object):
         # Otherwise no delimeters so we're left to guess at where the name
         # breaks
         else:
-            parts = re.split(r'[ \t\n\r]+', name)
+            parts = WHITESPACE_REGEX.split(name)
             if len(parts) == 2:
                 p1 = parts[0]
                 p2 = parts[1]
@@ -465,7 +572,7 @@ class Geocoder(object):
                     lat_lon = locs[p1]
                 
                 if lat_lon is None and p1.find("st.") >= 0:
-                    p1 = re.sub("st.", "saint", p1)
+                    p1 = SAINT_ABBV_REGEX.sub("saint", p1)
                     if p1 + '\t' + p2 in locs:
                         lat_lon = locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -474,7 +581,7 @@ class Geocoder(object):
                         lat_lon = locs[p1]
 
                 elif lat_lon is None and p1.find("saint") >= 0:
-                    p1 = re.sub("saint", "st.", p1)
+                    p1 = SAINT_REGEX.sub("st.", p1)
                     if p1 + '\t' + p2 in locs:
                         lat_lon = locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -505,40 +612,122 @@ class Geocoder(object):
 
 
 
-    def reverse_geocode(self, lat, lon):
+    def settlement_index(self):
         """
-        Returns the closest city name given a latitude and lonitude.
+        Returns the SettlementIndex over the entries of the reverse geocoder,
+        which is built the first time it is needed.
         """
-        cities = self.reverse_geocoder[(round(lat,2),round(lon,2))]
-        closest_location = float("inf")
-        best_location = None
-        for city in cities:
-            lat2 = city[0]
-            lon2 = city[1]
-            distance = vincenty((lat,lon),(lat2,lon2)).km
-            if distance < closest_location:
-                closest_location = distance
-                best_location = city[2]
-
-        #if the direct search fails to find a location within 20km of the requested location,
-        #the lat/lon is assumed to be either not available or a fringe case. In the latter
-        #we check all the surrounding boxes in the reverse geocoder.
-        if closest_location > 20:
-            cities = self.reverse_geocoder[(round(lat+0.01,2),round(lon+0.01,2))] \
-                 + self.reverse_geocoder[(round(lat+0.01,2),round(lon-0.01,2))] + self.reverse_geocoder[(round(lat-0.01,2),round(lon+0.01,2))] \
-                 + self.reverse_geocoder[(round(lat-0.01,2),round(lon-0.01,2))] + self.reverse_geocoder[(round(lat,2),round(lon+0.01,2))] \
-                 + self.reverse_geocoder[(round(lat,2),round(lon-0.01,2))] + self.reverse_geocoder[(round(lat+0.01,2),round(lon,2))] \
-                 + self.reverse_geocoder[(round(lat-0.01,2),round(lon,2))]
-            for city in cities:
-                lat2 = city[0]
-                lon2 = city[1]
-                distance = vincenty((lat,lon),(lat2,lon2)).km
-                if distance < closest_location:
-                    closest_location = distance
-                    best_location = city[2]
-
-        return best_location
+        if self.settlements is None:
+            self.settlements = self.reverse_geocoder.settlement_index()
+            LOGGER.debug("Geocoder indexed %d settlements" % len(self.settlements))
+        return self.settlements
 
+    def reverse_geocode(self, lat, lon, max_distance=REVERSE_GEOCODE_MAX_KM):
+        """
+        Returns the name of the closest city to the latitude and longitude, or
+        None if there is no city within max_distance kilometers.
+        """
+        return self.reverse_geocode_many([lat], [lon], max_distance)[0]
+
+    def reverse_geocode_many(self, lats, lons, max_distance=REVERSE_GEOCODE_MAX_KM):
+        """
+        Returns the list of the names of the closest city to each of the
+        latitudes and longitudes, with None for the points that have no city
+        within max_distance kilometers.
+        """
+        settlements = self.settlement_index()
+        nearest, distances = settlements.nearest(lats, lons, max_distance)
+        return [settlements.name(i) if i >= 0 else None for i in nearest]
+
+
+    def mention_index(self):
+        """
+        Returns the token trie used by find_mentions, as a dict from the
+        tuple of the tokens of each name with at most MAX_MENTION_TOKENS tokens
+        to a dict from the tuple of the separators between those tokens to the
+        name, and the set of the proper prefixes of those token tuples.  The
+        trie is built the first time it is needed.
+        """
+        if self.mentions is None:
+            names = {}
+            prefixes = set()
+            for name in self.geocoder:
+                parts = NAME_SEPARATOR_REGEX.split(name)
+                tokens = tuple(parts[0::2])
+                if len(tokens) > MAX_MENTION_TOKENS or "" in tokens:
+                    continue
+                names.setdefault(tokens, {})[tuple(parts[1::2])] = name
+                for i in xrange(1, len(tokens)):
+                    prefixes.add(tokens[:i])
+            self.mentions = (names, prefixes)
+            LOGGER.debug("Geocoder indexed %d names for mentions" % len(names))
+        return self.mentions
+
+    def find_mentions(self, text, capitalized_only=False):
+        """
+        Returns the list of the places mentioned in the text, as (start, end,
+        name, (lat, lon)) tuples where text[start:end] is the mention of the
+        place with that name.  The whitespace-separated tokens of the text are
+        matched in a single pass, taking the longest name of up to
+        MAX_MENTION_TOKENS tokens (whose tokens may be joined by either a
+        space or a tab) that starts at each token and then continuing after
+        it.  If capitalized_only is True, mentions only consist of tokens that
+        start with an upper-case letter.
+        """
+        names, prefixes = self.mention_index()
+        spans = [(m.start(), m.end()) for m in TOKEN_REGEX.finditer(text)]
+        tokens = [text[start:end].lower() for start, end in spans]
+        is_upper = [text[start].isupper() for start, end in spans]
+
+        mentions = []
+        n = len(tokens)
+        i = 0
+        while i < n:
+            if capitalized_only and not is_upper[i]:
+                i += 1
+                continue
+
+            # Extend the mention for as long as it is the prefix of some name,
+            # remembering the longest name seen
+            longest = None
+            j = i + 1
+            while True:
+                key = tuple(tokens[i:j])
+                if key in names:
+                    separators = names[key]
+                    for seps in MENTION_SEPARATORS[j - i]:
+                        if seps in separators:
+                            longest = (j, separators[seps])
+                            break
+                if j >= n or j - i >= MAX_MENTION_TOKENS or not key in prefixes \
+                        or (capitalized_only and not is_upper[j]):
+                    break
+                j += 1
+
+            if longest is None:
+                i += 1
+                continue
+            end, name = longest
+            mentions.append((spans[i][0], spans[end-1][1], name, self.geocoder[name]))
+            i = end
+
+        return mentions
+
+    def find_mentions_many(self, texts, capitalized_only=False):
+        """
+        Returns the list of the results of find_mentions for each of the
+        texts.
+        """
+        return [self.find_mentions(text, capitalized_only) for text in texts]
+
+    def memory_report(self):
+        """
+        Returns a dict of the bytes used by this Geocoder's settlement table,
+        on the heap and memory-mapped, and an estimate of the bytes that
+        separate name, lower-cased name and reverse geocoder dictionaries and
+        a set of city names would use instead (see gazetteer.memory_report)
+        """
+        return memory_report(self.table)
 
     def get_cities(self):
         """
@@ -547,12 +736,45 @@ class Geocoder(object):
         """
         return self.all_city_names
 
+def gazetteer_name(dataset):
+    """
+    Returns the name of the gazetteer used for the dataset, since GPS data
+    uses the GeoLite gazetteer.
+    """
+    if dataset == "geo-median":
+        return "geolite"
+    if not dataset in GAZETTEER_SOURCES:
+        raise NotImplementedError(dataset)
+    return dataset
+
+def gazetteer_source(dataset):
+    """
+    Returns the path of the file the dataset's gazetteer is built from.
+    """
+    return os.path.join(RESOURCES_DIR, GAZETTEER_SOURCES[gazetteer_name(dataset)])
+
+def gazetteer_path(dataset):
+    """
+    Returns the directory of the compiled gazetteer for the dataset.
+    """
+    return os.path.join(RESOURCES_DIR, "gazetteer", gazetteer_name(dataset))
+
+def build_gazetteer(dataset):
+    """
+    Compiles the gazetteer of the dataset into the directory returned by
+    gazetteer_path, from which each Geocoder for the dataset will then be
+    loaded.
+    """
+    geocoder = Geocoder(dataset, use_gazetteer=False)
+    return write_gazetteer(gazetteer_path(dataset), geocoder.table,
+                           gazetteer_source(dataset))
+
 def geolite_data():
     """
     Returns the file contents of the geolite dataset.
     """
     file_contents = []
-    file_name = os.path.join("geolocate/resources","geolite.csv")
+    file_name = gazetteer_source("geolite")
     with open(file_name, 'rb') as csv_file:
         for line in csv.reader(csv_file):
             file_contents.append(line)
@@ -563,7 +785,7 @@ def geonames_data():
     Returns the file contents of the geolite dataset.
     """
     file_contents = []
-    file_name = os.path.join("geolocate/resources","geonames.exanded-cities.tsv.gz")
+    file_name = gazetteer_source("geonames")
     f = gzip.open(file_name, 'rb') 
     for line in f:
         file_contents.append(line.strip().split('\t'))
@@ -574,7 +796,7 @@ def google_data():
     """
     Returns the file contents of the google dataset.
     """
-    file_name = os.path.join("geolocate/resources","google-formatted.tsv")
+    file_name = gazetteer_source("google")
     file_contents = []
     with open(file_name, 'r') as tsv_file:
         for line in csv.reader(tsv_file, dialect="excel-tab"):
@@ -585,7 +807,7 @@ def dbpedia_data():
     """
     Returns the file contents of the google dataset.
     """
-    file_name = os.path.join("geolocate/resources","dbpedia.settlement-to-locations.localized.cleaned.uniq.tsv")
+    file_name = gazetteer_source("dbpedia")
     file_contents = []
     with open(file_name, 'r') as tsv_file:
         for line in csv.reader(tsv_file, dialect="excel-tab"):
@@ -597,7 +819,7 @@ def state_abbv_data():
     """
     Returns a dict containing state abbreviations
     """
-    file_name = os.path.join("geolocate/resources","state_table.csv")
+    file_name = os.path.join(RESOURCES_DIR,"state_table.csv")
     abbv_to_state = {}
     with open(file_name, 'r') as csv_file:
         line_no = 0
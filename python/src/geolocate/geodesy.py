@@ -0,0 +1,199 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Distances between latitude-longitude points, computed with numpy so that
+the distances from a user to all of their neighbors (or between all pairs
+of two sets of points) take one call rather than one per pair.
+
+Two metrics are provided: `haversine`, the great-circle distance on a sphere
+of radius `EARTH_RADIUS_KM`, and `vincenty`, the geodesic distance on the
+WGS-84 ellipsoid.  Both take arrays (or scalars) of latitudes and longitudes
+in degrees, which are broadcast against each other like the arguments of a
+numpy ufunc, and return distances in kilometers, or in miles if
+`miles=True`.  Vincenty's method does not converge for nearly antipodal
+points; those pairs are given their haversine distance rather than raising
+an error.
+
+The point-based functions take (lat, lon) pairs, or (n, 2) arrays of them:
+`distance` for a single pair, `pairwise` for the i-th point of one array
+and the i-th of another, `one_to_many` for one point and many, and
+`many_to_many` for the matrix of all pairs, which is computed in chunks of
+rows to bound the memory of the intermediate arrays.  `cartesian` gives the
+3-D coordinates of points, whose straight-line distances are lower bounds on
+their geodesic distances.
+"""
+
+import numpy
+
+# The mean radius of the Earth
+EARTH_RADIUS_KM = 6371.0088
+
+KM_PER_MILE = 1.609344
+
+# The semi-major axis, flattening and semi-minor axis of the WGS-84 ellipsoid
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B_KM = (1 - WGS84_F) * WGS84_A_KM
+
+# When the iteration of Vincenty's method is considered to have converged
+VINCENTY_TOLERANCE = 1e-12
+VINCENTY_MAX_ITERATIONS = 200
+
+# The number of distances many_to_many computes at once
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+def _result(distances, miles):
+    if miles:
+        distances = distances / KM_PER_MILE
+    if distances.ndim == 0:
+        return float(distances)
+    return distances
+
+def _radians(*values):
+    return [numpy.radians(numpy.asarray(v, dtype=numpy.float64)) for v in values]
+
+def haversine(lats1, lons1, lats2, lons2, miles=False):
+    """
+    Returns the great-circle distances between the points.
+    """
+    lats1, lons1, lats2, lons2 = _radians(lats1, lons1, lats2, lons2)
+    a = numpy.sin((lats2 - lats1) / 2) ** 2 \
+        + numpy.cos(lats1) * numpy.cos(lats2) * numpy.sin((lons2 - lons1) / 2) ** 2
+    distances = 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+    return _result(distances, miles)
+
+def vincenty(lats1, lons1, lats2, lons2, miles=False):
+    """
+    Returns the geodesic distances between the points on the WGS-84
+    ellipsoid, using Vincenty's inverse method.
+    """
+    rlats1, rlons1, rlats2, rlons2 = _radians(lats1, lons1, lats2, lons2)
+    rlats1, rlons1, rlats2, rlons2 = numpy.broadcast_arrays(rlats1, rlons1, rlats2, rlons2)
+    f = WGS84_F
+    L = rlons2 - rlons1
+    U1 = numpy.arctan((1 - f) * numpy.tan(rlats1))
+    U2 = numpy.arctan((1 - f) * numpy.tan(rlats2))
+    sin_U1, cos_U1 = numpy.sin(U1), numpy.cos(U1)
+    sin_U2, cos_U2 = numpy.sin(U2), numpy.cos(U2)
+
+    def terms(lam):
+        sin_lam, cos_lam = numpy.sin(lam), numpy.cos(lam)
+        sin_sigma = numpy.sqrt((cos_U2 * sin_lam) ** 2
+                               + (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam) ** 2)
+        cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+        sigma = numpy.arctan2(sin_sigma, cos_sigma)
+        # Coincident points have no azimuth
+        sin_alpha = numpy.where(sin_sigma == 0, 0.0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+        cos2_alpha = 1 - sin_alpha ** 2
+        # Points on the equator have no reduced latitude
+        cos_2sigma_m = numpy.where(cos2_alpha == 0, 0.0,
+                                   cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+        return sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m
+
+    lam = L
+    converged = numpy.zeros(L.shape, dtype=bool)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for iteration in xrange(VINCENTY_MAX_ITERATIONS):
+            sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = terms(lam)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            next_lam = L + (1 - C) * f * sin_alpha * \
+                (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            # Once a pair converges its value is kept, so that the distance
+            # of a pair does not depend on the others it is computed with
+            next_lam = numpy.where(converged, lam, next_lam)
+            converged = numpy.abs(next_lam - lam) < VINCENTY_TOLERANCE
+            lam = next_lam
+            if converged.all():
+                break
+
+        sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = terms(lam)
+        u2 = cos2_alpha * (WGS84_A_KM ** 2 - WGS84_B_KM ** 2) / WGS84_B_KM ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distances = WGS84_B_KM * A * (sigma - delta_sigma)
+
+    failed = ~converged | numpy.isnan(distances)
+    if failed.any():
+        distances = numpy.where(failed, haversine(lats1, lons1, lats2, lons2), distances)
+    return _result(distances, miles)
+
+def cartesian(lats, lons):
+    """
+    Returns the (n, 3) array of the Earth-centered Cartesian coordinates (in
+    km) of the points on the WGS-84 ellipsoid.  The straight-line distance
+    between two points is never more than their geodesic distance.
+    """
+    rlats, rlons = _radians(lats, lons)
+    rlats, rlons = numpy.broadcast_arrays(rlats, rlons)
+    e2 = WGS84_F * (2 - WGS84_F)
+    sin_lats = numpy.sin(rlats)
+    # The radius of curvature in the prime vertical
+    N = WGS84_A_KM / numpy.sqrt(1 - e2 * sin_lats ** 2)
+    xyz = numpy.empty(rlats.shape + (3,), dtype=numpy.float64)
+    xyz[...,0] = N * numpy.cos(rlats) * numpy.cos(rlons)
+    xyz[...,1] = N * numpy.cos(rlats) * numpy.sin(rlons)
+    xyz[...,2] = N * (1 - e2) * sin_lats
+    return xyz.reshape(-1, 3)
+
+# The metrics that the point-based functions accept, by name
+METRICS = { 'haversine': haversine, 'vincenty': vincenty }
+
+def _metric(metric):
+    if not metric in METRICS:
+        raise ValueError('unknown distance metric: %s' % metric)
+    return METRICS[metric]
+
+def _points(points):
+    return numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+
+def distance(p1, p2, metric='haversine', miles=False):
+    """
+    Returns the distance between the two (lat, lon) points.
+    """
+    return _metric(metric)(p1[0], p1[1], p2[0], p2[1], miles=miles)
+
+def pairwise(points1, points2, metric='haversine', miles=False):
+    """
+    Returns the array of the distances between the i-th points of the two
+    sequences of (lat, lon) points, which have the same length.
+    """
+    points1 = _points(points1)
+    points2 = _points(points2)
+    return _metric(metric)(points1[:,0], points1[:,1], points2[:,0], points2[:,1],
+                           miles=miles).reshape(-1)
+
+def one_to_many(point, points, metric='haversine', miles=False):
+    """
+    Returns the array of the distances from the (lat, lon) point to each of
+    the points.
+    """
+    points = _points(points)
+    return _metric(metric)(point[0], point[1], points[:,0], points[:,1],
+                           miles=miles).reshape(-1)
+
+def many_to_many(points1, points2, metric='haversine', miles=False,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns the (len(points1), len(points2)) matrix of the distances between
+    each pair of points, computing about `chunk_size` distances at a time.
+    """
+    func = _metric(metric)
+    points1 = _points(points1)
+    points2 = _points(points2)
+    distances = numpy.empty((len(points1), len(points2)), dtype=numpy.float64)
+    rows = max(1, chunk_size // max(len(points2), 1))
+    lats2 = points2[:,0][numpy.newaxis,:]
+    lons2 = points2[:,1][numpy.newaxis,:]
+    for start in xrange(0, len(points1), rows):
+        chunk = points1[start:start + rows]
+        distances[start:start + len(chunk)] = func(chunk[:,0][:,numpy.newaxis],
+                                                   chunk[:,1][:,numpy.newaxis],
+                                                   lats2, lons2, miles=miles)
+    return distances
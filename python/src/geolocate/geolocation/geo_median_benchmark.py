@@ -0,0 +1,134 @@
+__author__ = 'joh12041'
+
+# Times the numpy medians of geo_median.py against the original implementation, which computed each distance with
+# geopy, on synthetic users with increasing numbers of GPS points, and checks that both write the same rows.
+#
+# The original snapped median computes n^2 distances, which takes hours for users with thousands of points, so for
+# large users its time is extrapolated from the time it takes for a sample of the candidate points, and the median
+# chosen by numpy is only checked to be at least as good as the best of the sample.
+
+import argparse
+import csv
+import os, os.path
+import sys
+import time
+
+import numpy
+from geopy.distance import vincenty
+from geopy.distance import great_circle
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import geo_median
+
+def referenceDistance(p1, p2):
+    try:
+        return vincenty(p1, p2).kilometers
+    except ValueError:
+        return great_circle(p1, p2).kilometers
+
+def referenceObjfunc(testMedian, dataPoints):
+    temp = 0.0
+    for i in range(0, len(dataPoints)):
+        temp += referenceDistance(testMedian, dataPoints[i])
+    return temp
+
+def referenceSnappedMedian(dataPoints):
+    lowestDev = float("inf")
+    for point in dataPoints:
+        tmpAbsDev = referenceObjfunc(point, dataPoints)
+        if tmpAbsDev < lowestDev:
+            lowestDev = tmpAbsDev
+            testMedian = point
+    return testMedian
+
+def referenceWeiszfeldMedian(dataPoints, numIter):
+    testMedian = (sum(p[0] for p in dataPoints) / len(dataPoints), sum(p[1] for p in dataPoints) / len(dataPoints))
+    if referenceObjfunc(testMedian, dataPoints) == 0:
+        return testMedian
+    for x in range(0, numIter):
+        inverses = []
+        for point in dataPoints:
+            distance = referenceDistance(testMedian, point)
+            inverses.append(1 / distance if distance > 0 else 0)
+        denom = sum(inverses)
+        nextLat = 0.0
+        nextLon = 0.0
+        for y in range(0, len(dataPoints)):
+            nextLat += (dataPoints[y][0] * inverses[y]) / denom
+            nextLon += (dataPoints[y][1] * inverses[y]) / denom
+        prevMedian = testMedian
+        testMedian = (nextLat, nextLon)
+        if referenceDistance(prevMedian, testMedian) * 1000 < geo_median.DISTANCE_THRESHOLD:
+            break
+    return testMedian
+
+def referenceRow(dataPoints, median, uid):
+    distances = [referenceDistance(median, point) for point in dataPoints]
+    if numpy.median(distances) <= geo_median.LIMIT_MAD:
+        return [uid, round(median[0], 6), round(median[1], 6)]
+    return None
+
+def userPoints(rng, n):
+    # Most points are around home, the rest are spread over the surrounding region
+    home = (rng.uniform(25, 49), rng.uniform(-124, -67))
+    near = int(n * 0.8)
+    lats = numpy.concatenate([rng.normal(home[0], 0.05, near), rng.normal(home[0], 2.0, n - near)])
+    lons = numpy.concatenate([rng.normal(home[1], 0.05, near), rng.normal(home[1], 2.0, n - near)])
+    return [(float(lat), float(lon)) for lat, lon in zip(lats, lons)]
+
+class RowCollector(object):
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the geometric medians of geo_median.py')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 2000, 5000],
+                        help='the numbers of GPS points of the synthetic users')
+    parser.add_argument('--iterations', type=int, default=1000, help='the maximum number of Weiszfeld iterations')
+    parser.add_argument('--sample', type=int, default=100,
+                        help='the number of candidate points from which the time of the original snapped median is '
+                             'extrapolated for larger users')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(args.seed)
+    csvwriter = csv.writer(sys.stdout, delimiter='\t')
+    csvwriter.writerow(['points', 'median', 'original (s)', 'numpy (s)', 'speedup', 'same row'])
+    for n in args.sizes:
+        dataPoints = userPoints(rng, n)
+        for snap in [True, False]:
+            geo_median.SNAP_TO_USER_POINTS = snap
+            rows = RowCollector()
+            start = time.time()
+            geo_median.compute_user_median(dataPoints, args.iterations, rows, 'user')
+            newTime = time.time() - start
+            newRow = rows.rows[0] if rows.rows else None
+
+            start = time.time()
+            if snap and n > args.sample:
+                # Time the sums of distances of a sample of the candidates, then check the candidate chosen by numpy
+                # against the best of the sample
+                sample = [dataPoints[i] for i in rng.choice(n, args.sample, replace=False)]
+                best = min(referenceObjfunc(point, dataPoints) for point in sample)
+                refTime = (time.time() - start) * n / args.sample
+                chosen = dataPoints[geo_median.snappedMedian(numpy.asarray(dataPoints))]
+                same = referenceObjfunc(chosen, dataPoints) <= best
+                refLabel = '~%.1f' % refTime
+            else:
+                if snap:
+                    median = referenceSnappedMedian(dataPoints)
+                else:
+                    median = referenceWeiszfeldMedian(dataPoints, args.iterations)
+                refTime = time.time() - start
+                same = referenceRow(dataPoints, median, 'user') == newRow
+                refLabel = '%.2f' % refTime
+
+            csvwriter.writerow([n, 'snapped' if snap else 'weiszfeld', refLabel, '%.3f' % newTime,
+                                '%.0fx' % (refTime / max(newTime, 1e-6)), same])
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ Allows for multiple dataset inputs
 """
 
 import os, os.path
+import argparse
 import csv
 import re
 import logging
@@ -17,20 +18,38 @@ import sys
 import gzip
 import json
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from geolocate.geocode_cache import DEFAULT_CACHE_SIZE, MISSING, GeocodeCache
+
 LOGGER = logging.getLogger(os.path.basename(__file__))
 
+# The patterns used to clean up noisy location names
+USA_REGEX = re.compile("\\busa\\b")
+US_REGEX = re.compile("\\bus\\b")
+UK_REGEX = re.compile("\\buk\\b")
+LEADING_CRUFT_REGEX = re.compile(r'^[\W+]+')
+TRAILING_CRUFT_REGEX = re.compile(r'[\W+]+$')
+DELIMITER_REGEX = re.compile(r'[,\-|]+')
+WHITESPACE_REGEX = re.compile(r'[ \t\n\r]+')
+SAINT_ABBV_REGEX = re.compile("st.")
+SAINT_REGEX = re.compile("saint")
+
 class Geocoder(object):
 
     """
     Geocoder to be used on the Geolocation Inference Project.
     """
-    def __init__(self,dataset="geonames"):
+    def __init__(self,dataset="geonames",noisy_cache_size=DEFAULT_CACHE_SIZE,
+                 noisy_cache_fname=None):
         """
-        Initializes the "geocoder" dictionary from geonames
+        Initializes the "geocoder" dictionary from geonames.  The results of
+        geocode_noisy are cached for up to noisy_cache_size names, and also
+        stored in noisy_cache_fname, if provided.
         """
         self.abbv_to_state = state_abbv_data()
         self.state_abbv_regex = re.compile(r'(\b' + (r'\b|\b'.join(self.abbv_to_state.keys())) + r'\b)')
         self.lc_name_to_location = {}
+        self.noisy_cache = GeocodeCache(noisy_cache_size, noisy_cache_fname)
 
         LOGGER.debug("Geocoder loading city-location mapping from %s" % (dataset))
 
@@ -68,15 +87,30 @@ class Geocoder(object):
         Returns the latitude and longitude (tuple) of a noisy location name
         (e.g., the location field of a social media user's profile).  If your
         input isn't cleaned, you probably want this method instead of geocode().
+        Results are cached by the lower-cased, stripped name.
         """
-
-        usaRegex = re.compile("\\busa\\b")
-        usRegex = re.compile("\\bus\\b")
-        ukRegex = re.compile("\\buk\\b")
-        
         name = location_name.lower()
         name = name.strip()
+        lat_lon = self.noisy_cache.get(name)
+        if lat_lon is MISSING:
+            lat_lon = self.__geocode_noisy(name)
+            self.noisy_cache.put(name, lat_lon)
+        return lat_lon
 
+    def geocode_noisy_many(self, location_names):
+        """
+        Returns the list of the results of geocode_noisy for each of the
+        names, geocoding each distinct name only once.
+        """
+        results = {}
+        for location_name in location_names:
+            if not location_name in results:
+                results[location_name] = self.geocode_noisy(location_name)
+        LOGGER.debug("Geocoder noisy cache: %(hits)d hits, %(misses)d misses" %
+                     self.noisy_cache.stats())
+        return [results[location_name] for location_name in location_names]
+
+    def __geocode_noisy(self, name):
         # Correct for a few common noisy prefices
         if name.startswith("the city of "):
             name = name[12:] #.substring("the city of ".length())
@@ -84,12 +118,12 @@ class Geocoder(object):
             name = name[9:] #.substring("downtown ".length())
 
         # Swap out the three common contry abbrevations
-        name = re.sub(usaRegex, "united states", name)
-        name = re.sub(usRegex, "united states", name)
-        name = re.sub(ukRegex, "united kingdom", name)
+        name = USA_REGEX.sub("united states", name)
+        name = US_REGEX.sub("united states", name)
+        name = UK_REGEX.sub("united kingdom", name)
 
         # Substitute out state names from the US
-        matches = re.search(self.state_abbv_regex, name)
+        matches = self.state_abbv_regex.search(name)
         if not matches is None:
             abbv = matches.group(0)
             expanded = name[:matches.start(0)] + self.abbv_to_state[abbv] + name[matches.end(0):]
@@ -104,8 +138,8 @@ class Geocoder(object):
             return (38.904722, -77.016389)
 
         # Strip off all the cruft on either side
-        name = re.sub(r'^[\W+]+', " ", name)
-        name = re.sub(r'[\W+]+$', " ", name)
+        name = LEADING_CRUFT_REGEX.sub(" ", name)
+        name = TRAILING_CRUFT_REGEX.sub(" ", name)
         name = name.strip()
 
         # Rename the dict for brevity since we're going to referencing it a lot
@@ -133,7 +167,7 @@ class Geocoder(object):
         # Look for some name delimeters in the name to try matching on
         # city/state, etc.
         if name.find(',') >= 0 or name.find('-') >= 0 or name.find('|') >= 0:
-            parts = re.split(r'[,\-|]+', name)
+            parts = DELIMITER_REGEX.split(name)
 
             if len(parts) == 2:
                 p1 = parts[0].strip()
@@ -147,7 +181,7 @@ class Geocoder(object):
                     return locs[p1]
 
                 if p1.find("st.") >= 0:
-                    p1 = re.sub("st.", "saint", p1)
+                    p1 = SAINT_ABBV_REGEX.sub("saint", p1)
                     if p1 + '\t' + p2 in locs:
                         return locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -156,7 +190,7 @@ class Geocoder(object):
                         return locs[p1]
 
                 elif p1.find("saint") >= 0:
-                    p1 = re.sub("saint", "st.", p1)
+                    p1 = SAINT_REGEX.sub("st.", p1)
                     if p1 + '\t' + p2 in locs:
                         return locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -179,7 +213,7 @@ class Geocoder(object):
                     return locs[p1]
 
                 if p1.find("st.") >= 0:
-                    p1 = re.sub("st.", "saint", p1)
+                    p1 = SAINT_ABBV_REGEX.sub("saint", p1)
                     if p1 + '\t' + p2 + '\t' + p3 in locs:
                         return locs[p1 + '\t' + p2 + '\t' + p3]
                     elif p1 + '\t' + p2 in locs:
@@ -189,7 +223,7 @@ class Geocoder(object):
                     elif p1 in locs:
                         return locs[p1]
                 if p1.find("saint") >= 0:
-                    p1 = re.sub("saint", "st.", p1)
+                    p1 = SAINT_REGEX.sub("st.", p1)
                     if p1 + '\t' + p2 + '\t' + p3 in locs:
                         return locs[p1 + '\t' + p2 + '\t' + p3]
                     elif p1 + '\t' + p2 in locs:
@@ -205,7 +239,7 @@ class Geocoder(object):
         # Otherwise no delimiters so we're left to guess at where the name
         # breaks
         else:
-            parts = re.split(r'[ \t\n\r]+', name)
+            parts = WHITESPACE_REGEX.split(name)
             if len(parts) == 2:
                 p1 = parts[0]
                 p2 = parts[1]
@@ -218,7 +252,7 @@ class Geocoder(object):
                     return locs[p1]
                 
                 if p1.find("st.") >= 0:
-                    p1 = re.sub("st.", "saint", p1)
+                    p1 = SAINT_ABBV_REGEX.sub("saint", p1)
                     if p1 + '\t' + p2 in locs:
                         return locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -227,7 +261,7 @@ class Geocoder(object):
                         return locs[p1]
 
                 elif p1.find("saint") >= 0:
-                    p1 = re.sub("saint", "st.", p1)
+                    p1 = SAINT_REGEX.sub("st.", p1)
                     if p1 + '\t' + p2 in locs:
                         return locs[p1 + '\t' + p2]
                     elif p2 + '\t' + p1 in locs:
@@ -295,9 +329,16 @@ def extract_user_location(post):
     return post["user"]["location"]
 
 def main():
+    # This geocodes the users of the sample tweets serially; the home
+    # locations of a dataset are built by `geoinf build_home_locations`
+    parser = argparse.ArgumentParser(description='geocode the location fields of the users of the sample tweets')
+    parser.add_argument('-c','--noisy_cache',default=None,
+                        help='a file in which the results of geocode_noisy are kept between runs')
+    args = parser.parse_args()
+
     # Generate geocoder from preprocessed CSV
     print("Starting...")
-    gc = Geocoder()
+    gc = Geocoder(noisy_cache_fname=args.noisy_cache)
     print("Geocoder created with {0} places.".format(len(gc.lc_name_to_location)))
     location_field_data_fn = "../sample_tweets.json.gz"
     output_fn = "../sample_dataset/users.home-locations.geo-median.tsv"
@@ -315,14 +356,16 @@ def main():
             continue
     print len(uidToLocations.keys())
 
+    # Geocode each distinct location once, reusing the results of earlier runs
+    uids = [uid for uid, location in uidToLocations.iteritems() if location]
+    pts = gc.geocode_noisy_many([uidToLocations[uid] for uid in uids])
+    gc.noisy_cache.close()
+    print("Geocoder cache: {hits} hits, {misses} misses.".format(**gc.noisy_cache.stats()))
+
     i = 0
     with open(output_fn, "w") as fout:
         csvwriter = csv.writer(fout, delimiter='\t')
-        for uid, location in uidToLocations.iteritems():
-            if location:
-                pt = gc.geocode_noisy(location)
-            else:
-                pt = None
+        for uid, pt in zip(uids, pts):
             if pt == None:
                 continue
             csvwriter.writerow([uid, pt[0], pt[1]])
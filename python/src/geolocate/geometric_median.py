@@ -0,0 +1,132 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+The geometric median of a user's GPS points, used as their home location.
+The median is either snapped to the user's point with the lowest sum of
+distances to the others (the medoid) or found with Weiszfeld's algorithm,
+and users whose points are too few, or too spread out around the median, are
+given no home location.  All distances are Vincenty distances computed with
+`geodesy`, over the whole array of a user's points at once.
+"""
+
+import os, os.path
+import logging
+
+import numpy
+
+import geodesy
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# The minimum number of GPS points of a user with a home location
+MIN_POINTS = 3
+
+# The maximum median distance (in km) of a user's points from their median
+MAX_MAD_KM = 30
+
+# The distance (in meters) between iterations of Weiszfeld's algorithm at
+# which it is considered to have converged
+DISTANCE_THRESHOLD_M = 1
+
+DEFAULT_ITERATIONS = 1000
+
+def gps_points(user):
+    """
+    Returns the list of the (lat, lon) points of the user's GPS-tagged posts,
+    read from the `geo` field of each post, or from its GeoJSON `coordinates`
+    field if it has no `geo`.
+    """
+    points = []
+    for post in user['posts']:
+        geo = post.get('geo')
+        if isinstance(geo, dict) and isinstance(geo.get('coordinates'), list) \
+                and len(geo['coordinates']) >= 2:
+            lat, lon = geo['coordinates'][:2]
+        else:
+            coords = post.get('coordinates')
+            if not isinstance(coords, dict) or coords.get('type') != 'Point' \
+                    or not isinstance(coords.get('coordinates'), list) \
+                    or len(coords['coordinates']) < 2:
+                continue
+            # GeoJSON points are (lon, lat)
+            lon, lat = coords['coordinates'][:2]
+        try:
+            points.append((float(lat), float(lon)))
+        except (TypeError, ValueError):
+            continue
+    return points
+
+def snapped_median(points):
+    """
+    Returns the index of the point with the lowest sum of distances to all of
+    the points (the medoid), taking the first of any ties.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    n = len(points)
+    # The sums are computed for a chunk of points at a time to bound the
+    # size of the distance matrix
+    sums = numpy.empty(n)
+    rows = max(1, geodesy.DEFAULT_CHUNK_SIZE // n)
+    for start in xrange(0, n, rows):
+        sums[start:start + rows] = geodesy.many_to_many(points[start:start + rows], points,
+                                                        metric='vincenty').sum(axis=1)
+    return int(numpy.argmin(sums))
+
+def weiszfeld_median(points, num_iter=DEFAULT_ITERATIONS, user_id=None):
+    """
+    Returns the (lat, lon) geometric median of the points, found with
+    Weiszfeld's algorithm starting from their centroid, where each iteration
+    moves the candidate to the mean of the points weighted by their inverse
+    distances.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    median = points.mean(axis=0)
+    if geodesy.one_to_many(median, points, metric='vincenty').sum() == 0:
+        # The points are all the same
+        return (float(median[0]), float(median[1]))
+
+    for i in xrange(num_iter):
+        distances = geodesy.one_to_many(median, points, metric='vincenty')
+        # Points equal to the candidate are left out, or it could not move
+        weights = numpy.zeros(len(points))
+        nonzero = distances > 0
+        weights[nonzero] = 1 / distances[nonzero]
+
+        previous = median
+        median = (points * weights[:,numpy.newaxis]).sum(axis=0) / weights.sum()
+        change = geodesy.distance(previous, median, metric='vincenty') * 1000
+        if change < DISTANCE_THRESHOLD_M:
+            break
+    else:
+        logger.warn('%s: failed to converge. Last change between iterations was %s meters.'
+                    % (user_id, change))
+    return (float(median[0]), float(median[1]))
+
+def median_absolute_deviation(points, median):
+    """
+    Returns the median of the distances (in km) of the points from the median.
+    """
+    return float(numpy.median(geodesy.one_to_many(median, points, metric='vincenty')))
+
+def home_location(points, snap=True, num_iter=DEFAULT_ITERATIONS,
+                  min_points=MIN_POINTS, max_mad=MAX_MAD_KM, user_id=None):
+    """
+    Returns the (lat, lon) geometric median of the user's points, snapped to
+    one of them if `snap` is True, or None if the user has fewer than
+    `min_points` points or their median absolute deviation from it exceeds
+    `max_mad` km.
+    """
+    if len(points) < min_points:
+        return None
+    array = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    if snap:
+        median = tuple(points[snapped_median(array)])
+    else:
+        median = weiszfeld_median(array, num_iter, user_id)
+    if median_absolute_deviation(array, median) > max_mad:
+        return None
+    return median
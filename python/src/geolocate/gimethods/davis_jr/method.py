@@ -6,7 +6,7 @@
 
 import os.path
 import logging
-import gzip
+from geolocate.compression import open_file, find_file, model_extension
 import pickle
 
 from collections import Counter
@@ -16,6 +16,12 @@ from geolocate import GIMethod, GIModel, geocoder
 
 LOGGER = logging.getLogger(os.path.basename(__file__))
 
+# The post fields used to find a user's location
+LOCATION_FIELDS = ['geo', 'place', 'user.id', 'user.id_str', 'user.location']
+
+# The sources of the locations found by find_location
+GEO, GEOIP, LOC_FIELD = 'geo', 'geo-ip', 'loc field'
+
 class Davis_Jr_et_al_Model(GIModel):
 
     def __init__(self, user_id_to_location):
@@ -64,9 +70,6 @@ class Davis_Jr_et_al_Method(GIMethod):
         # Location is represented as a lat/lon geopy Point
         self.user_id_to_location = {}
         self.geocoder = None;
-        self.geo = 0
-        self.loc = 0
-        self.geoip = 0
         self.user_to_home_loc = {}
 
 
@@ -87,6 +90,12 @@ class Davis_Jr_et_al_Method(GIMethod):
             self.geocoder = geocoder.Geocoder()
             can_use_home_loc = False
         
+        # The farthest (in km) that a GPS location is moved to the settlement
+        # it is canonicalized to
+        max_canonical_distance = geocoder.REVERSE_GEOCODE_MAX_KM
+        if 'max_canonical_distance' in settings:
+            max_canonical_distance = float(settings['max_canonical_distance'])
+
         min_location_votes = 2
         if 'min_location_votes' in settings:
             min_location_votes = int(settings['min_location_votes'])
@@ -107,52 +116,75 @@ class Davis_Jr_et_al_Method(GIMethod):
 
 
         LOGGER.debug('Loading mention network')
-        mention_network = dataset.bi_mention_network()
+        # Only the users' neighbors are looked up, for which the read-only
+        # CSR graph suffices
+        mention_network = dataset.bi_mention_network(csr=True)
 
         # For each of the users that we have in the network, see if we can
-        # associate that user with a home location.
+        # associate that user with a home location.  The users' interned
+        # indices are also their node indices in the network.
         all_users = set(mention_network.nodes_iter())
-        for user_id, home_loc in dataset.user_home_location_iter():           
-            if not user_id in all_users:
+        for user_idx, home_loc in dataset.user_home_location_iter(interned=True):
+            if not mention_network.has_node_(user_idx):
                 continue
-            self.user_to_home_loc[user_id] = home_loc
+            self.user_to_home_loc[mention_network.node_object(user_idx)] = home_loc
+
+        # Processes used to look for the users' locations
+        num_workers = None
+        if 'num_workers' in settings:
+            num_workers = int(settings['num_workers'])
 
         # This dict will contain a mapping from a user ID to an associated
         # location, if one can be discovered from the GPS, GeoIP, or Location
         # Field data.
-        user_to_gold_loc = {}
-        num_users_seen = 0
-        
         LOGGER.debug('Inferring home locations of %s users' % len(all_users))
-        for user in dataset.user_iter():
-            user_id = user["user_id"]
-            # Skip the posts of users who aren't in the mention network.  This
-            # is potentially inefficient, but there's currently no support for
-            # iterating by user-id.
-            if not user_id in all_users:
+        # Only read the posts of users who are in the mention network, and
+        # only the fields of their posts that get_location looks at.  The
+        # users are split between workers, so the number of users located by
+        # each source is counted here, from the workers' results.
+        user_to_found_loc = dataset.map_users(
+            lambda user: self.find_location(user["posts"], posts_to_use, can_use_home_loc),
+            user_ids=all_users, fields=LOCATION_FIELDS, num_workers=num_workers)
+
+        # The GPS points are canonicalized here, all at once, rather than in
+        # the workers one post at a time
+        user_to_gold_loc = {}
+        gps_user_ids = []
+        gps_points = []
+        source_counts = Counter()
+        for user_id, (lat_lon, source) in user_to_found_loc.iteritems():
+            if lat_lon is None:
                 continue
-
-            # This strategy returns null if no location was found
-            home_loc = self.get_location(user["posts"], posts_to_use, can_use_home_loc)
-            if not home_loc is None:
-                user_to_gold_loc[user_id] = home_loc
-                #last_seen_user = user_id
-            num_users_seen += 1
-            if num_users_seen % 100000 == 0:
-                LOGGER.debug('Seen %d/%d users, located %d (%d geo, %d geo-ip, %d loc field)' % (num_users_seen, len(all_users), len(user_to_gold_loc), self.geo, self.geoip, self.loc))
-                #LOGGER.debug("check for %s" % last_seen_user)
-                #break
+            source_counts[source] += 1
+            if source == GEO:
+                gps_user_ids.append(user_id)
+                gps_points.append(lat_lon)
+            else:
+                user_to_gold_loc[user_id] = lat_lon
+        canonical_lat_lons = self.geocoder.canonicalize_many(gps_points, max_canonical_distance)[0]
+        for user_id, lat_lon in zip(gps_user_ids, canonical_lat_lons.tolist()):
+            user_to_gold_loc[user_id] = tuple(lat_lon)
+        LOGGER.debug('Located %d/%d users (%d geo, %d geo-ip, %d loc field)'
+                     % (len(user_to_gold_loc), len(all_users), source_counts[GEO],
+                        source_counts[GEOIP], source_counts[LOC_FIELD]))
+
+        # The friends' locations are looked up by node index, so that the
+        # neighbors of each user never need to be mapped back to their ids
+        idx_to_gold_loc = {}
+        for user_id, lat_lon in user_to_gold_loc.iteritems():
+            idx_to_gold_loc[mention_network.node_idx(user_id)] = lat_lon
         
         # Once we have a gold-standard set of locations, infer the locations of
         # all other users on the basis of their friends
-        for user_id in all_users:
-            if user_id in user_to_gold_loc:
-                self.user_id_to_location[user_id] = user_to_gold_loc[user_id]
+        for user_idx in mention_network.nodes_().tolist():
+            user_id = mention_network.node_object(user_idx)
+            if user_idx in idx_to_gold_loc:
+                self.user_id_to_location[user_id] = idx_to_gold_loc[user_idx]
                 continue
 
             #LOGGER.debug("Testing %s" % user_id)
 
-            neighbors = mention_network.neighbors(user_id)
+            neighbors = mention_network.neighbors_(user_idx).tolist()
             
             # Check that the user's ego network is within the prescribed bounds
             if len(neighbors) < min_friends or len(neighbors) > max_friends:
@@ -162,11 +194,10 @@ class Davis_Jr_et_al_Method(GIMethod):
             # For each of the users in the network, get their estimated
             # location, if any
             locationCounts = Counter()
-            for neighbor_id in neighbors:
-                in_gold = str(neighbor_id in user_to_gold_loc)
-                #LOGGER.debug("%s -> %s ? %s" % (user_id, neighbor_id, in_gold))
-                if neighbor_id in user_to_gold_loc:
-                    locationCounts[user_to_gold_loc[neighbor_id]] += 1
+            for neighbor_idx in neighbors:
+                #LOGGER.debug("%s -> %s ? %s" % (user_id, neighbor_idx, neighbor_idx in idx_to_gold_loc))
+                if neighbor_idx in idx_to_gold_loc:
+                    locationCounts[idx_to_gold_loc[neighbor_idx]] += 1
 
             # Skip this user if we didn't have any locatable friends
             if len(locationCounts) == 0:
@@ -197,7 +228,7 @@ class Davis_Jr_et_al_Method(GIMethod):
             #fh.close()
             
             # Write the .tsv for human debugability too
-            fh = gzip.open(os.path.join(model_dir, 'user-to-lat-lon.tsv.gz'), 'w')
+            fh = open_file(os.path.join(model_dir, 'user-to-lat-lon.tsv' + model_extension(settings)), 'w')
             for user_id, loc in self.user_id_to_location.iteritems():
                 fh.write("%s\t%s\t%s\n" % (user_id, loc[0], loc[1]))
             fh.close()
@@ -211,6 +242,21 @@ class Davis_Jr_et_al_Method(GIMethod):
         location field of the author's posts, returning that location or None if
         the user did not provide any of those three forms of information
         """
+        found = self.find_location(posts, posts_to_use, can_use_home_loc)
+        if found is None:
+            return None
+        lat_lon, source = found
+        if source == GEO and not lat_lon is None:
+            return self.geocoder.canonicalize(lat_lon[0], lat_lon[1])
+        return lat_lon
+
+    def find_location(self, posts, posts_to_use, can_use_home_loc):
+        """
+        Returns the location that get_location would identify, along with
+        its source (GEO for a GPS point that has yet to be canonicalized to
+        its settlement, GEOIP or LOC_FIELD), or None if the user did not
+        provide any location information
+        """
 
         # We don't need all the posts
         if len(posts) > posts_to_use:
@@ -227,11 +273,10 @@ class Davis_Jr_et_al_Method(GIMethod):
             lat = coords[0]
             lon = coords[1]
 
-            # Convert the point to its city name and then re-convert that city
-            # back to a lat-lon.  This normalizes the lat-lon data to a single
-            # point for a city.
-            self.geo += 1
-            return self.geocoder.canonicalize(lat, lon)
+            # The point will be converted to its city name and then that city
+            # re-converted back to a lat-lon.  This normalizes the lat-lon data
+            # to a single point for a city.
+            return (lat, lon), GEO
 
         # Next, check for GeoIP city location
         for post in posts:
@@ -255,8 +300,7 @@ class Davis_Jr_et_al_Method(GIMethod):
             # NOTE: we should probably check that lat/lon is within the bounding
             # box that Twitter provides, otherwise it's an error and we should
             # pick somethign like the mid-point of the bounding box.
-            self.geoip += 1
-            return self.geocoder.geocode(location_name)
+            return self.geocoder.geocode(location_name), GEOIP
 
         # Finally, check for a self-reported.  There's no need to iterate over
         # all the posts for this, since the self-reported location is mostly
@@ -283,10 +327,7 @@ class Davis_Jr_et_al_Method(GIMethod):
             # for us
             lat_lon = self.geocoder.geocode_noisy(location_name)       
 
-        if not lat_lon is None:
-            self.loc += 1
-
-        return lat_lon
+        return lat_lon, LOC_FIELD
 
         
 
@@ -296,7 +337,7 @@ class Davis_Jr_et_al_Method(GIMethod):
         Reads in the pickled Davis Jr. et al model
         """      
 
-        fh = gzip.open(os.path.join(model_dir, 'user-to-lat-lon.tsv.gz'), 'r')
+        fh = open_file(find_file(os.path.join(model_dir, 'user-to-lat-lon.tsv')), 'r')
         user_id_to_location = {} 
         for line in fh:
             cols = line.split("\t")
@@ -13,7 +13,7 @@ import timeit
 import random
 import time
 import os
-import gzip
+from geolocate.compression import open_file, find_file, model_extension
 
 import numpy as np
 from sklearn.tree import DecisionTreeRegressor
@@ -473,23 +473,22 @@ class FriendlyLocation(GIMethod, network):
 		
 		# this part is D(l, L, P)
 		#print 'fl'
-		for l_k, p_k in self.iter_contacts_inf():
-			if l_k is not None:
-				dist = utils.distance(lloc, l_k)
-				j = self.qntl_map(p_k)
-				if self.stgrEdges[dist] > 0 and self.actEdges[j][dist] > 0:
-					p = float(self.actEdges[j][dist]) / self.stgrEdges[dist]
-				else:
-					p = 0
-				#p = self.p_inf(j, dist)
-				#print 'p'
-				#print p
-					#print 'p'
-					#print p
-					#print 'logp'
-					#print np.log(p)
-				if p > 0:
-					res += np.log(p)
+		contacts = [(l_k, p_k) for l_k, p_k in self.iter_contacts_inf() if l_k is not None]
+		# the distances (in miles) to all of the located contacts at once
+		dists = utils.distances(lloc, [l_k for l_k, p_k in contacts])
+		for (l_k, p_k), dist in zip(contacts, dists):
+			j = self.qntl_map(p_k)
+			if self.stgrEdges[dist] > 0 and self.actEdges[j][dist] > 0:
+				p = float(self.actEdges[j][dist]) / self.stgrEdges[dist]
+			else:
+				p = 0
+			#p = self.p_inf(j, dist)
+			#print 'p'
+			#print p
+			#print 'logp'
+			#print np.log(p)
+			if p > 0:
+				res += np.log(p)
 			# Add the next 7 lines to add the denominator back into the FL equation
 			#try:
 				#p2 = self.allActEdges[dist]/self.stgrEdges[dist]
@@ -630,20 +629,19 @@ class FriendlyLocation(GIMethod, network):
 		#print 'home loc time:'
 		#print len(user_loc_list)
 		#fstgr = open('stgr_edges.tsv', 'w')
-		c = 0
 		LOGGER.debug('sampling stranger edges and actual edges')
-		for uid1, loc1 in user_loc_list:
+		locs = [loc for uid, loc in user_loc_list]
+		for c, (uid1, loc1) in enumerate(user_loc_list):
 			#if c % 100 == 0:
 			#	print c
-			c2 = 0
-			for uid2, loc2 in user_loc_list:
+			# the distances (in miles) to all of the other sampled users at once
+			distances = utils.distances(loc1, locs)
+			for c2, (uid2, loc2) in enumerate(user_loc_list):
 				if not c2 == c:
 					if self.X.has_edge(uid1, uid2):
 						self.actEdgesTuples.append((uid1, uid2))
-					distance = round(utils.distance(loc1, loc2), 1)
+					distance = round(distances[c2], 1)
 					self.stgrEdges[distance] += 1
-				c2 += 1
-			c += 1
 		#for distance in self.stgrEdges:
 		#	fstgr.write(str(distance) + '\t' + str(self.stgrEdges[distance]) + '\n')
 		#fstgr.close()
@@ -716,8 +714,8 @@ class FriendlyLocation(GIMethod, network):
 		self.user_to_loc = self.infer_locs()
 		if model_dir is not None:
 			LOGGER.debug('saving model')
-			filename = os.path.join(model_dir, "user-to-lat-lon.tsv.gz")
-			fh = gzip.open(filename, 'w')
+			filename = os.path.join(model_dir, 'user-to-lat-lon.tsv' + model_extension(settings))
+			fh = open_file(filename, 'w')
 			for user_id, loc in self.user_to_loc.iteritems():
                         	if not loc is None:
 					fh.write("%s\t%s\t%s\n" % (user_id, loc[0], loc[1]))
@@ -728,9 +726,9 @@ class FriendlyLocation(GIMethod, network):
 		return self.model
 
 	def load_model(self, model_dir, settings=None):
-		path_settings = os.path.join(model_dir, "user-to-lat-lon.tsv.gz")
+		path_settings = find_file(os.path.join(model_dir, 'user-to-lat-lon.tsv'))
 		user_to_loc = {}
-		fh = gzip.open(path_settings, "r")
+		fh = open_file(path_settings, "r")
 		for line in fh:
 		    cols = line.split("\t")
 		    user_to_loc[cols[0]] = (float(cols[1]), float(cols[2]))
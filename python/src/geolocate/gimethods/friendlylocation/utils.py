@@ -11,7 +11,7 @@ import math
 
 # import requests
 import numpy as np
-from haversine import haversine
+from geolocate import geodesy
 
 
 def valid_coord(coord):
@@ -34,11 +34,26 @@ def isCoord(loc):
             return coord
     return None
 
+# The Earth radius (km) and miles per km of the haversine package that this
+# method's distances were computed with.  The stranger and actual edges are
+# binned by distance rounded to 0.1 miles, so the distances keep its radius
+# rather than geodesy's mean radius.
+EARTH_RADIUS_KM = 6371
+MILES_PER_KM = 0.621371
+
+# return the haversine distance in km, with the method's Earth radius
+def distance_km(loc1, loc2):
+	return geodesy.distance(loc1, loc2) * (EARTH_RADIUS_KM / geodesy.EARTH_RADIUS_KM)
+
+# return the array of distances in miles from loc to each of locs
+def distances(loc, locs):
+	return geodesy.one_to_many(loc, locs) * (EARTH_RADIUS_KM / geodesy.EARTH_RADIUS_KM * MILES_PER_KM)
+
 # return distance in miles
 def distance(loc1, loc2):
 	if loc1 == None or loc2 == None:
 		return -1
-	return haversine(loc1, loc2, miles=True)
+	return distance_km(loc1, loc2) * MILES_PER_KM
 
 # get random coordinates
 def rand_coord():
@@ -53,12 +68,12 @@ def location_error(true_loc, coord, LocRes):
 	if not true_loc: return 0.0
 	# check if location field contains coordinates
 	#coord = isCoord(text_loc)
-	if coord: return haversine(true_loc, coord)
+	if coord: return distance_km(true_loc, coord)
 	# resolve to lat lon 
 	res = LocRes.reverse_geocode(text_loc.split()[0],text_loc.split()[1])
 	if not res: return 0.0
 	res_val = map(float, res)
-	return haversine(true_loc, res_val)
+	return distance_km(true_loc, res_val)
 
 # create a vector 
 # [ mention relationship, location error, post data, social triangles ]
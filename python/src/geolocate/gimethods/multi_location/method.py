@@ -20,13 +20,12 @@ import numpy as np
 import math
 import logging
 import os
-import random
 from geolocate.geocoder import Geocoder
 from scipy.optimize import curve_fit
-from haversine import haversine
 from geolocate import GIMethod, GIModel
+from geolocate import geodesy
 from collections import Counter, defaultdict
-import gzip
+from geolocate.compression import open_file, find_file, model_extension
 try:
     import cPickle as pickle
 except:
@@ -85,9 +84,9 @@ class MultiLocationMethod(GIMethod):
         if model_dir:
             logger.debug("Storing model in %s" % model_dir)
             MultiLocationMethod.model_dir = model_dir
-            filename = os.path.join(model_dir, 'user-to-lat-lon.tsv.gz')
+            filename = os.path.join(model_dir, 'user-to-lat-lon.tsv' + model_extension(settings))
 
-            fh = gzip.open(filename, 'w')
+            fh = open_file(filename, 'w')
             for user_id, loc in user_id_to_location.iteritems():
                 fh.write("%s\t%s\t%s\n" % (user_id, loc[0], loc[1]))
             fh.close()
@@ -102,7 +101,7 @@ class MultiLocationMethod(GIMethod):
         self.model_dir = model_dir
         user_id_to_location = {}
 	count = 0
-	fh = gzip.open(os.path.join(model_dir, 'user-to-lat-lon.tsv.gz'), 'r')
+	fh = open_file(find_file(os.path.join(model_dir, 'user-to-lat-lon.tsv')), 'r')
         for line in fh:
             cols = line.split("\t")
 	    try:
@@ -236,107 +235,17 @@ class MultiLocation(object):
                 pass
 
     def find_locations(self):
-        users_seen = 1
-        for possible_posts in MultiLocationMethod.dataset.user_iter():
-            users_seen += 1
-            if users_seen % 1000000 == 0:
-                logger.debug("Seen %d users" %users_seen)
+        progress = MultiLocationMethod.dataset.user_progress('Finding location mentions', logger)
+        for possible_posts in MultiLocationMethod.dataset.user_iter(fields=['text']):
+            progress.update()
 
             user_id = possible_posts['user_id']
             posts = possible_posts['posts']
             if len(posts) > 600: posts = posts[-600:]
-            for post in posts:
-
-                #twokenizer may be too computationally expensive here...
-                #text = tokenizer(post['text'])
-                text = post['text'].split()
-                lc_text = []
-                is_upper = []
-                for s in text:
-                    isup = s[0].isupper()
-                    is_upper.append(isup)
-                    if isup:
-                        lc_text.append(s.lower())
-                    else:
-                        lc_text.append(s)
-
-                i = 0
-                n = len(text)
-                while True:
-                    if i >= n:
-                        break
-
-                    if not is_upper[i]:
-                        i += 1
-                        continue
-
-                    is_up1 = i + 1 < n and is_upper[i+1]
-                    first_two_with_space = None
-                    first_two_with_tab = None
-
-                    if i + 2 < n and is_upper[i+2] and is_up1:
-                        w1 = lc_text[i]
-                        w2 = lc_text[i+1]
-                        w3 = lc_text[i+2]
-
-                        first_two_with_space = w1 + " " + w2
-                        s2 = first_two_with_space + " " + w3
-                        location = self.geocoder.geocode(s2)
-                        if not location is None:
-                            self.record_user_location(s2, location, user_id)
-                            i += 3
-                            continue
-
-                        s3 = first_two_with_space + "\t" + w3
-                        location = self.geocoder.geocode(s3)
-                        if not location is None:
-                            self.record_user_location(s3, location, user_id)
-                            i += 3
-                            continue
-
-                        first_two_with_tab = w1 + "\t" + w2
-                        s4 = first_two_with_tab + "\t"  + w3
-                        location = self.geocoder.geocode(s4)
-                        if not location is None:
-                            self.record_user_location(s4, location, user_id)
-                            i += 3
-                            continue
-
-                        s5 = first_two_with_tab + " " + w3
-                        location = self.geocoder.geocode(s5)
-                        if not location is None:
-                            self.record_user_location(s5, location, user_id)
-                            i += 3
-                            continue
-
-                    elif i + 1 < n and is_up1:
-                        w1 = lc_text[i]
-                        w2 = lc_text[i+1]
-
-                        if first_two_with_tab is None:
-                            first_two_with_tab = w1 + "\t" + w2
-
-                        location = self.geocoder.geocode(first_two_with_tab)
-                        if not location is None:
-                            self.record_user_location(first_two_with_tab, location, user_id)
-                            i += 2
-                            continue
-
-                        if first_two_with_space is None:
-                            first_two_with_space = w1 + " " + w2
-                        location = self.geocoder.geocode(first_two_with_space)
-                        if not location is None:
-                            self.record_user_location(first_two_with_space, location, user_id)
-                            i += 2
-                            continue
-
-                    else:
-                        w1 = lc_text[i]
-                        location = self.geocoder.geocode(w1)
-                        if not location is None:
-                            self.record_user_location(w1, location, user_id)
-
-                    i += 1
+            for mentions in self.geocoder.find_mentions_many([post['text'] for post in posts],
+                                                             capitalized_only=True):
+                for start, end, location_name, location in mentions:
+                    self.record_user_location(location_name, location, user_id)
 
     def record_user_location(self, location_name, location, user_id):
         try:
@@ -351,10 +260,12 @@ class MultiLocation(object):
         return
 
 
-    def compute_coefficients(self):
+    def compute_coefficients(self, n=10000000):
         """
         Computes the coefficients for equation (1) form the paper,
         P(f<i,j>|alpha,beta,x_i,y_i) = beta*distance(x_i,y_i)^alpha
+        from n randomly sampled pairs of users, along with the parameter F_r of
+        the random following model.
         """
 
         def func_to_fit(x, a, b):
@@ -365,30 +276,35 @@ class MultiLocation(object):
 
         # our networks are too large to generate these coefficients on each call...
         # this is about the same number of combinations as shown in the paper...
-        n = 10000000
         #random_sample = random.sample(list(self.u_star),n)
         random_sample = list(self.u_star)
         number_of_users = len(self.u_star)
 
         # processed_combinations = 0
         # start_time = time.time()
+        sample_locations = np.array([self.mention_network.node_data(node) for node in random_sample],
+                                    dtype=np.float64).reshape(-1, 2)
+
         #for node_u, node_v in combinations(random_sample,2):
-        for i in range(0,n):
-            node_u, node_v = (random_sample[random.randint(0,number_of_users-1)],random_sample[random.randint(0,number_of_users-1)])
-            if node_u == node_v: continue
-            # if processed_combinations % 1000000 == 0:
-            #     logger.debug("Took %f to process %d combinations..." % ((time.time() - start_time), processed_combinations))
-            # processed_combinations += 1
-            l_u = self.mention_network.node_data(node_u)
-            l_v = self.mention_network.node_data(node_v)
-            distance = round(haversine(l_u,l_v,miles=True),0)
-            if distance > 10000:
-                continue
-            mentions_per_distance[distance] += 1.0
-            self.N_squared += 1.0
-            if self.mention_network.has_edge(node_u,node_v):
-                following_relationship[distance] += 1.0
-                self.S += 1.0
+        # The pairs are sampled in chunks so that the distances of each chunk
+        # are computed at once
+        chunk_size = 1000000
+        for start in range(0,n,chunk_size):
+            us = np.random.randint(0,number_of_users,min(chunk_size,n - start))
+            vs = np.random.randint(0,number_of_users,len(us))
+            distances = np.round(geodesy.pairwise(sample_locations[us],sample_locations[vs],miles=True),0)
+            for u, v, distance in zip(us,vs,distances):
+                if u == v: continue
+                # if processed_combinations % 1000000 == 0:
+                #     logger.debug("Took %f to process %d combinations..." % ((time.time() - start_time), processed_combinations))
+                # processed_combinations += 1
+                if distance > 10000:
+                    continue
+                mentions_per_distance[distance] += 1.0
+                self.N_squared += 1.0
+                if self.mention_network.has_edge(random_sample[u],random_sample[v]):
+                    following_relationship[distance] += 1.0
+                    self.S += 1.0
 
         x = list(sorted([key for key in mentions_per_distance]))
         x[0] += 1e-8
@@ -407,6 +323,10 @@ class MultiLocation(object):
 
         self.alpha = solutions[0]
         self.beta = solutions[1]
+
+        #self.N_squared = len(self.mention_network.edges_())
+        #p(f<i,j> = 1 | F_r) = S / N^2
+        self.F_r = (self.S / self.N_squared)
         return
 
 
@@ -450,7 +370,7 @@ class MultiLocation(object):
             Calculates the probability, P(f<i,j>|alpha,beta,location_1,location_2)
             """
             try:
-                return self.beta * (abs(haversine(l_u, l_v))) ** (self.alpha)
+                return self.beta * (abs(geodesy.distance(l_u, l_v))) ** (self.alpha)
             except:
                 #this needs to be changed to a very small value....
                 return self.beta * (0.00000001) ** self.alpha
@@ -540,10 +460,6 @@ class MultiLocation(object):
 
         logger.debug("Finished finding venue data! %d venues found!" % len(self.venues))
 
-        #self.N_squared = len(self.mention_network.edges_())
-        #p(f<i,j> = 1 | F_r) = S / N^2
-        self.F_r = (self.S / self.N_squared)
-
         #Section 4.4, generate model selector based on bernoulli distributions using T_r and F_r
         logger.debug("Generating model selectors...")
         self.generate_model_selector()
@@ -587,33 +503,17 @@ class MultiLocation(object):
         if n < 2:
             return locations[np.random.randint(0, n)]
 
-        min_distance_sum = 10000000
-        median = None  # Point type
-
-        # Loop through all the points, finding the point that minimizes the
-        # geodetic distance to all other points.  By construction median will
-        # always be assigned to some non-None value by the end of the loop.
-        for i in range(0, n):
-            p1 = locations[i]
-            dist_sum = 0
-            for j in range(0, n):
-                p2 = locations[j]
-                # Skip self-comparison
-                if i == j:
-                    continue
-                dist = haversine(p1, p2)
-                dist_sum += dist
-
-                # Short-circuit early if it's clear that this point cannot be
-                # the median since it does not minimize the distance sum
-                if dist_sum > min_distance_sum:
-                    break
-
-            if dist_sum < min_distance_sum:
-                min_distance_sum = dist_sum
-                median = p1
-
-        return median
+        # Find the point that minimizes the geodetic distance to all other
+        # points (its distance to itself is zero), summing the distances of a
+        # chunk of points at a time
+        points = np.asarray(locations, dtype=np.float64)
+        dist_sums = np.empty(n)
+        rows = max(1, geodesy.DEFAULT_CHUNK_SIZE // n)
+        for start in range(0, n, rows):
+            dist_sums[start:start + rows] = geodesy.many_to_many(points[start:start + rows], points).sum(axis=1)
+
+        # Ties go to the first of the points, as np.argmin returns it
+        return locations[int(np.argmin(dist_sums))]
     
 
 
@@ -0,0 +1,158 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Compares the decisions of `has_home` with those of the backtracking search
+it replaced, on a sample of the users of a dataset, and times both.  The
+backtracking search takes exponential time in the worst case, so users with
+more than `--max_points` GPS points are only given to `has_home`.
+
+  python -m geolocate.gimethods.spatial_label_propagation.compare_homes <dataset_dir>
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from geopy import distance
+
+from geolocate.sparse_dataset import SparseDataset
+from geolocate.gimethods.spatial_label_propagation.method import \
+    HOME_MIN_POINTS, get_gps_locations, has_home
+
+def reference_has_home(locations):
+    """
+    Returns True if the locations contain a subset of at least five points
+    that are all within 15km of each other.  This is the backtracking search
+    that `has_home` replaced, kept as it was, with its geopy distances.
+    """
+    
+    n = len(locations)
+    cur_locs = []
+    for i in range(0, n-4):
+        # Try adding the next location to start the search
+        cur_locs.append(locations[i])
+        for j in range(i+1, n):
+            # If we recursively find a match starting from the current seed,
+            # return success
+            if reference_can_find_home_match(cur_locs, locations, j, n):
+                return True
+        # Otherwise, remove the current seed and see if a different location
+        # can be a member a subset matching the desired constraints
+        cur_locs.pop()
+    return False
+
+def reference_can_find_home_match(cur_locs, locations, next_index, n):
+    """
+    Searches the list of locations to see if some combination of locations
+    starting at next_index can be added to the locations currently in
+    cur_locs that satisfy the constraint that all locations in cur_locs
+    must be at most 15km from each other.  If 5 such points are found,
+    return success
+    """
+
+    # The next location to test
+    loc2 = locations[next_index]
+
+    # Check that the next point that could be added (at next_index) would
+    # satisfy the distance requirement with the current location group
+    for loc1 in cur_locs:
+        if reference_get_distance(loc1, loc2) > 15:
+            return False
+
+    # Push on the next location, to see if we can meet the requirements
+    # while it is a member of the group
+    cur_locs.append(locations[next_index])
+
+    # If we have 5 locations that are all within 15km, return success!
+    if len(cur_locs) == 5:
+        return True
+
+    # Search the remaining locations to see if some combination can satisfy
+    # the requirements when this new location is added to the group
+    for j in range(next_index+1, n):
+        if reference_can_find_home_match(cur_locs, locations, j, n):
+            return True
+
+    # Remove the last item added since no match could be found when it is a
+    # member of the current location group
+    cur_locs.pop()        
+    return False
+
+def reference_get_distance(p1, p2):
+    """
+    Computes the distance between the two latitude-longitude Points using
+    Vincenty's Formula
+    """
+    return distance.distance(p1, p2).kilometers
+
+def sample_users(dataset, num_users, seed=None):
+    """
+    Returns a list of (user id, GPS locations) of a uniform sample of the
+    users with at least five GPS locations.
+    """
+    rng = random.Random(seed)
+    sample = []
+    seen = 0
+    for user in dataset.user_iter(fields=['coordinates']):
+        locations = get_gps_locations(user['posts'])
+        if len(locations) < HOME_MIN_POINTS:
+            continue
+        seen += 1
+        if len(sample) < num_users:
+            sample.append((user['user_id'], locations))
+        else:
+            i = rng.randint(0, seen - 1)
+            if i < num_users:
+                sample[i] = (user['user_id'], locations)
+    return sample
+
+def main():
+    parser = argparse.ArgumentParser(description='compare has_home with the backtracking search it replaced')
+    parser.add_argument('-u','--users',type=int,default=1000,
+                        help='the number of users with at least five GPS points to sample')
+    parser.add_argument('-m','--max_points',type=int,default=100,
+                        help='the most GPS points of a user given to the backtracking search')
+    parser.add_argument('-s','--seed',type=int,default=None)
+    parser.add_argument('dataset_dir',help='the directory of the dataset')
+    args = parser.parse_args()
+
+    sample = sample_users(SparseDataset(args.dataset_dir), args.users, args.seed)
+    compared = 0
+    homes = 0
+    disagreements = []
+    new_time = 0.0
+    compared_time = 0.0
+    reference_time = 0.0
+    for user_id, locations in sample:
+        start = time.time()
+        decision = has_home(locations)
+        elapsed = time.time() - start
+        new_time += elapsed
+        homes += decision
+        if len(locations) > args.max_points:
+            continue
+        start = time.time()
+        reference = reference_has_home(locations)
+        reference_time += time.time() - start
+        compared_time += elapsed
+        compared += 1
+        if reference != decision:
+            disagreements.append((user_id, len(locations), reference, decision))
+
+    print('Sampled %d users, %d with a home; compared %d with at most %d points'
+          % (len(sample), homes, compared, args.max_points))
+    print('has_home took %.2f seconds (%.2f on the users compared), the backtracking search %.2f seconds'
+          % (new_time, compared_time, reference_time))
+    print('%d disagreements' % len(disagreements))
+    for user_id, num_points, reference, decision in disagreements:
+        print('\t%s (%d points): backtracking %s, has_home %s' % (user_id, num_points, reference, decision))
+    if disagreements:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
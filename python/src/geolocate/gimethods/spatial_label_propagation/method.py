@@ -6,15 +6,19 @@
 
 import codecs
 import collections
+import heapq
 import json
+import math
 import operator
 import random
 import logging
 from geopy.point import Point
-from geopy import distance
 import os.path
 import itertools
-import gzip
+from geolocate.compression import open_file, find_file
+from geolocate import geodesy
+
+import numpy
 
 from multiprocessing import Process, Queue, cpu_count
 from Queue import Full as QueueFull
@@ -27,6 +31,23 @@ import multiprocessing
 
 logger = logging.getLogger(os.path.basename(__file__))
 
+# A user has a home location if at least this many of their GPS points are
+# all within this many km of each other
+HOME_MIN_POINTS = 5
+HOME_MAX_DISTANCE_KM = 15
+
+# The side of the cubes of the grid over which has_home searches for nearby
+# points, small enough that the diagonal of a cube is under
+# HOME_MAX_DISTANCE_KM
+HOME_CELL_KM = 8.5
+
+# The offsets of the cells after a cell in the grid that may hold points
+# within HOME_MAX_DISTANCE_KM of its points
+_HOME_CELL_REACH = int(math.ceil(HOME_MAX_DISTANCE_KM / HOME_CELL_KM))
+_HOME_CELL_OFFSETS = [offset for offset in itertools.product(
+                          range(-_HOME_CELL_REACH, _HOME_CELL_REACH + 1), repeat=3)
+                      if offset > (0, 0, 0)]
+
 time_per_infer_user = 0
 num_users_inferred = 0
 time_per_geometric_median = 0
@@ -88,61 +109,90 @@ class SpatialLabelPropagation(GIMethod):
         """
         
         logger.debug('Loading mention network')
-        mention_network = dataset.bi_mention_network()
-        all_users = set(mention_network.nodes())
+        mention_network = dataset.bi_mention_network(csr=True)
         print('Loaded network with %d users and %d edges' 
                      % (mention_network.__len__(), mention_network.size()))
 
-        # This dict will contain a mapping from each user ID associated with at
-        # least 5 posts within a 15km radius to the user's home location
+        # Users are identified by their index in the dataset's id table, which
+        # lets all the per-user state below live in flat arrays.  Each user
+        # associated with at least 5 posts within a 15km radius has their home
+        # location recorded in home_lat/home_lon.
         print('Loading known user locations')
-        user_to_home_loc = {user: loc for (user, loc) in dataset.user_home_location_iter()}
+        home_users, home_lats, home_lons = dataset.user_home_locations()
 
-        print('Loaded gold-standard locations of %s users (%s)' 
-                     % (len(user_to_home_loc), 
-                        float(len(user_to_home_loc)) / len(all_users)))
+        user_ids = dataset.user_ids()
+        n = len(user_ids)
+        is_home = numpy.zeros(n, dtype=bool)
+        is_home[home_users] = True
+        home_lat = numpy.full(n, numpy.nan)
+        home_lon = numpy.full(n, numpy.nan)
+        home_lat[home_users] = home_lats
+        home_lon[home_users] = home_lons
 
-        # This dictionary is where we currently think a user is.  The subset of
-        # users with known GPS-based home locations will always have their
-        # gold-standard location set in this dict (i.e., it's not an estimate)
-        user_to_estimated_location = {}
+        #not sure if below line should be included
+        all_users = numpy.union1d(mention_network.nodes_(), home_users)
+        num_users = len(all_users)
 
-        # Update the initial data with the gold standard data
-        user_to_estimated_location.update(user_to_home_loc)
+        print('Loaded gold-standard locations of %s users (%s)' 
+                     % (is_home.sum(), float(is_home.sum()) / num_users))
+
+        # This is where we currently think a user is, with NaN for users who
+        # are not yet located.  The subset of users with known GPS-based home
+        # locations will always have their gold-standard location set here
+        # (i.e., it's not an estimate)
+        est_lat = home_lat.copy()
+        est_lon = home_lon.copy()
 
-        # This dictionary is the next prediction of where we think a user is
-        # based on its neighbors.  This dict is separate from the current
-        # estiamte to avoid mixing the two estimates during inference time.
-        user_to_next_estimated_location = {}
+        # This is the next prediction of where we think a user is based on its
+        # neighbors.  These are kept separate from the current estimate to
+        # avoid mixing the two estimates during inference time.
+        next_lat = numpy.full(n, numpy.nan)
+        next_lon = numpy.full(n, numpy.nan)
 
         # TODO: make this configurable from the settings varaible
         num_iterations = 5
-        #not sure if below line should be included
-        all_users = all_users | set(user_to_home_loc.keys())
-        
-        num_users = len(all_users)
         
         for iteration in range(0, num_iterations):
             logger.debug('Beginning iteration %s' % iteration)
-            num_located_at_start = len(user_to_estimated_location)
+            num_located_at_start = numpy.count_nonzero(~numpy.isnan(est_lat))
             num_processed = 0
-            for user_id in all_users:
-                self.update_user_location(user_id, mention_network, 
-                                          user_to_home_loc,
-                                          user_to_estimated_location,
-                                          user_to_next_estimated_location)
+            for user_idx in all_users:
+                # Short-circuit if we already know where this user is located
+                # so that we always preserve the "hint" going forward
+                if is_home[user_idx]:
+                    next_lat[user_idx] = home_lat[user_idx]
+                    next_lon[user_idx] = home_lon[user_idx]
+                else:
+                    median = self.estimate_user_location(user_idx, mention_network,
+                                                         est_lat, est_lon)
+                    if not median is None:
+                        next_lat[user_idx] = median[0]
+                        next_lon[user_idx] = median[1]
                 num_processed += 1
                 if num_processed % 100000 == 0:
                     print('In iteration %d, processed %d users out of %d, located %d'
-                                 % (iteration, num_processed, num_users, len(user_to_next_estimated_location)))
-            num_located_at_end = len(user_to_next_estimated_location)
+                                 % (iteration, num_processed, num_users,
+                                    numpy.count_nonzero(~numpy.isnan(next_lat))))
+            located = ~numpy.isnan(next_lat)
+            num_located_at_end = numpy.count_nonzero(located)
             print('At end of iteraition %s, located %s users (%s new)' %
                          (iteration, num_located_at_end,
                           num_located_at_end - num_located_at_start))
 
             # Replace all the old location estimates with what we estimated
             # from this iteration
-            user_to_estimated_location.update(user_to_next_estimated_location)
+            est_lat[located] = next_lat[located]
+            est_lon[located] = next_lon[located]
+
+        # Convert the arrays back into the user-id keyed dicts the caller expects
+        user_to_home_loc = {}
+        for user_idx in home_users:
+            user_to_home_loc[user_ids.user_id(user_idx)] = \
+                (home_lat[user_idx], home_lon[user_idx])
+        user_to_estimated_location = {}
+        for user_idx in numpy.flatnonzero(~numpy.isnan(est_lat)):
+            user_to_estimated_location[user_ids.user_id(user_idx)] = \
+                (est_lat[user_idx], est_lon[user_idx])
 
         logger.info("Saving model (%s locations) to %s" 
                     % (len(user_to_estimated_location), model_dir))
@@ -166,40 +216,33 @@ class SpatialLabelPropagation(GIMethod):
         return SpatialLabelPropagationModel(user_to_estimated_location)            
 
 
-    def update_user_location(self, user_id, mention_network,
-                             user_to_home_loc, user_to_estimated_location,
-                             user_to_next_estimated_location):
+    def estimate_user_location(self, user_idx, mention_network, est_lat, est_lon):
         """
-        Uses the provided social network and estimated user locations to update
-        the location of the specified user_id in the
-        user_to_next_estimated_location dict.  Users who have a home location
-        (defined from GPS data) will always be updated with their home location.
+        Uses the provided social network and the current estimated locations
+        (indexed by interned user index, NaN if unknown) to estimate the
+        location of the specified user, returning None if none of the user's
+        neighbors have a location.
         """
 
-        # Short-circuit if we already know where this user is located
-        # so that we always preserve the "hint" going forward
-        if user_id in user_to_home_loc:
-            user_to_next_estimated_location[user_id] = user_to_home_loc[user_id]
-            return
-
         # For each of the users in the user's ego network, get their estimated
         # location, if any
-        locations = []
-        for neighbor_id in mention_network.neighbors_iter(user_id):
-            if neighbor_id in user_to_estimated_location:
-                locations.append(user_to_estimated_location[neighbor_id])
-
+        if not mention_network.has_node_(user_idx):
+            return None
+        neighbors = mention_network.neighbors_(user_idx)
+        neighbors = neighbors[~numpy.isnan(est_lat[neighbors])]
 
         # If we have at least one location from the neighbors, use the
         # list of locations to infer a location for this individual.
-        if len(locations) > 0:
+        if len(neighbors) > 0:
+            locations = zip(est_lat[neighbors], est_lon[neighbors])
             # NOTE: the median here could be replaced by any number of
             # functions (some of which we tried in the ICWSM paper).
             # For example, the social density method that Derek
             # suggested would replace the geometric median here as how
             # we estimate a user's location from their neighbors.
-            median = get_geometric_median(locations)
-            user_to_next_estimated_location[user_id] = median
+            return get_geometric_median(locations)
+        return None
+
 
     def load_model(self, model_dir, settings):
         """
@@ -208,7 +251,7 @@ class SpatialLabelPropagation(GIMethod):
         """
         user_id_to_location = {}
 
-        model_file = gzip.open(os.path.join(model_dir, "user-to-lat-lon.tsv.gz"), 'r')
+        model_file = open_file(find_file(os.path.join(model_dir, 'user-to-lat-lon.tsv')), 'r')
         for line in model_file:
             cols = line.split("\t")
             user_id = cols[0]
@@ -236,6 +279,24 @@ def get_home_location(posts):
     Returns the estimated home location of this user from their GPS-tagged
     posts, or None if the user could not be associated with any location
     """
+    locations = get_gps_locations(posts)
+
+    # We need at least 5 GPS tweets to infer a reliable home location
+    if len(locations) < HOME_MIN_POINTS:
+        return None
+    
+    # See if we can find at least 5 tweets within 15km of each other
+    if has_home(locations):
+        # Return the center as a proxy for this user's home location
+        return get_geometric_median(locations)
+    else:
+        # Return that the user has no home location
+        return None
+
+def get_gps_locations(posts):
+    """
+    Returns the list of the GPS locations of the posts, as Points
+    """
 
     # The list of observed GPS locations for this user
     locations = []
@@ -264,79 +325,102 @@ def get_home_location(posts):
            
     #logger.debug('Found %s GPS-tagged locations' % len(locations))
     #print 'Found %s GPS-tagged locations' % len(locations)
-
-        # We need at least 5 GPS tweets to infer a reliable home location
-    if len(locations) < 5:
-        return None
-    
-    # See if we can find at least 5 tweets within 15km of each other
-    if has_home(locations):
-        # Return the center as a proxy for this user's home location
-        return get_geometric_median(locations)
-    else:
-        # Return that the user has no home location
-        return None
+    return locations
 
 def has_home(locations):
     """
     Returns True if the locations contain a subset of at least five points
-    that are all within 15km of each other
+    that are all within 15km of each other.
+
+    Points within 15km of each other are also within 15km in a straight
+    line, so they fall in nearby cells of a grid of cubes over their
+    Cartesian coordinates, and distances are only computed between points in
+    nearby cells.  The cubes are small enough that any points sharing one
+    are within 15km of each other, so a user with five points in a cube has
+    a home, and otherwise each point has a bounded number of nearby points.
+    The subset is then searched for as a clique of the graph joining the
+    points within 15km, which takes time polynomial in the number of points.
     """
-    
     n = len(locations)
-    cur_locs = []
-    for i in range(0, n-4):
-        # Try adding the next location to start the search
-        cur_locs.append(locations[i])
-        for j in range(i+1, n):
-            # If we recursively find a match starting from the current seed,
-            # return success
-            if can_find_home_match(cur_locs, locations, j, n):
-                return True
-        # Otherwise, remove the current seed and see if a different location
-        # can be a member a subset matching the desired constraints
-        cur_locs.pop()
-    return False
+    if n < HOME_MIN_POINTS:
+        return False
+    points = numpy.array([(p[0], p[1]) for p in locations], dtype=numpy.float64)
+    xyz = geodesy.cartesian(points[:,0], points[:,1])
+    cells = collections.defaultdict(list)
+    for i, cell in enumerate(numpy.floor(xyz / HOME_CELL_KM).astype(numpy.int64).tolist()):
+        cells[tuple(cell)].append(i)
+    if max(len(members) for members in cells.itervalues()) >= HOME_MIN_POINTS:
+        return True
 
-def can_find_home_match(cur_locs, locations, next_index, n):
+    # Pair the points in each cell with those in the cells after it within
+    # reach, so that each pair is only seen once
+    first = []
+    second = []
+    for (x, y, z), members in cells.iteritems():
+        for i, a in enumerate(members):
+            first.extend([a] * (len(members) - i - 1))
+            second.extend(members[i+1:])
+        for offset in _HOME_CELL_OFFSETS:
+            others = cells.get((x + offset[0], y + offset[1], z + offset[2]))
+            if others is None:
+                continue
+            for a in members:
+                first.extend([a] * len(others))
+                second.extend(others)
+    if not first:
+        return False
+    first = numpy.array(first)
+    second = numpy.array(second)
+    near = ((xyz[first] - xyz[second]) ** 2).sum(axis=1) <= HOME_MAX_DISTANCE_KM ** 2
+    first = first[near]
+    second = second[near]
+    near = geodesy.pairwise(points[first], points[second], metric='vincenty') <= HOME_MAX_DISTANCE_KM
+
+    neighbors = [set() for i in xrange(n)]
+    for a, b in itertools.izip(first[near].tolist(), second[near].tolist()):
+        neighbors[a].add(b)
+        neighbors[b].add(a)
+    return _has_clique(neighbors, HOME_MIN_POINTS)
+
+def _has_clique(neighbors, size):
     """
-    Searches the list of locations to see if some combination of locations
-    starting at next_index can be added to the locations currently in
-    cur_locs that satisfy the constraint that all locations in cur_locs
-    must be at most 15km from each other.  If 5 such points are found,
-    return success
+    Returns True if the graph, given as the set of neighbors of each vertex,
+    has a clique of the specified size.  Each vertex is only extended with
+    its neighbors that come after it in a degeneracy order (repeatedly
+    removing a vertex of the lowest remaining degree), which are at most the
+    degeneracy of the graph, so the search takes O(n * d^(size-1)) time.
     """
-
-    # The next location to test
-    loc2 = locations[next_index]
-
-    # Check that the next point that could be added (at next_index) would
-    # satisfy the distance requirement with the current location group
-    for loc1 in cur_locs:
-        if get_distance(loc1, loc2) > 15:
+    degrees = [len(adjacent) for adjacent in neighbors]
+    heap = [(degree, v) for v, degree in enumerate(degrees)]
+    heapq.heapify(heap)
+    removed = [False] * len(neighbors)
+    later = [None] * len(neighbors)
+    while heap:
+        degree, v = heapq.heappop(heap)
+        if removed[v] or degree != degrees[v]:
+            continue
+        removed[v] = True
+        later[v] = set(u for u in neighbors[v] if not removed[u])
+        for u in later[v]:
+            degrees[u] -= 1
+            heapq.heappush(heap, (degrees[u], u))
+
+    def extend(candidates, remaining):
+        if remaining == 0:
+            return True
+        if len(candidates) < remaining:
             return False
+        for v in candidates:
+            if extend(candidates & later[v], remaining - 1):
+                return True
+        return False
 
-    # Push on the next location, to see if we can meet the requirements
-    # while it is a member of the group
-    cur_locs.append(locations[next_index])
-
-    # If we have 5 locations that are all within 15km, return success!
-    if len(cur_locs) == 5:
-        return True
-
-    # Search the remaining locations to see if some combination can satisfy
-    # the requirements when this new location is added to the group
-    for j in range(next_index+1, n):
-        if can_find_home_match(cur_locs, locations, j, n):
+    for v in xrange(len(neighbors)):
+        if len(later[v]) >= size - 1 and extend(later[v], size - 1):
             return True
-
-    # Remove the last item added since no match could be found when it is a
-    # member of the current location group
-    cur_locs.pop()        
     return False
 
 
-
 def get_geometric_median(coordinates):
     """
     Returns the geometric median of the list of locations.
@@ -351,34 +435,17 @@ def get_geometric_median(coordinates):
     elif n == 2:
         return coordinates[random.randint(0, 1)]
     
-    min_distance_sum = 10000000
-    median = None # Point type
-    
-    # Loop through all the points, finding the point that minimizes the
-    # geodetic distance to all other points.  By construction median will
-    # always be assigned to some non-None value by the end of the loop.
-    for i in range(0, n):
-        p1 = coordinates[i]
-        dist_sum = 0
-        for j in range(0, n):
-
-            # Skip self-comparison
-            if i == j:
-                continue
-
-            p2 = coordinates[j]
-            dist = get_distance(p1, p2)
-            dist_sum += dist
-
-            # Abort early if we already know this isn't the median
-            if dist_sum > min_distance_sum:
-                    break
-
-        if dist_sum < min_distance_sum:
-            min_distance_sum = dist_sum
-            median = p1
+    # Find the point that minimizes the geodetic distance to all other points
+    # (its distance to itself is zero), summing the distances of a chunk of
+    # points at a time.  Ties go to the first of the points.
+    points = [(p[0], p[1]) for p in coordinates]
+    dist_sums = numpy.empty(n)
+    rows = max(1, geodesy.DEFAULT_CHUNK_SIZE // n)
+    for start in range(0, n, rows):
+        dist_sums[start:start + rows] = geodesy.many_to_many(
+            points[start:start + rows], points, metric='vincenty').sum(axis=1)
 
-    return median
+    return coordinates[int(numpy.argmin(dist_sums))]
 
 
 def get_distance(p1, p2):
@@ -386,5 +453,5 @@ def get_distance(p1, p2):
     Computes the distance between the two latitude-longitude Points using
     Vincenty's Formula
     """
-    return distance.distance(p1, p2).kilometers
+    return geodesy.distance(p1, p2, metric='vincenty')
 
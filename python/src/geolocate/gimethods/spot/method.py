@@ -12,16 +12,14 @@ Date Created: September 2014
 """
 
 
-from geopy.distance import vincenty
-from geopy.distance import great_circle
-from haversine import haversine
 from geolocate import GIMethod, GIModel
+from geolocate import geodesy
 from collections import defaultdict
 from scipy.optimize import curve_fit
 import numpy as np
 import sys
 import logging
-import gzip
+from geolocate.compression import open_file, find_file, model_extension
 import os
 try:
     import cPickle as pickle
@@ -88,9 +86,9 @@ class SpotMethod(GIMethod):
         if model_dir:
             logger.debug("Storing the model in %s" % model_dir)
             SpotMethod.model_dir = model_dir
-            filename = os.path.join(model_dir, 'user-to-lat-lon.tsv.gz')
+            filename = os.path.join(model_dir, 'user-to-lat-lon.tsv' + model_extension(settings))
 
-            fh = gzip.open(filename, 'w')
+            fh = open_file(filename, 'w')
             for user_id, loc in user_id_to_location.iteritems():
                 fh.write("%s\t%f\t%f\n" % (user_id, loc[0], loc[1]))
             fh.close()
@@ -107,7 +105,7 @@ class SpotMethod(GIMethod):
         self.model_dir = model_dir
         if settings:
             self.settings = settings
-	fh = gzip.open(os.path.join(model_dir, 'user-to-lat-lon.tsv.gz'), 'r')
+	fh = open_file(find_file(os.path.join(model_dir, 'user-to-lat-lon.tsv')), 'r')
         user_id_to_location = {}
         for line in fh:
             cols = line.split("\t")
@@ -259,14 +257,19 @@ class Spot_Social_Tightness(Spot):
         logger.debug("Calcuating social closeness")
         for user in self.users_with_location:
             user_location = self.mention_network.node_data_(user)
+            friends = []
+            friend_locations = []
             for friend in self.mention_network.neighbors_iter_(user):
                 friend_location = self.mention_network.node_data_(friend)
                 if not friend_location: continue
+                friends.append(friend)
+                friend_locations.append(friend_location)
 
+            distances = np.round(geodesy.one_to_many(user_location,friend_locations),0)
+            for friend, distance in zip(friends, distances):
                 pairs += 1
                 social_closeness = round(self.cosine_similarity(user,friend),2)
                 self.sij[user][friend] = social_closeness
-                distance = round(haversine(user_location,friend_location),0)
                 self.probability_distance_social_closeness[distance][social_closeness] += 1.0
 
         #the normalizing factor is the total number of social_closeness probabilities added above...
@@ -307,13 +310,12 @@ class Spot_Social_Tightness(Spot):
             location_of_neighbor_u = self.mention_network.node_data_(neighbor_u)
             probability = 0
 
-            for neighbor_v in self.mention_network.neighbors_iter_(neighbor_u):
-                if neighbor_v not in location_set: continue
-                location_of_neighbor_v = self.mention_network.node_data_(neighbor_v)
-
-                #to get the dict-lookup correct, we round to the nearest kilometer
-                distance = round(haversine(location_of_neighbor_u,location_of_neighbor_v),0)
-
+            neighbors_v = [neighbor_v for neighbor_v in self.mention_network.neighbors_iter_(neighbor_u)
+                           if neighbor_v in location_set]
+            #to get the dict-lookup correct, we round to the nearest kilometer
+            distances = np.round(geodesy.one_to_many(location_of_neighbor_u,
+                                                     [self.mention_network.node_data_(v) for v in neighbors_v]),0)
+            for neighbor_v, distance in zip(neighbors_v, distances):
                 # "" , round to two significant figures
                 social_closeness = self.sij[neighbor_u][neighbor_v]
                 probability += self.probability_distance_social_closeness[distance][social_closeness]
@@ -476,11 +478,13 @@ class Spot_Energy(Spot):
             rgs = sorted(rgs)
             rcs = sorted(rcs)
 
-            user_location = self.mention_network.node_data(user)
-            best_distance = float('inf')
-            for neighbor_location in rg:
-                if vincenty(neighbor_location[1],user_location).km < best_distance:
-                    self.best_neighbor[user] = neighbor_location[1]
+            # the location of the closest located neighbor, measuring the
+            # distances to all of them at once
+            if rgs:
+                user_location = self.mention_network.node_data(user)
+                distances = geodesy.one_to_many(user_location,[location for rg,location in rgs],
+                                                metric='vincenty')
+                self.best_neighbor[user] = rgs[int(np.argmin(distances))][1]
 
             for rg in rgs:
                 #storing the ranking index number r_G, and r_C, and the location
@@ -553,14 +557,19 @@ class Spot_Energy(Spot):
         """
         #building dr, making ten bins based on social similarity
         distances_by_social_similarity = defaultdict(list)
+        #the distances from each user to all of their friends, computed at once
+        neighbor_distances = {}
         for user in self.users_with_location:
             location_user = self.mention_network.node_data(user)
-            for neighbor in self.mention_network.neighbor_iter(user):
+            neighbors = list(self.mention_network.neighbors(user))
+            distances = geodesy.one_to_many(location_user,
+                                            [self.mention_network.node_data(neighbor) for neighbor in neighbors],
+                                            metric='vincenty')
+            neighbor_distances[user] = (neighbors,distances)
+            for neighbor, distance in zip(neighbors,distances):
                 if user == neighbor:
                     continue
-                location_neighbor = self.mention_network.node_data(neighbor)
                 social_similarity_rounded = round(self.sij[user][neighbor],1) #rounded to one significant figure
-                distance = vincenty(location_user,location_neighbor)
                 distances_by_social_similarity[social_similarity_rounded].append(distance)
         for social_similarity in distances_by_social_similarity:
             distances = distances_by_social_similarity[social_similarity]
@@ -568,19 +577,19 @@ class Spot_Energy(Spot):
 
 
         for user in self.users_with_location:
-            location_user = self.mention_network.node_data(user)
-            for neighbor in self.mention_network.neighbors_iter(user):
-                if not user in self.users_with_location:
-                    continue
-                location_neighbor = self.mention_network.node_data(neighbor)
-
-                social_similarity = self.sij[user][neighbor]
-                #the exponent term, g<u_i,u_j> = -e^(-|l_i - l_j|/d_r)
-                x = - vincenty(location_user,location_neighbor) / self.dr[round(social_similarity,1)]
-                #summing sij * g<u_i,u_j> over all friends
-                #I've factored out a -1 from np.exp(x) and cancelled it with
-                #the leading -1 in the summation.
-                self.g_ui[user] += social_similarity* np.exp(x)
+            #a user who mentioned themselves is counted among their friends here,
+            #but not when building dr
+            neighbors, distances = neighbor_distances[user]
+            if not neighbors:
+                continue
+            social_similarities = np.array([self.sij[user][neighbor] for neighbor in neighbors])
+            drs = np.array([self.dr[round(social_similarity,1)] for social_similarity in social_similarities])
+            #the exponent term, g<u_i,u_j> = -e^(-|l_i - l_j|/d_r)
+            x = - distances / drs
+            #summing sij * g<u_i,u_j> over all friends
+            #I've factored out a -1 from np.exp(x) and cancelled it with
+            #the leading -1 in the summation.
+            self.g_ui[user] += (social_similarities * np.exp(x)).sum()
 
 
     def social_coefficients(self):
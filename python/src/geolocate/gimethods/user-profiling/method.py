@@ -16,11 +16,12 @@ from numpy.random import uniform as un
 import os, os.path
 import logging
 import time
-import gzip
+from geolocate.compression import open_file, find_file, model_extension
 
 from collections import defaultdict
 from geolocate import GIMethod, GIModel
 from geolocate import geocoder
+from geolocate.progress import ProgressLogger
 
 #from twokenize import tokenizeRawTweetText as tokenizer
 
@@ -80,8 +81,8 @@ class UserProfilingMethod(GIMethod):
         if model_dir:
             logger.debug("Storing the model in %s" %model_dir)
 
-            filename = os.path.join(model_dir, 'user-to-lat-lon.tsv.gz')
-            fh = gzip.open(filename, 'w')
+            filename = os.path.join(model_dir, 'user-to-lat-lon.tsv' + model_extension(settings))
+            fh = open_file(filename, 'w')
             for user_id, loc in user_id_to_location.iteritems():
                 fh.write("%s\t%s\t%s\n" % (user_id, loc[0], loc[1]))
             fh.close()
@@ -100,7 +101,7 @@ class UserProfilingMethod(GIMethod):
             self.settings = settings
 
         user_id_to_location = {}
-        model_file = gzip.open(os.path.join(model_dir, "user-to-lat-lon.tsv.gz"), 'r')
+        model_file = open_file(find_file(os.path.join(model_dir, 'user-to-lat-lon.tsv')), 'r')
         for line in model_file:
             line = line.strip()
             cols = line.split("\t")
@@ -219,105 +220,18 @@ class UserProfiling(object):
 
 
     def find_locations(self):
-        users_seen = 1
-        for possible_posts in UserProfilingMethod.dataset.user_iter():
-            users_seen += 1
-            if users_seen % 1000000 == 0:
-                logger.debug("Seen %d users" %users_seen)
+        # Only the posts of users with unknown locations are needed
+        progress = ProgressLogger('Finding location mentions', len(self.U_n), logger)
+        for possible_posts in UserProfilingMethod.dataset.iter_users(self.U_n, fields=['text']):
+            progress.update()
             user_id = possible_posts['user_id']
             if user_id in self.U_n:
                 posts = possible_posts['posts']
                 if len(posts) > 600: posts = posts[-600:]
-                for post in posts:
-                    #twokenizer may be too computationally expensive here...
-                    #text = tokenizer(post['text'])
-                    text = post['text'].split()
-                    lc_text = []
-                    is_upper = []
-                    for s in text:
-                        isup = s[0].isupper()
-                        is_upper.append(isup)
-                        if isup:
-                            lc_text.append(s.lower())
-                        else:
-                            lc_text.append(s)
-                    i = 0
-                    n = len(text)
-                    while True:
-                        if i >= n:
-                            break
-                        if not is_upper[i]:
-                            i += 1
-                            continue
-
-                        is_up1 = i + 1 < n and is_upper[i+1]
-                        first_two_with_space = None
-                        first_two_with_tab = None
-
-                        if i + 2 < n and is_upper[i+2] and is_up1:
-                            w1 = lc_text[i] 
-                            w2 = lc_text[i+1] 
-                            w3 = lc_text[i+2] 
-                            
-                            first_two_with_space = w1 + " " + w2
-                            s2 = first_two_with_space + " " + w3
-                            location = self.geocoder.geocode(s2)
-                            if not location is None:
-                                self.record_user_location(s2, location, user_id)
-                                i += 3
-                                continue
-
-                            s3 = first_two_with_space + "\t" + w3
-                            location = self.geocoder.geocode(s3)
-                            if not location is None:
-                                self.record_user_location(s3, location, user_id)
-                                i += 3
-                                continue
-
-                            first_two_with_tab = w1 + "\t" + w2
-                            s4 = first_two_with_tab + "\t"  + w3
-                            location = self.geocoder.geocode(s4)
-                            if not location is None:
-                                self.record_user_location(s4, location, user_id)
-                                i += 3
-                                continue
-
-                            s5 = first_two_with_tab + " " + w3
-                            location = self.geocoder.geocode(s5)
-                            if not location is None:
-                                self.record_user_location(s5, location, user_id)
-                                i += 3
-                                continue
-
-                        elif i + 1 < n and is_up1:
-                            w1 = lc_text[i] 
-                            w2 = lc_text[i+1] 
-
-                            if first_two_with_tab is None:
-                                first_two_with_tab = w1 + "\t" + w2
-                                
-                            location = self.geocoder.geocode(first_two_with_tab)
-                            if not location is None:
-                                self.record_user_location(first_two_with_tab, location, user_id)
-                                i += 2
-                                continue
-                                                            
-                            if first_two_with_space is None:
-                                first_two_with_space = w1 + " " + w2
-                            location = self.geocoder.geocode(first_two_with_space)
-                            if not location is None:
-                                self.record_user_location(first_two_with_space, location, user_id)
-                                i += 2
-                                continue
-
-                        else:
-                            w1 = lc_text[i]
-                            location = self.geocoder.geocode(w1)
-                            if not location is None:
-                                self.record_user_location(w1, location, user_id)
-                                
-                        i += 1
-
+                for mentions in self.geocoder.find_mentions_many([post['text'] for post in posts],
+                                                                 capitalized_only=True):
+                    for start, end, location_name, location in mentions:
+                        self.record_user_location(location_name, location, user_id)
 
     def record_user_location(self, location_name, location, user_id):
         self.locations.add(location_name)
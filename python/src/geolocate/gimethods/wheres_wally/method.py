@@ -13,7 +13,7 @@ from sklearn import svm
 from sklearn import preprocessing
 import numpy
 import scipy.sparse
-import gzip
+from geolocate.compression import open_file, find_file, model_extension
 import time
 
 
@@ -21,7 +21,7 @@ from collections import defaultdict
 
 from geolocate import GIMethod, GIModel
 
-from geolocate.geocoder import Geocoder
+from geolocate.geocoder import Geocoder, REVERSE_GEOCODE_MAX_KM
 
 
 LOGGER = logging.getLogger(os.path.basename(__file__))
@@ -96,6 +96,12 @@ class Wheres_Wally(GIMethod):
         else:
             self.geocoder = Geocoder()
 
+        # The farthest (in km) that a home location is moved to the
+        # settlement it is canonicalized to
+        max_canonical_distance = REVERSE_GEOCODE_MAX_KM
+        if 'max_canonical_distance' in settings:
+            max_canonical_distance = float(settings['max_canonical_distance'])
+
 
         # NOTE: The original paper used the directional friends/followers
         # network.  However, the paper was tested on a much smaller network
@@ -104,7 +110,9 @@ class Wheres_Wally(GIMethod):
         # stronger signal of social relationships and (2) significantly reduce
         # the memory requirement.
         LOGGER.debug('Loading mention network')        
-        mention_network = dataset.bi_mention_network()
+        # The features only need degrees, neighbors and edge lookups, which
+        # the memory-mapped CSR graph answers without a zen copy
+        mention_network = dataset.bi_mention_network(csr=True)
 
         # This dict will contain a mapping from user ID to an associated home
         # location, which is derived either from the location field (as in the
@@ -122,18 +130,25 @@ class Wheres_Wally(GIMethod):
         # this down to only the most common locations
         location_counts = collections.Counter() 
 
+        home_user_ids = []
+        home_locs = []
         for user_id, home_loc in dataset.user_home_location_iter():
             
             if not user_id in all_users:
                 continue
-            
-            # home_loc is a (lat,lon) tuple.  While this is accurate, we want to
-            # coarsen the location data to decrease sparsity (i.e., more people
-            # located in the same city location, despite slightly different
-            # underlying lat/lon values).  Here, use the Geocoder to map the
-            # lat/lon to a name and then back to a canonical lat/lon for that
-            # name           
-            canonical_lat_lon = self.geocoder.canonicalize(home_loc[0], home_loc[1])
+            home_user_ids.append(user_id)
+            home_locs.append(home_loc)
+
+        # home_loc is a (lat,lon) tuple.  While this is accurate, we want to
+        # coarsen the location data to decrease sparsity (i.e., more people
+        # located in the same city location, despite slightly different
+        # underlying lat/lon values).  Here, use the Geocoder to map the
+        # lat/lon to a name and then back to a canonical lat/lon for that
+        # name, for all of the users at once
+        canonical_lat_lons = self.geocoder.canonicalize_many(home_locs, max_canonical_distance)[0]
+
+        for user_id, canonical_lat_lon in zip(home_user_ids, canonical_lat_lons.tolist()):
+            canonical_lat_lon = tuple(canonical_lat_lon)
 
             location_counts[canonical_lat_lon] += 1
 
@@ -317,7 +332,7 @@ class Wheres_Wally(GIMethod):
             os.mkdir(model_dir)         
 
         # Write the .tsv for human debugability too
-        fh = gzip.open(os.path.join(model_dir, 'user-to-lat-lon.tsv.gz'), 'w')
+        fh = open_file(os.path.join(model_dir, 'user-to-lat-lon.tsv' + model_extension(settings)), 'w')
         for user_id, loc in self.user_id_to_location.iteritems():
             fh.write("%s\t%s\t%s\n" % (user_id, loc[0], loc[1]));
         fh.close()
@@ -480,7 +495,7 @@ class Wheres_Wally(GIMethod):
         """      
 
         user_id_to_location = {}
-        model_file = gzip.open(os.path.join(model_dir, "user-to-lat-lon.tsv.gz"), 'r')
+        model_file = open_file(find_file(os.path.join(model_dir, 'user-to-lat-lon.tsv')), 'r')
         for line in model_file:
             cols = line.split("\t")
             user_id = cols[0]
@@ -0,0 +1,325 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Builds the users.home-locations.<source>.tsv.gz files of a dataset, which
+`SparseDataset` reads as the ground-truth locations of its users (see
+`load_home_locations`).  The sources are:
+
+  loc-field: the self-reported location field of each user's profile
+      (`user.location` in their posts), geocoded with `Geocoder.geocode_noisy`.
+      Users are streamed from a projection of the users file onto that field,
+      so only one location string per user is kept in memory, and each
+      distinct string is geocoded once by a pool of workers that share the
+      (memory-mapped) gazetteer of the parent process.
+
+  geo-median: the geometric median of the GPS points of each user's posts
+      (see `geometric_median.home_location`).  The users are split among
+      worker processes, which append the median of each user (or an empty
+      row, if it has none) to their part of a checkpoint as soon as it is
+      computed.  A run that is interrupted leaves the checkpoint behind, and
+      the next run skips the users already in it; the home locations file is
+      written from the checkpoint once all of the users are done.
+
+A user with several location strings is represented either by the first one
+seen or by the most frequent one (ties going to the one seen first).
+"""
+
+import os, os.path
+import logging
+import shutil
+import time
+import traceback
+
+from array import array
+from multiprocessing import Process, Queue, cpu_count
+
+import geometric_median
+from compression import open_file
+from geocode_cache import MISSING, GeocodeCache
+from geocoder import Geocoder
+from sparse_dataset import SparseDataset
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# The sources of home locations that build_home_locations can generate
+HOME_LOCATION_SOURCES = ['loc-field', 'geo-median']
+
+# How the location string of a user with several is chosen
+LOCATION_POLICIES = ['first', 'most-frequent']
+
+# The path of the profile location field in a post
+LOCATION_FIELD = 'user.location'
+
+# The fields of a post that hold its GPS coordinates
+GPS_FIELDS = ['geo', 'coordinates']
+
+def home_locations_fname(dataset_dir, source):
+    """
+    Returns the name of the home locations file of the source, which is the
+    file `SparseDataset` reads for `default_location_source=source`.
+    """
+    return os.path.join(dataset_dir, 'users.home-locations.' + source + '.tsv.gz')
+
+def profile_location(user, policy='first'):
+    """
+    Returns the (stripped) location string of the user's profile, chosen
+    from the non-empty location fields of their posts by the policy, or None
+    if none of the posts has one.
+    """
+    counts = {}
+    order = []
+    for post in user['posts']:
+        location = (post.get('user') or {}).get('location')
+        if not location:
+            continue
+        location = location.strip()
+        if not location:
+            continue
+        if policy == 'first':
+            return location
+        if not location in counts:
+            counts[location] = 0
+            order.append(location)
+        counts[location] += 1
+
+    if not order:
+        return None
+    # max() returns the first of the tied strings, which is the first seen
+    return max(order, key=lambda location: counts[location])
+
+def checkpoint_dir(dataset_dir, source):
+    """
+    Returns the name of the directory holding the checkpoint of an unfinished
+    run of the source.
+    """
+    return os.path.join(dataset_dir, '.tmp-users.home-locations.' + source)
+
+def build_home_locations(dataset_dir, source='loc-field', policy='first',
+                         gazetteer='geonames', num_workers=None,
+                         cache_fname=None, snap=True, restart=False):
+    """
+    Writes the home locations file of the source for the dataset and returns
+    a dict of statistics on the users processed.
+
+    For loc-field, the distinct location strings are geocoded by
+    `num_workers` processes (by default, one per core).  If `cache_fname` is
+    specified, the strings geocoded by earlier runs are read from it and the
+    new ones are appended to it (see `GeocodeCache`).
+
+    For geo-median, the medians are computed by `num_workers` processes and
+    are snapped to one of the user's points if `snap` is True.  Users in the
+    checkpoint of an earlier, unfinished run are not recomputed, unless
+    `restart` is True.
+    """
+    if not source in HOME_LOCATION_SOURCES:
+        raise ValueError('unknown home location source: %s' % source)
+    if not policy in LOCATION_POLICIES:
+        raise ValueError('unknown location policy: %s' % policy)
+    if not num_workers:
+        num_workers = cpu_count()
+    if source == 'geo-median':
+        return _build_geo_median_locations(dataset_dir, num_workers, snap, restart)
+
+    start = time.time()
+    dataset = SparseDataset(dataset_dir)
+    geocoder = Geocoder(gazetteer, noisy_cache_fname=cache_fname)
+
+    # Stream the users, keeping only the index of each user's location string
+    num_users = 0
+    user_ids = []
+    location_ids = array('i')
+    location_index = {}
+    locations = []
+    progress = dataset.user_progress('Reading the location fields', logger)
+    for user in dataset.user_iter(fields=[LOCATION_FIELD]):
+        num_users += 1
+        progress.update()
+        location = profile_location(user, policy)
+        if location is None:
+            continue
+        i = location_index.get(location)
+        if i is None:
+            i = len(locations)
+            location_index[location] = i
+            locations.append(location)
+        user_ids.append(user['user_id'])
+        location_ids.append(i)
+    progress.done()
+    location_index = None
+
+    # Geocode the strings that are not already cached
+    points = [geocoder.noisy_cache.get(location) for location in locations]
+    uncached = [i for i, point in enumerate(points) if point is MISSING]
+    num_cached = len(locations) - len(uncached)
+    logger.info('Geocoding %d location strings (%d cached) with %d workers'
+                % (len(uncached), num_cached, num_workers))
+    geocode_start = time.time()
+    geocoded = geocode_parallel(geocoder, [locations[i] for i in uncached], num_workers)
+    geocode_time = time.time() - geocode_start
+    for i, point in zip(uncached, geocoded):
+        points[i] = point
+        geocoder.noisy_cache.put(locations[i], point)
+    geocoder.noisy_cache.close()
+
+    fname = home_locations_fname(dataset_dir, source)
+    tmp_fname = os.path.join(dataset_dir, '.tmp-' + os.path.basename(fname))
+    num_located = 0
+    with open_file(tmp_fname, 'w') as fh:
+        fh.write('user_id\tlat\tlon\n')
+        for user_id, i in zip(user_ids, location_ids):
+            point = points[i]
+            if point is None:
+                continue
+            fh.write('%s\t%s\t%s\n' % (user_id, repr(point[0]), repr(point[1])))
+            num_located += 1
+    os.rename(tmp_fname, fname)
+
+    elapsed = max(time.time() - start, 1e-6)
+    stats = { 'users': num_users, 'with_location': len(user_ids),
+              'located': num_located, 'names': len(locations),
+              'cached': num_cached, 'geocoded': len(uncached),
+              'located_names': sum(1 for point in points if point is not None),
+              'seconds': elapsed, 'users_per_sec': num_users / elapsed,
+              'names_per_sec': len(uncached) / max(geocode_time, 1e-6),
+              'hit_rate': num_located / float(max(len(user_ids), 1)),
+              'cache_hit_rate': num_cached / float(max(len(locations), 1)) }
+    logger.info('Wrote the home locations of %d of %d users to %s'
+                % (num_located, num_users, fname))
+    return stats
+
+def _build_geo_median_locations(dataset_dir, num_workers, snap, restart):
+    start = time.time()
+    dataset = SparseDataset(dataset_dir)
+    checkpoint = checkpoint_dir(dataset_dir, 'geo-median')
+    if restart and os.path.exists(checkpoint):
+        shutil.rmtree(checkpoint)
+    if not os.path.exists(checkpoint):
+        os.makedirs(checkpoint)
+    done = read_checkpoint(checkpoint)
+    num_resumed = len(done)
+    logger.info('Computing the geometric medians of the users with %d workers '
+                '(%d done by an earlier run)' % (num_workers, num_resumed))
+
+    # Each process appends to its own part of the checkpoint, named by the
+    # start of this run so that no part of an earlier run is appended to
+    run = '%d' % (start * 1000)
+    parts = {}
+    def compute_median(user):
+        # The ids read from the checkpoint are strings
+        user_id = '%s' % user['user_id']
+        if user_id in done:
+            return None
+        pid = os.getpid()
+        fh = parts.get(pid)
+        if fh is None:
+            # Line buffered, so each row is in the file once it is written,
+            # even if the process is killed
+            fh = open(os.path.join(checkpoint, 'part-%s-%d.tsv' % (run, pid)), 'a', 1)
+            parts[pid] = fh
+        point = geometric_median.home_location(geometric_median.gps_points(user),
+                                               snap, user_id=user_id)
+        if point is None:
+            fh.write('%s\t\t\n' % user_id)
+        else:
+            fh.write('%s\t%s\t%s\n' % (user_id, repr(float(point[0])), repr(float(point[1]))))
+        return None
+
+    try:
+        dataset.map_users(compute_median, fields=GPS_FIELDS, num_workers=num_workers)
+    finally:
+        for fh in parts.values():
+            fh.close()
+    done = read_checkpoint(checkpoint)
+
+    fname = home_locations_fname(dataset_dir, 'geo-median')
+    tmp_fname = os.path.join(dataset_dir, '.tmp-' + os.path.basename(fname))
+    num_located = 0
+    with open_file(tmp_fname, 'w') as fh:
+        fh.write('user_id\tlat\tlon\n')
+        for user_id, point in done.iteritems():
+            if point is None:
+                continue
+            fh.write('%s\t%s\t%s\n' % (user_id, repr(point[0]), repr(point[1])))
+            num_located += 1
+    os.rename(tmp_fname, fname)
+    shutil.rmtree(checkpoint)
+
+    elapsed = max(time.time() - start, 1e-6)
+    num_computed = len(done) - num_resumed
+    stats = { 'users': len(done), 'located': num_located,
+              'resumed': num_resumed, 'computed': num_computed,
+              'seconds': elapsed, 'users_per_sec': num_computed / elapsed,
+              'hit_rate': num_located / float(max(len(done), 1)) }
+    logger.info('Wrote the home locations of %d of %d users to %s'
+                % (num_located, len(done), fname))
+    return stats
+
+def read_checkpoint(checkpoint):
+    """
+    Returns the dict from the id of each user in the parts of the checkpoint
+    directory to their (lat, lon) home location, or None if they have none.
+    The last row of a part is ignored if its process was killed while writing
+    it.
+    """
+    done = {}
+    for part in sorted(os.listdir(checkpoint)):
+        with open(os.path.join(checkpoint, part), 'r') as fh:
+            for line in fh:
+                if not line.endswith('\n'):
+                    continue
+                user_id, lat, lon = line[:-1].split('\t')
+                done[user_id] = (float(lat), float(lon)) if lat else None
+    return done
+
+def geocode_parallel(geocoder, names, num_workers):
+    """
+    Returns the list of the results of `geocoder.geocode_noisy` for the
+    names, which are split among `num_workers` forked processes.
+    """
+    num_workers = max(1, min(num_workers, len(names) // 1000 + 1))
+    if num_workers == 1:
+        return _geocode(geocoder, names)
+
+    results = Queue()
+    workers = [Process(target=_geocode_worker,
+                       args=(results, geocoder, worker_id, names[worker_id::num_workers]))
+               for worker_id in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    # Results must be read before joining, or the workers could block on a
+    # full queue
+    points = [None] * len(names)
+    failed = False
+    for worker in workers:
+        worker_id, worker_points = results.get()
+        if worker_points is None:
+            failed = True
+        else:
+            points[worker_id::num_workers] = worker_points
+    for worker in workers:
+        worker.join()
+    if failed:
+        raise Exception('a worker failed while geocoding the location strings')
+    return points
+
+def _geocode(geocoder, names):
+    # The names are distinct, so there is nothing for the noisy cache to
+    # reuse, and the parent process writes the results to its file
+    noisy_cache = geocoder.noisy_cache
+    geocoder.noisy_cache = GeocodeCache(0)
+    try:
+        return geocoder.geocode_noisy_many(names)
+    finally:
+        geocoder.noisy_cache = noisy_cache
+
+def _geocode_worker(results, geocoder, worker_id, names):
+    try:
+        results.put((worker_id, _geocode(geocoder, names)))
+    except:
+        traceback.print_exc()
+        results.put((worker_id, None))
@@ -0,0 +1,173 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Helpers for building the mention network edge lists of a dataset from
+aggregated integer edge arrays.  Users are interned into a `UserIdTable`, and
+each directed edge (src, dst) is encoded as the int64 key (src << 32) | dst.
+Keeping the distinct keys sorted, along with the number of mentions behind
+each, lets edges be merged with `numpy.unique` and the reverse of an edge be
+found by binary search.  Edges are aggregated a chunk at a time into sorted
+runs, which are merged with `add_run` and reduced once with `merge_runs`.
+"""
+
+import os, os.path
+import logging
+
+from array import array
+from itertools import izip
+
+import numpy
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# The number of edges formatted at a time when writing an edge list
+ELIST_CHUNK_SIZE = 1 << 18
+
+# The edge lists written by `write_mention_networks`
+MENTION_NETWORK_FILES = ['mention_network.elist',
+                         'bi_mention_network.elist',
+                         'bi_mention_network.weighted.elist',
+                         'bi_mention_network.directed.weighted.elist']
+
+def empty_edges():
+    """
+    Returns the (edges, weights) arrays with no edges.
+    """
+    return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+def as_int64(values):
+    """
+    Returns the int array, which may be an `array.array`, as an int64 array.
+    """
+    if isinstance(values, array):
+        values = numpy.frombuffer(values, dtype=values.typecode)
+    return numpy.asarray(values, dtype=numpy.int64)
+
+def aggregate_edges(srcs, dsts, counts=None):
+    """
+    Returns the sorted distinct edges of the (src, dst) pairs, which are given
+    as int arrays, and the number of mentions behind each.  Each pair counts
+    as one mention unless `counts` is specified.
+    """
+    if len(srcs) == 0:
+        return empty_edges()
+    edges = (as_int64(srcs) << 32) | as_int64(dsts)
+    if counts is None:
+        edges, weights = numpy.unique(edges, return_counts=True)
+        return edges, weights.astype(numpy.int64)
+    return merge_runs([(edges, as_int64(counts))])
+
+def merge_runs(runs):
+    """
+    Returns the sorted distinct edges of the (edges, weights) runs and the
+    total weight of each, in one reduction over all of the runs.
+    """
+    runs = [run for run in runs if len(run[0]) > 0]
+    if len(runs) == 0:
+        return empty_edges()
+    if len(runs) == 1 and numpy.all(runs[0][0][1:] > runs[0][0][:-1]):
+        return runs[0]
+    all_edges = numpy.concatenate([edges for edges, weights in runs])
+    all_weights = numpy.concatenate([weights for edges, weights in runs])
+    edges, inverse = numpy.unique(all_edges, return_inverse=True)
+    weights = numpy.bincount(inverse, weights=all_weights).astype(numpy.int64)
+    return edges, weights
+
+def add_run(runs, run):
+    """
+    Appends the (edges, weights) run to the list of runs, first merging it
+    with the runs at the end of the list that are no more than twice its
+    size.  The runs then shrink geometrically along the list, so there are
+    only logarithmically many of them and each edge is merged
+    logarithmically many times, however many chunks are added.
+    """
+    if len(run[0]) == 0:
+        return
+    while runs and len(runs[-1][0]) <= 2 * len(run[0]):
+        run = merge_runs([runs.pop(), run])
+    runs.append(run)
+
+def read_edges(elist_fname, user_ids):
+    """
+    Returns the sorted distinct (edges, weights) of the weighted, directed
+    edge list (such as a dataset's `mention_network.elist`).  The users are
+    interned into `user_ids`.  Weights may be written as floats (e.g., 1.0),
+    but are read as the integer mention counts `write_elist` writes.
+    """
+    intern = user_ids.intern
+    srcs = array('i')
+    dsts = array('i')
+    counts = array('l')
+    with open(elist_fname, 'r') as fh:
+        for line in fh:
+            cols = line.split()
+            if len(cols) < 2:
+                continue
+            srcs.append(intern(cols[0]))
+            dsts.append(intern(cols[1]))
+            counts.append(int(float(cols[2])) if len(cols) > 2 else 1)
+    return aggregate_edges(srcs, dsts, counts)
+
+def write_elist(fname, user_ids, src, dst, weights=None):
+    """
+    Writes the edges between the user indices as an edge list with the user
+    ids, in the format read by `zen.edgelist.read`.
+    """
+    with open(fname,'w') as fh:
+        for i in xrange(0, len(src), ELIST_CHUNK_SIZE):
+            u = user_ids.user_ids(src[i:i + ELIST_CHUNK_SIZE])
+            v = user_ids.user_ids(dst[i:i + ELIST_CHUNK_SIZE])
+            if weights is None:
+                fh.write(''.join(['%s %s\n' % e for e in izip(u, v)]))
+            else:
+                w = weights[i:i + ELIST_CHUNK_SIZE].tolist()
+                fh.write(''.join(['%s %s %d\n' % e for e in izip(u, v, w)]))
+
+def write_mention_networks(working_dir, user_ids, edges, weights):
+    """
+    Writes the mention network with the edges and weights to
+    `mention_network.elist` in the working directory, along with the networks
+    of users who have mentioned each other:
+
+      - `bi_mention_network.elist` - undirected and unweighted
+      - `bi_mention_network.weighted.elist` - undirected, where an edge's
+        weight is the number of times the two users mentioned each other
+      - `bi_mention_network.directed.weighted.elist` - both directions of each
+        edge, weighted by the number of times the source mentioned the target
+
+    Returns a dict from the name of each edge list to its number of edges.
+    """
+    src = edges >> 32
+    dst = edges & 0xffffffff
+
+    # An edge is bidirectional if its reverse is also an edge.  Since the
+    # edges are sorted, the reverse is found by binary search.
+    reverse = (dst << 32) | src
+    pos = numpy.searchsorted(edges, reverse)
+    pos[pos == len(edges)] = 0
+    mutual = (edges[pos] == reverse) & (src != dst)
+    reverse_weights = weights[pos]
+
+    # TODO: Add compression to this...
+    write_elist(os.path.join(working_dir,'mention_network.elist'),
+                user_ids, src, dst, weights)
+    write_elist(os.path.join(working_dir,'bi_mention_network.directed.weighted.elist'),
+                user_ids, src[mutual], dst[mutual], weights[mutual])
+
+    # The undirected networks list each pair of users once
+    once = mutual & (src < dst)
+    write_elist(os.path.join(working_dir,'bi_mention_network.elist'),
+                user_ids, src[once], dst[once])
+    write_elist(os.path.join(working_dir,'bi_mention_network.weighted.elist'),
+                user_ids, src[once], dst[once],
+                weights[once] + reverse_weights[once])
+
+    num_mutual = int(mutual.sum())
+    return { 'mention_network.elist': len(edges),
+             'bi_mention_network.elist': num_mutual // 2,
+             'bi_mention_network.weighted.elist': num_mutual // 2,
+             'bi_mention_network.directed.weighted.elist': num_mutual }
@@ -0,0 +1,69 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Progress reporting for long loops over a dataset.  When the total number of
+items is known (e.g., from the dataset's manifest), the rate and estimated
+time remaining are reported along with the count.
+"""
+
+import os, os.path
+import logging
+import time
+
+from datetime import timedelta
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+class ProgressLogger(object):
+    """
+    Counts the items processed by a loop and logs the progress at most once
+    every `interval` seconds.
+    """
+
+    def __init__(self, name, total=None, log=None, interval=30.0):
+        self.name = name
+        self.total = total
+        self.count = 0
+        self._log = log if log is not None else logger
+        self._interval = interval
+        self._start = time.time()
+        self._last_logged = self._start
+
+    def update(self, n=1):
+        """
+        Records that n more items were processed.
+        """
+        self.count += n
+        now = time.time()
+        if now - self._last_logged >= self._interval:
+            self._last_logged = now
+            self._log.info(self.status(now))
+
+    def done(self):
+        """
+        Logs the final count.
+        """
+        self._log.info(self.status(time.time(), finished=True))
+
+    def status(self, now=None, finished=False):
+        """
+        Returns a description of the progress so far.
+        """
+        if now is None:
+            now = time.time()
+        elapsed = max(now - self._start, 1e-6)
+        rate = self.count / elapsed
+        if finished:
+            return '%s: %d done in %s (%.1f/sec)' \
+                % (self.name, self.count, timedelta(seconds=int(elapsed)), rate)
+        if self.total:
+            pct = 100.0 * self.count / self.total
+            remaining = max(self.total - self.count, 0) / rate if rate > 0 else 0
+            return '%s: %d/%d (%.1f%%), %.1f/sec, ETA %s' \
+                % (self.name, self.count, self.total, pct, rate,
+                   timedelta(seconds=int(remaining)))
+        return '%s: %d (%.1f/sec)' % (self.name, self.count, rate)
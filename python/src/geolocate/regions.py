@@ -0,0 +1,212 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+Assigns points to the regions (e.g., counties) whose polygons contain them.
+The polygons are indexed with an STRtree, so each point is only tested
+against the prepared polygons whose bounding boxes contain it, and points
+outside the bounds of all of the polygons are skipped without building a
+geometry.  Large sets of points are split among forked worker processes that
+share the index.
+
+The regions are read from a GeoJSON FeatureCollection, each feature being
+identified by one of its properties (e.g., the FIPS code of a county).  This
+module requires the optional `shapely` package.
+"""
+
+import os, os.path
+import json
+import logging
+import numbers
+import traceback
+
+import numpy
+
+from multiprocessing import Process, Queue, cpu_count
+
+from compression import open_file
+
+try:
+    from shapely.geometry import Point, shape
+    from shapely.prepared import prep
+    from shapely.strtree import STRtree
+except ImportError:
+    STRtree = None
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# The number of points below which assign_regions does not start workers
+MIN_POINTS_PER_WORKER = 10000
+
+def load_regions(fname, id_property):
+    """
+    Returns the (ids, polygons) of the features in the GeoJSON file, where
+    each id is the value of the feature's `id_property` property.
+    """
+    _require_shapely()
+    with open_file(fname, 'r') as fh:
+        collection = json.load(fh)
+    ids = []
+    polygons = []
+    for feature in collection['features']:
+        if feature.get('geometry') is None:
+            continue
+        ids.append(feature['properties'][id_property])
+        polygons.append(shape(feature['geometry']))
+    logger.debug('Loaded %d regions from %s' % (len(polygons), fname))
+    return ids, polygons
+
+class RegionIndex(object):
+    """
+    A spatial index of polygons that finds the polygon containing each of a
+    set of points.
+    """
+
+    def __init__(self, polygons):
+        _require_shapely()
+        self._polygons = list(polygons)
+        self._prepared = [prep(polygon) for polygon in self._polygons]
+        self._tree = STRtree(self._polygons)
+        # Older versions of shapely return the geometries from a query,
+        # rather than their indices
+        self._index = dict((id(polygon), i) for i, polygon in enumerate(self._polygons))
+        if self._polygons:
+            bounds = numpy.array([polygon.bounds for polygon in self._polygons])
+            self.bounds = (bounds[:,0].min(), bounds[:,1].min(),
+                           bounds[:,2].max(), bounds[:,3].max())
+        else:
+            self.bounds = None
+
+    def __len__(self):
+        return len(self._polygons)
+
+    def _candidates(self, point):
+        for candidate in self._tree.query(point):
+            if isinstance(candidate, numbers.Integral):
+                yield int(candidate)
+            else:
+                yield self._index[id(candidate)]
+
+    def find(self, lats, lons):
+        """
+        Returns the array of the index of the polygon containing each point,
+        or -1 for points that are in no polygon.  A point on the boundary of
+        several polygons is assigned to the first of them.
+        """
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        regions = numpy.empty(len(lats), dtype=numpy.int32)
+        regions.fill(-1)
+        if self.bounds is None:
+            return regions
+
+        min_lon, min_lat, max_lon, max_lat = self.bounds
+        inside = numpy.flatnonzero((lons >= min_lon) & (lons <= max_lon)
+                                   & (lats >= min_lat) & (lats <= max_lat))
+        prepared = self._prepared
+        for i in inside:
+            point = Point(lons[i], lats[i])
+            best = -1
+            for j in self._candidates(point):
+                if (best < 0 or j < best) and prepared[j].intersects(point):
+                    best = j
+            regions[i] = best
+        return regions
+
+def assign_regions(points, polygons, num_workers=None):
+    """
+    Returns the array of the index of the polygon containing each of the
+    (lat, lon) points, or -1 for points that are in no polygon.  `polygons`
+    may be a list of shapely polygons or a `RegionIndex` of them.  The points
+    are split into contiguous chunks that are assigned by `num_workers`
+    processes (by default, one per core).
+    """
+    index = polygons if isinstance(polygons, RegionIndex) else RegionIndex(polygons)
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    lats = points[:,0]
+    lons = points[:,1]
+    if not num_workers:
+        num_workers = cpu_count()
+    num_workers = max(1, min(num_workers, len(points) // MIN_POINTS_PER_WORKER))
+    if num_workers == 1:
+        return index.find(lats, lons)
+
+    bounds = numpy.linspace(0, len(points), num_workers + 1).astype(int)
+    results = Queue()
+    workers = [Process(target=_find_worker,
+                       args=(results, index, worker_id, lats[bounds[worker_id]:bounds[worker_id+1]],
+                             lons[bounds[worker_id]:bounds[worker_id+1]]))
+               for worker_id in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    # Results must be read before joining, or the workers could block on a
+    # full queue
+    regions = numpy.empty(len(points), dtype=numpy.int32)
+    failed = False
+    for worker in workers:
+        worker_id, worker_regions = results.get()
+        if worker_regions is None:
+            failed = True
+        else:
+            regions[bounds[worker_id]:bounds[worker_id+1]] = worker_regions
+    for worker in workers:
+        worker.join()
+    if failed:
+        raise Exception('a worker failed while assigning the points to regions')
+    return regions
+
+def assign_counties(dataset_dir, counties_fname, source='geo-median',
+                    id_property='FIPS', num_workers=None):
+    """
+    Writes the county of the home location of each user in the dataset's
+    users.home-locations.<source>.tsv.gz file to
+    users.home-locations.<source>.counties.tsv.gz, as rows of tab-separated
+    user id and county id, and returns the (number of users, number assigned
+    to a county).  Users outside all of the counties are omitted.
+    """
+    ids, polygons = load_regions(counties_fname, id_property)
+    user_ids = []
+    points = []
+    locations_fname = os.path.join(dataset_dir, 'users.home-locations.%s.tsv.gz' % source)
+    with open_file(locations_fname, 'r') as fh:
+        #eliminate header row
+        next(fh)
+
+        for line in fh:
+            try:
+                user_id, lat, lon = line.split('\t')
+                points.append((float(lat), float(lon)))
+            except ValueError:
+                continue
+            user_ids.append(user_id)
+    regions = assign_regions(points, polygons, num_workers)
+
+    fname = os.path.join(dataset_dir, 'users.home-locations.%s.counties.tsv.gz' % source)
+    tmp_fname = os.path.join(dataset_dir, '.tmp-' + os.path.basename(fname))
+    num_assigned = 0
+    with open_file(tmp_fname, 'w') as fh:
+        fh.write('user_id\tcounty\n')
+        for user_id, region in zip(user_ids, regions):
+            if region < 0:
+                continue
+            fh.write('%s\t%s\n' % (user_id, ids[region]))
+            num_assigned += 1
+    os.rename(tmp_fname, fname)
+    logger.info('Assigned %d of %d users to counties in %s'
+                % (num_assigned, len(user_ids), fname))
+    return len(user_ids), num_assigned
+
+def _find_worker(results, index, worker_id, lats, lons):
+    try:
+        results.put((worker_id, index.find(lats, lons)))
+    except:
+        traceback.print_exc()
+        results.put((worker_id, None))
+
+def _require_shapely():
+    if STRtree is None:
+        raise Exception('assigning points to regions requires the shapely package')
@@ -30,6 +30,22 @@ All three core files in the dataset directory contain data in JSON format.
         These posts should have identical format and data to those in the 
         `posts.json.gz` file.  Moreover, every post present in the `posts.json` file
         must be present in `users.json` and visa versa.
+
+Methods typically use only a few fields of each post.  Iterating with `fields`
+(e.g., `user_iter(fields=['text', 'user.location'])`) reads from a projected
+copy of the users file, `users.proj-<key>.json.gz`, in which every post has
+been reduced to those fields.  The projection is built the first time a set of
+fields is requested and is rebuilt whenever the users file changes.
+
+Posts added after the dataset was built (see `dataset.append_posts`) are kept
+in delta segments, `ds_root/deltas/<n>/`, each holding the users file, user id
+table, index and mention network of only the new posts.  The users and
+networks of the deltas are merged with those of the base files when read,
+until `dataset.compact_dataset` folds them into the base files.
+
+Whole files are read with `compression.open_file`, so scans of the users file
+can be decompressed by a separate process (see `compression.DEFAULT_THREADS`),
+while individual users are still read by block from the block gzip file.
 """
 
 import simplejson
@@ -38,8 +54,20 @@ import json
 import os, os.path
 import logging
 import zen
-import gzip
-import subprocess
+import hashlib
+import traceback
+
+from itertools import izip
+from multiprocessing import Process, Queue, cpu_count
+
+import numpy
+
+from block_gzip import BlockGzipWriter, read_blocks, read_lines
+from compression import open_file
+from csr_graph import load_csr, source_signature
+from mention_edges import merge_runs, read_edges, write_mention_networks
+from progress import ProgressLogger
+from user_ids import UserIdTable, shard_of
 
 logger = logging.getLogger(os.path.basename(__file__))
 
@@ -51,7 +79,8 @@ class SparseDataset(object):
     def __init__(self, dataset_dir, cross_fold_dir=None, users_file='users.json.gz', excluded_users=set(), default_location_source='geo-median'):
         settings_fname = os.path.join(dataset_dir,'dataset.json')
         if os.path.exists(settings_fname):
-            self._settings = jsonlib.load(open(settings_fname,'r'))
+            with open(settings_fname,'r') as fh:
+                self._settings = json.load(fh)
         else:
             self._settings = {}
 
@@ -65,33 +94,56 @@ class SparseDataset(object):
             self._users_with_locations_fname = os.path.join(dataset_dir, 'users.home-locations.' + default_location_source + '.tsv.gz')
         self._mention_network_fname = os.path.join(dataset_dir, 'mention_network.elist')
         self._bi_mention_network_fname = os.path.join(dataset_dir, 'bi_mention_network.elist')
+        self._user_ids_fname = os.path.join(os.path.dirname(self._users_fname), 'users.ids.txt.gz')
+        self._user_ids = None
+        self._users_index_fname = self._users_fname.replace('.json.gz', '.index.npy')
+        self._users_index = None
+        self._projections = {}
+        self._home_locations = None
+        self._deltas_dir = os.path.join(dataset_dir, 'deltas')
+        self._deltas = None
+        self._base_users = None
         self.excluded_users = excluded_users
         
 
-    def post_iter(self):
+    def post_iter(self, fields=None):
         """
         Return an iterator over all the posts in the dataset. The ordering
-        of the posts follows the order of users in the dataset file.
+        of the posts follows the order of users in the dataset file.  If
+        `fields` is specified, each post contains only those fields.
         """
-        fh = gzip.open(self._users_fname,'r')
-
-        for line in fh:
-            user = self.load_user(line)
+        for user in self.user_iter(fields):
             for post in user["posts"]:
                 yield post
-        fh.close()
 
-    def user_iter(self):
+    def user_iter(self, fields=None, shard=None, num_shards=None):
         """
         Return an iterator over all posts in the dataset grouped by user. Each
         user is represented by a list of their posts - so any metadata about the
-        user must be aggregated from the posts it produced.
+        user must be aggregated from the posts it produced.  If `fields` is
+        specified, each post contains only those fields (see `project_post`).
+
+        If `shard` and `num_shards` are specified, only the users in that
+        shard are returned, where the shards split the users into `num_shards`
+        disjoint sets.  This allows `num_shards` workers to process the dataset
+        in parallel (see `map_users`).
         """
-        fh = gzip.open(self._users_fname,'r')
+        if shard is not None:
+            return self.iter_users(None, fields, shard, num_shards)
+
+        if fields is None:
+            fname = self._users_fname
+        else:
+            fname = self.projected_users(fields)[0]
+        return self._with_deltas(self._scan_users(fname), None, fields)
+
+    def _scan_users(self, fname):
+        fh = open_file(fname,'r')
 
         for line in fh:
             user = self.load_user(line)
             yield user
+        fh.close()
 
     def __iter__(self):
         """
@@ -99,36 +151,459 @@ class SparseDataset(object):
         """
         return self.post_iter()
 
-    def user_home_location_iter(self):
+    def has_users_index(self):
+        """
+        Returns True if the users file has an index that allows reading
+        individual users without scanning the whole file.
+        """
+        return os.path.exists(self._users_index_fname)
+
+    def get_user(self, user_id, fields=None):
+        """
+        Returns the user with the specified id, or None if the dataset has no
+        such user.
+        """
+        for user in self.iter_users([user_id], fields):
+            return user
+        return None
+
+    def iter_users(self, user_ids, fields=None, shard=None, num_shards=None):
+        """
+        Return an iterator over the users with the specified ids (or all users,
+        if `user_ids` is None), in the order they appear in the users file.  If
+        the users file is indexed, only the blocks of the file containing these
+        users are decompressed; otherwise, the entire file is scanned.  Ids not
+        in the dataset are skipped.  If `fields` is specified, each post
+        contains only those fields.
+
+        If `shard` and `num_shards` are specified, only the users in that
+        shard are returned.  For an indexed file, the shards are contiguous
+        runs of the blocks holding these users, so each shard reads a disjoint
+        part of the file.  Otherwise, users are assigned to shards by a hash of
+        their id.
+        """
+        # When all users are wanted, the manifest's block offsets give each
+        # shard's part of the file without reading the index
+        if user_ids is None and fields is None and shard is not None:
+            byte_range = self._shard_byte_range(shard, num_shards)
+            if byte_range is not None:
+                users = self._read_users_range(*byte_range)
+                return self._with_deltas(users, user_ids, fields, shard, num_shards)
+
+        source = self._indexed_users_file(fields)
+        if source is not None:
+            fname, index = source
+            users = self._read_indexed_users(fname, index, user_ids, shard, num_shards)
+            return self._with_deltas(users, user_ids, fields, shard, num_shards)
+
+        logger.debug('%s has no index; scanning all users' % self._users_fname)
+        users = self._scan_users(self._users_fname)
+        if user_ids is not None:
+            wanted = user_ids if isinstance(user_ids, (set, frozenset, dict)) \
+                else set(user_ids)
+            users = (user for user in users if user['user_id'] in wanted)
+        if shard is not None:
+            users = (user for user in users
+                     if shard_of(user['user_id'], num_shards) == shard)
+        return self._with_deltas(users, user_ids, fields, shard, num_shards)
+
+    def deltas(self):
+        """
+        Returns the list of `DeltaSegment` objects for the posts appended to
+        the dataset since it was last compacted, in the order they were added.
+        """
+        if self._deltas is None:
+            self._deltas = [DeltaSegment(d) for d in list_deltas(self._deltas_dir)]
+        return self._deltas
+
+    def _with_deltas(self, users, user_ids, fields, shard=None, num_shards=None):
+        """
+        Returns the iterator over the base users, with the posts of the delta
+        segments merged in.
+        """
+        deltas = self.deltas()
+        if len(deltas) == 0:
+            return users
+        return self._iter_merged_users(users, deltas, user_ids, fields, shard, num_shards)
+
+    def _iter_merged_users(self, users, deltas, user_ids, fields, shard, num_shards):
+        paths = None if fields is None else [f.split('.') for f in sorted(set(fields))]
+
+        # The posts of users in the base files are appended to their base
+        # user.  The deltas are small, so their users are read individually.
+        for user in users:
+            user_id = user['user_id']
+            for delta in deltas:
+                posts = delta.get_posts(user_id)
+                if posts is not None:
+                    user['posts'].extend(self._load_delta_posts(user_id, posts, paths))
+            yield user
+
+        # Then, the users who appear only in the deltas
+        wanted = None
+        if user_ids is not None:
+            wanted = user_ids if isinstance(user_ids, (set, frozenset, dict)) \
+                else set(user_ids)
+        merged = set()
+        for i, delta in enumerate(deltas):
+            for user_id, posts in delta.iter_posts():
+                if user_id in merged or self._in_base(user_id) \
+                        or (wanted is not None and not user_id in wanted) \
+                        or (shard is not None and shard_of(user_id, num_shards) != shard):
+                    continue
+                posts = self._load_delta_posts(user_id, posts, paths)
+                for later in deltas[i + 1:]:
+                    later_posts = later.get_posts(user_id)
+                    if later_posts is not None:
+                        posts.extend(self._load_delta_posts(user_id, later_posts, paths))
+                merged.add(user_id)
+                yield { 'user_id': user_id, 'posts': posts }
+
+    def _load_delta_posts(self, user_id, posts, paths):
+        if user_id in self.excluded_users:
+            for post in posts:
+                post.pop("geo", None)
+        if paths is not None:
+            posts = [project_post(post, paths) for post in posts]
+        return posts
+
+    def _in_base(self, user_id):
+        """
+        Returns True if the user has posts in the base users file.
+        """
+        if self.has_users_index():
+            index = self._indexed_users_file(None)[1]
+            idx = self.user_ids().get(user_id)
+            return idx >= 0 and idx < len(index) and index[idx][0] >= 0
+
+        # Without an index, the users in the file are only known by reading it
+        if self._base_users is None:
+            self._base_users = set(user['user_id']
+                                   for user in self._scan_users(self._users_fname))
+        return user_id in self._base_users
+
+    def _shard_byte_range(self, shard, num_shards):
+        """
+        Returns the (start, end) byte offsets of the part of the users file
+        holding the shard, using the block offsets in the manifest, or None if
+        there is no current manifest.  Shards are split at the recorded blocks
+        closest to an even split of the users.
+        """
+        manifest = self.manifest()
+        if manifest is None or not 'users_blocks' in manifest:
+            return None
+        offsets = manifest['users_blocks']['offsets']
+        users_before = manifest['users_blocks']['users_before']
+        end_offset = source_signature(self._users_fname)['size']
+        if len(offsets) == 0:
+            return (end_offset, end_offset)
+
+        boundaries = [offsets[0]]
+        for i in range(1, num_shards):
+            j = numpy.searchsorted(users_before, i * manifest['num_users'] / float(num_shards))
+            boundaries.append(offsets[min(j, len(offsets) - 1)])
+        boundaries.append(end_offset)
+        return (boundaries[shard], max(boundaries[shard], boundaries[shard + 1]))
+
+    def _read_users_range(self, start, end):
+        """
+        Yields the users in the blocks of the users file between the offsets.
+        """
+        fh = open(self._users_fname, 'rb')
+        for block in read_blocks(fh, start, end):
+            for line in block.split('\n'):
+                if line:
+                    yield self.load_user(line)
+        fh.close()
+
+    def manifest(self):
+        """
+        Returns the dataset's `dataset.json` manifest (see
+        `dataset.write_manifest`), or None if the dataset has no manifest or if
+        the users file has changed since the manifest was written.
+        """
+        if not self._manifest_file_current(self._users_fname):
+            return None
+        return self._settings
+
+    def _manifest_file_current(self, fname):
+        """
+        Returns True if the manifest describes the current version of the file.
+        """
+        info = self._settings.get('files', {}).get(os.path.basename(fname))
+        if info is None or not os.path.exists(fname):
+            return False
+        signature = source_signature(fname)
+        return info['size'] == signature['size'] and info['mtime'] == signature['mtime']
+
+    def num_users(self):
+        """
+        Returns the number of users with posts, or None if it is not known
+        without scanning the users file.  Users with posts in more than one
+        delta segment are counted once per segment, so with deltas this is an
+        upper bound.
+        """
+        return self._count('num_users')
+
+    def num_posts(self):
+        """
+        Returns the number of posts, or None if it is not known without
+        scanning the users file.
+        """
+        return self._count('num_posts')
+
+    def _count(self, key):
+        manifest = self.manifest()
+        if manifest is None or manifest.get(key) is None:
+            return None
+        total = manifest[key]
+        for delta in self.deltas():
+            if delta.manifest is None or delta.manifest.get(key) is None:
+                return None
+            total += delta.manifest[key]
+        return total
+
+    def user_progress(self, name, log=None):
+        """
+        Returns a `ProgressLogger` for a loop over all the users, which reports
+        an ETA if the number of users is known.
+        """
+        return ProgressLogger(name, self.num_users(), log)
+
+    def post_progress(self, name, log=None):
+        """
+        Returns a `ProgressLogger` for a loop over all the posts, which reports
+        an ETA if the number of posts is known.
+        """
+        return ProgressLogger(name, self.num_posts(), log)
+
+    def _indexed_users_file(self, fields):
+        """
+        Returns the (file name, index) of the indexed users file holding the
+        fields, or None if the users file has no index.
+        """
+        if fields is not None:
+            return self.projected_users(fields)
+        if not self.has_users_index():
+            return None
+        if self._users_index is None:
+            self._users_index = numpy.load(self._users_index_fname, mmap_mode='r')
+        return (self._users_fname, self._users_index)
+
+    def _read_indexed_users(self, fname, index, user_ids, shard=None, num_shards=None):
+        """
+        Yields the users with the specified ids (or all users, if `user_ids` is
+        None) from the block gzip users file, using the index from user id
+        indices to line locations.
+        """
+        if user_ids is None:
+            locations = numpy.asarray(index)
+        else:
+            # The table may hold more ids than the index (e.g., users who were
+            # only mentioned), and those have no posts to read
+            indices = self.user_ids().indices(user_ids)
+            indices = indices[(indices >= 0) & (indices < len(index))]
+            locations = numpy.asarray(index[numpy.unique(indices)])
+        locations = locations[locations[:,0] >= 0]
+        if shard is not None:
+            locations = shard_locations(locations, shard, num_shards)
+        locations = [(int(b), int(o)) for b, o in locations]
+
+        fh = open(fname, 'rb')
+        for line in read_lines(fh, locations):
+            yield self.load_user(line)
+        fh.close()
+
+    def map_users(self, func, user_ids=None, fields=None, num_workers=None):
+        """
+        Applies `func` to each user (or to each of the users with the specified
+        ids) and returns a dict from user id to the result, omitting users for
+        which `func` returned None.  The users are split into one shard per
+        worker and the shards are processed in parallel by `num_workers`
+        processes (by default, one per core).  `fields` is passed on to
+        `user_iter`.
+
+        Since the workers are forked, `func` may be any callable, including a
+        bound method or a lambda, but any changes it makes to the state of
+        the calling process are not seen outside its worker; only the returned
+        results are.
+        """
+        if not num_workers:
+            num_workers = cpu_count()
+
+        # Load (or build) the files the workers share before forking, so that
+        # they are not built once per worker
+        self.user_ids()
+        self._indexed_users_file(fields)
+        self.deltas()
+
+        if num_workers == 1:
+            return self._map_shard(func, user_ids, fields, None, None)
+
+        results = Queue()
+        workers = [Process(target=self._map_shard_worker,
+                           args=(results, func, user_ids, fields, shard, num_workers))
+                   for shard in range(num_workers)]
+        for worker in workers:
+            worker.start()
+
+        # Results must be read before joining, or the workers could block on a
+        # full queue
+        user_results = {}
+        failed = False
+        for worker in workers:
+            shard_results = results.get()
+            if shard_results is None:
+                failed = True
+            else:
+                user_results.update(shard_results)
+        for worker in workers:
+            worker.join()
+        if failed:
+            raise Exception('a worker failed while mapping over the users')
+        return user_results
+
+    def _map_shard(self, func, user_ids, fields, shard, num_shards):
+        shard_results = {}
+        for user in self.iter_users(user_ids, fields, shard, num_shards):
+            result = func(user)
+            if result is not None:
+                shard_results[user['user_id']] = result
+        return shard_results
+
+    def _map_shard_worker(self, results, func, user_ids, fields, shard, num_shards):
+        try:
+            results.put(self._map_shard(func, user_ids, fields, shard, num_shards))
+        except:
+            traceback.print_exc()
+            results.put(None)
+
+    def projected_users(self, fields):
+        """
+        Returns the (file name, index) of the users file projected onto the
+        fields, building the projection if it does not exist or if the users
+        file has changed since it was built.
+        """
+        fields = sorted(set(fields))
+        key = hashlib.md5(','.join(fields)).hexdigest()[:10]
+        if key in self._projections:
+            return self._projections[key]
+
+        base = self._users_fname.replace('.json.gz', '.proj-%s' % key)
+        fname = base + '.json.gz'
+        index_fname = base + '.index.npy'
+        meta_fname = base + '.meta.json'
+
+        meta = None
+        if os.path.exists(meta_fname):
+            with open(meta_fname, 'r') as fh:
+                meta = json.load(fh)
+        if meta is None or meta.get('fields') != fields \
+                or meta.get('source') != source_signature(self._users_fname):
+            self._build_projection(fields, fname, index_fname, meta_fname)
+
+        projection = (fname, numpy.load(index_fname, mmap_mode='r'))
+        self._projections[key] = projection
+        return projection
+
+    def _build_projection(self, fields, fname, index_fname, meta_fname):
+        """
+        Writes the users file with every post reduced to the fields, along
+        with its index and the metadata used to tell when it is out of date.
+        """
+        logger.info('projecting %s onto %s' % (self._users_fname, ', '.join(fields)))
+        paths = [f.split('.') for f in fields]
+        id_table = self.user_ids()
+        locations = {}
+
+        writer = BlockGzipWriter(fname + '.tmp')
+        fh = open_file(self._users_fname, 'r')
+        for line in fh:
+            user = json.loads(line)
+            posts = [project_post(post, paths) for post in user['posts']]
+            idx = id_table.intern(user['user_id'])
+            locations[idx] = writer.write_line(
+                json.dumps({ 'user_id': user['user_id'], 'posts': posts }))
+        fh.close()
+        writer.close()
+        if id_table.is_dirty():
+            id_table.save()
+
+        # Users are stored by their index in the id table, and indices with no
+        # user are marked with a block offset of -1
+        index = numpy.empty((len(id_table), 2), dtype=numpy.int64)
+        index.fill(-1)
+        for idx, loc in locations.iteritems():
+            index[idx] = loc
+        with open(index_fname, 'wb') as ifh:
+            numpy.save(ifh, index)
+        os.rename(fname + '.tmp', fname)
+
+        # The metadata is written last, so a partially-built projection is
+        # never mistaken for a current one
+        with open(meta_fname, 'w') as mfh:
+            json.dump({ 'fields': fields,
+                        'source': source_signature(self._users_fname) }, mfh)
+
+    def user_ids(self):
+        """
+        Returns the `UserIdTable` that maps this dataset's user ids to dense
+        integer indices.  The table is loaded from `users.ids.txt.gz`, or built
+        from the users file (and saved) if the dataset predates the table.
+        """
+        if self._user_ids is None:
+            if os.path.exists(self._user_ids_fname):
+                self._user_ids = UserIdTable.load(self._user_ids_fname)
+            else:
+                logger.info('building user id table %s' % self._user_ids_fname)
+                self._user_ids = UserIdTable(fname=self._user_ids_fname)
+                fh = open_file(self._users_fname,'r')
+                for line in fh:
+                    self._user_ids.intern(json.loads(line)['user_id'])
+                fh.close()
+                self._user_ids.save()
+        return self._user_ids
+
+    def user_home_location_iter(self, interned=False):
         """
         Returns an iterator over all the users whose home location has
-        been already identified.  
+        been already identified.  If `interned` is True, users are reported by
+        their index in the `UserIdTable` rather than by their string id.
         """
-        location_file = self._users_with_locations_fname
-        print('Loading home locations from %s' 
-                     % (self._users_with_locations_fname))
-        with open(location_file, 'r') as fh:
+        users, lats, lons = self.user_home_locations()
+        if interned:
+            users = users.tolist()
+        else:
+            users = self.user_ids().user_ids(users)
+        return izip(users, izip(lats.tolist(), lons.tolist()))
+
+    def user_home_locations(self):
+        """
+        Returns the (users, lats, lons) arrays of all the users whose home
+        location has been already identified, where users are given by their
+        index in the `UserIdTable`.  Users in `excluded_users` are left out.
+
+        The home location file is parsed once into a binary cache next to it
+        (see `load_home_locations`), which is reused until the file changes.
+        """
+        if self._home_locations is None:
+            self._home_locations = load_home_locations(
+                self._users_with_locations_fname, self.user_ids())
+
+        users, lats, lons = self._home_locations
+        if len(self.excluded_users) > 0:
             logger.debug('Excluding locations for %d users' % (len(self.excluded_users)))
-            #eliminate header row
-            next(fh)
-
-            for line in fh:
-                try:
-                    user_id, lat, lon = line.split('\t')
-                    # print "%s %s" % (user_id, next(iter(self.excluded_users)))
-                    if not user_id in self.excluded_users:
-                        yield (user_id, (float(lat), float(lon)))
-                    #else:
-                    #        print "excluding %s" % user_id
-                except:
-                    continue
+            excluded = self.user_ids().indices(self.excluded_users)
+            keep = ~numpy.in1d(users, excluded)
+            users, lats, lons = users[keep], lats[keep], lons[keep]
+        return users, lats, lons
         
     def known_user_locations(self):
         """
         Return dictionary of users to their locations, containing only
         users who have already self-reported their own location.  
         """
-        fh = gzip.open(self._users_fname,'r')
+        fh = open_file(self._users_fname,'r')
 
         for line in fh:
             user = self.load_user(line)
@@ -136,55 +611,104 @@ class SparseDataset(object):
                 
         fh.close()
 
-    def mention_network(self):
+    def bi_mention_network(self, csr=False):
         """
-        Return the mention network for the dataset.
+        Return the undirected mention network for the dataset consisting
+        only of edges between users who have both mentioned each other.  If
+        `csr` is True, the read-only memory-mapped `CSRGraph` is returned
+        instead of a zen graph.
         """
-        return self.mention_network(bidirectional=False,directed=True,weighted=False)
+        return self.mention_network(bidirectional=True,directed=False,weighted=False,csr=csr)
 
-    def bi_mention_network(self):
+    def build_graph(self,fname,directed,weighted,csr=False):
         """
-        Return the undirected mention network for the dataset consisting
-        only of edges between users who have both mentioned each other.  This 
-        """
-        return self.mention_network(bidirectional=True,directed=False,weighted=False)
-
-    def build_graph(self,fname,directed,weighted):
-        command = ("wc -l %s" %fname)
-        print(fname);
-        process = subprocess.Popen(command, stdout=subprocess.PIPE,stderr=None, shell=True)
-        output = process.communicate()
-        graph_edge_capacity = int(output[0].split()[0]) + 1
-        G = zen.edgelist.read(fname, weighted=weighted, ignore_duplicate_edges=True, merge_graph=zen.Graph(directed=directed, edge_capacity=graph_edge_capacity,edge_list_capacity=1))
-        return G
-        
+        Loads the network in the edge list file.  The edge list is converted to
+        a binary CSR cache the first time it is loaded, and the cache is reused
+        until the edge list changes.  Nodes of the CSR graph are indexed by the
+        dataset's `UserIdTable`.
+
+        Unless `csr` is True, the CSR graph is converted to a zen graph one
+        edge at a time, which costs as much as building the zen graph from the
+        edge list did, so methods that only read the network should ask for
+        the CSR graph.
+        """
+        id_table = self.user_ids()
+        num_edges = None
+        if len(self.deltas()) > 0:
+            fname = self._merged_network(os.path.basename(fname))
+        elif self._manifest_file_current(fname):
+            # The edge count lets the edge arrays be allocated up front
+            network = self._settings['networks'].get(os.path.basename(fname))
+            if network is not None:
+                num_edges = network['num_edges']
+        G = load_csr(fname, directed=directed, weighted=weighted, id_table=id_table,
+                     num_edges=num_edges)
+        # Persist any mentioned users that had no posts of their own
+        if id_table.is_dirty():
+            id_table.save()
+        if csr:
+            return G
+        return G.to_zen()
+
+    def _merged_network(self, network_fname):
+        """
+        Returns the path of the named edge list for the mention network with
+        the edges of the delta segments merged in.  The merged edge lists are
+        written to `deltas/merged/` and rebuilt whenever the segments change.
+        """
+        merged_dir = os.path.join(self._deltas_dir, 'merged')
+        meta_fname = os.path.join(merged_dir, 'meta.json')
+        sources = [os.path.join(self._dataset_dir, 'mention_network.elist')] \
+            + [delta.mention_network_fname for delta in self.deltas()]
+        signature = [[fname, source_signature(fname)] for fname in sources]
+
+        meta = None
+        if os.path.exists(meta_fname):
+            with open(meta_fname, 'r') as fh:
+                meta = json.load(fh)
+        if meta is None or meta.get('sources') != signature:
+            logger.info('merging the mention networks of %d deltas' % (len(sources) - 1))
+            if not os.path.exists(merged_dir):
+                os.mkdir(merged_dir)
+            elif os.path.exists(meta_fname):
+                os.remove(meta_fname)
+            id_table = self.user_ids()
+            edges, weights = merge_runs([read_edges(fname, id_table) for fname in sources])
+            write_mention_networks(merged_dir, id_table, edges, weights)
+            if id_table.is_dirty():
+                id_table.save()
+            with open(meta_fname, 'w') as fh:
+                json.dump({ 'sources': signature }, fh)
+
+        return os.path.join(merged_dir, network_fname)
 
-    def mention_network(self, bidirectional=False, directed=False, weighted=False):
+    def mention_network(self, bidirectional=False, directed=False, weighted=False, csr=False):
         """
-        Return the mention network for the dataset.
+        Return the mention network for the dataset.  If `csr` is True, the
+        read-only `CSRGraph` is returned instead of a zen graph.
         """
         if bidirectional:
             if directed:
                 if weighted:
                     fname = os.path.join(self._dataset_dir, 'bi_mention_network.directed.weighted.elist')
-                    return self.build_graph(fname,directed=True,weighted=True)
+                    return self.build_graph(fname,directed=True,weighted=True,csr=csr)
                 else:
                     pass
             else:
                 if weighted:
                     fname = os.path.join(self._dataset_dir, 'bi_mention_network.weighted.elist')
-                    return self.build_graph(fname,directed=False,weighted=True)
+                    return self.build_graph(fname,directed=False,weighted=True,csr=csr)
 
                 else:
                     fname = os.path.join(self._dataset_dir, 'bi_mention_network.elist')
-                    return self.build_graph(fname,directed=False, weighted=False)
+                    return self.build_graph(fname,directed=False, weighted=False,csr=csr)
         else:
             if directed:
                 if weighted:
                     pass
                 else:
                     fname = os.path.join(self._dataset_dir, 'mention_network.elist')
-                    return self.build_graph(fname,directed=True, weighted=False)
+                    return self.build_graph(fname,directed=True, weighted=False,csr=csr)
             else:
                 if weighted:
                     pass
@@ -215,3 +739,154 @@ class SparseDataset(object):
                 post.pop("geo", None)
 
         return user_obj
+
+
+def project_post(post, paths):
+    """
+    Returns a copy of the post containing only the fields at the paths, where
+    each path is a list of keys into the post's nested dicts (e.g., ['user',
+    'location']).  The structure of the post is kept, so code written against
+    the full post works unchanged on the projection.  Fields missing from the
+    post are omitted from the projection, while null values are kept.
+    """
+    projected = {}
+    for path in paths:
+        src = post
+        dest = projected
+        for key in path[:-1]:
+            if not isinstance(src, dict) or not key in src:
+                break
+            src = src[key]
+            if not isinstance(src, dict):
+                # Keep a non-dict value (e.g., a null "place") as-is
+                dest[key] = src
+                break
+            dest = dest.setdefault(key, {})
+        else:
+            if isinstance(src, dict) and path[-1] in src:
+                dest[path[-1]] = src[path[-1]]
+    return projected
+
+def shard_locations(locations, shard, num_shards):
+    """
+    Returns the rows of the (n, 2) array of line locations in a block gzip
+    file that fall in the shard, where the shards are contiguous runs of
+    (roughly) equal numbers of the blocks that hold these lines.
+    """
+    blocks = numpy.unique(locations[:,0])
+    shard_blocks = numpy.array_split(blocks, num_shards)[shard]
+    if len(shard_blocks) == 0:
+        return locations[:0]
+    return locations[(locations[:,0] >= shard_blocks[0])
+                     & (locations[:,0] <= shard_blocks[-1])]
+
+def load_home_locations(fname, id_table):
+    """
+    Returns the (users, lats, lons) arrays of the home locations in the file,
+    which has a header row followed by rows of tab-separated user id,
+    latitude and longitude.  Users are interned into `id_table`, and the
+    arrays are cached in `<fname>.npz`, which is rebuilt if the file changes
+    or if the table no longer matches the indices in the cache.
+    """
+    cache_fname = fname + '.npz'
+    if os.path.exists(cache_fname):
+        with numpy.load(cache_fname) as cache:
+            meta = json.loads(str(cache['meta']))
+            num_ids = meta['num_ids']
+            if meta['source'] == source_signature(fname) \
+                    and num_ids <= len(id_table) \
+                    and (num_ids == 0 or id_table.user_id(num_ids - 1) == meta['last_id']):
+                logger.debug('Loading home locations from %s' % cache_fname)
+                return cache['users'], cache['lats'], cache['lons']
+
+    logger.info('Loading home locations from %s' % fname)
+    signature = source_signature(fname)
+    intern = id_table.intern
+    users = []
+    lats = []
+    lons = []
+    with open_file(fname, 'r') as fh:
+        #eliminate header row
+        next(fh)
+
+        for line in fh:
+            try:
+                user_id, lat, lon = line.split('\t')
+                lat = float(lat)
+                lon = float(lon)
+            except ValueError:
+                continue
+            users.append(intern(user_id))
+            lats.append(lat)
+            lons.append(lon)
+
+    if id_table.is_dirty():
+        id_table.save()
+
+    users = numpy.array(users, dtype=numpy.int32)
+    lats = numpy.array(lats, dtype=numpy.float64)
+    lons = numpy.array(lons, dtype=numpy.float64)
+    num_ids = len(id_table)
+    meta = { 'source': signature, 'num_ids': num_ids,
+             'last_id': id_table.user_id(num_ids - 1) if num_ids > 0 else None }
+    with open(cache_fname + '.tmp', 'wb') as cfh:
+        numpy.savez(cfh, users=users, lats=lats, lons=lons,
+                    meta=numpy.array(json.dumps(meta)))
+    os.rename(cache_fname + '.tmp', cache_fname)
+    return users, lats, lons
+
+def list_deltas(deltas_dir):
+    """
+    Returns the directories of the delta segments in `deltas_dir`, in the
+    order they were added.  Segments are numbered, so partially-written
+    segments and the merged networks are skipped.
+    """
+    if not os.path.isdir(deltas_dir):
+        return []
+    return [os.path.join(deltas_dir, name)
+            for name in sorted(os.listdir(deltas_dir)) if name.isdigit()]
+
+class DeltaSegment(object):
+    """
+    The users and mention network of a batch of posts appended to a dataset.
+    A segment directory has the same files as a dataset directory, with the
+    user id table and index of its own users file.
+    """
+
+    def __init__(self, segment_dir):
+        self.segment_dir = segment_dir
+        self.users_fname = os.path.join(segment_dir, 'users.json.gz')
+        self.mention_network_fname = os.path.join(segment_dir, 'mention_network.elist')
+        self.user_ids = UserIdTable.load(os.path.join(segment_dir, 'users.ids.txt.gz'))
+        self.index = numpy.load(os.path.join(segment_dir, 'users.index.npy'))
+        self.manifest = None
+        manifest_fname = os.path.join(segment_dir, 'dataset.json')
+        if os.path.exists(manifest_fname):
+            with open(manifest_fname, 'r') as fh:
+                self.manifest = json.load(fh)
+        self._fh = None
+
+    def get_posts(self, user_id):
+        """
+        Returns the user's posts in this segment, or None if the user has no
+        posts in it.
+        """
+        idx = self.user_ids.get(user_id)
+        if idx < 0 or idx >= len(self.index):
+            return None
+        if self._fh is None:
+            self._fh = open(self.users_fname, 'rb')
+        b, o = self.index[idx]
+        for line in read_lines(self._fh, [(int(b), int(o))]):
+            return json.loads(line)['posts']
+
+    def iter_posts(self):
+        """
+        Returns an iterator over the (user id, posts) of all the users in this
+        segment.
+        """
+        fh = open_file(self.users_fname, 'r')
+        for line in fh:
+            user = json.loads(line)
+            yield user['user_id'], user['posts']
+        fh.close()
@@ -0,0 +1,394 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+An SQLite store of a dataset, `ds_root/dataset.sqlite`, for looking up
+individual users, their neighbors and their home locations without scanning
+the users file.  The store is built from the dataset's files by
+`build_sqlite_dataset` (or by `geoinf build_dataset --backend sqlite`) and has
+the tables:
+
+    users(id, user_id, num_posts) - every user in the `UserIdTable`, keyed by
+        their interned index
+    posts(user, seq, text, lat, lon, location, post) - each user's posts in
+        order, with the fields most methods read (the GPS point and the
+        self-reported location) as columns and the full post as JSON
+    edges(src, dst, weight) - the directed, weighted mention network, indexed
+        on both endpoints
+    home_locations(source, user, lat, lon) - the users' home locations from
+        each `users.home-locations.<source>.tsv.gz` file
+    meta(key, value) - the signatures of the files the store was built from
+
+`SqliteDataset` serves users, home locations and neighbor queries from the
+store, and falls back to the `SparseDataset` it extends when the store is
+missing or out of date.
+"""
+
+import json
+import os, os.path
+import glob
+import logging
+import sqlite3
+
+from itertools import izip
+
+import numpy
+
+from csr_graph import source_signature
+from mention_edges import read_edges
+from sparse_dataset import SparseDataset, load_home_locations, project_post
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# The name of the store in a dataset directory
+SQLITE_FNAME = 'dataset.sqlite'
+
+# The number of rows inserted, or ids looked up, at a time
+SQLITE_BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE users (id INTEGER PRIMARY KEY, user_id TEXT NOT NULL, num_posts INTEGER NOT NULL);
+CREATE TABLE posts (user INTEGER NOT NULL, seq INTEGER NOT NULL, text TEXT,
+                    lat REAL, lon REAL, location TEXT, post TEXT NOT NULL,
+                    PRIMARY KEY (user, seq));
+CREATE TABLE edges (src INTEGER NOT NULL, dst INTEGER NOT NULL, weight INTEGER NOT NULL);
+CREATE TABLE home_locations (source TEXT NOT NULL, user INTEGER NOT NULL,
+                             lat REAL NOT NULL, lon REAL NOT NULL,
+                             PRIMARY KEY (source, user));
+"""
+
+# The indices are created once the tables are filled, which is faster than
+# updating them on every insert
+INDICES = """
+CREATE UNIQUE INDEX users_user_id ON users (user_id);
+CREATE INDEX edges_src ON edges (src, dst);
+CREATE INDEX edges_dst ON edges (dst, src);
+"""
+
+def build_sqlite_dataset(dataset_dir, db_fname=None):
+    """
+    Builds the SQLite store of the dataset (by default, `dataset.sqlite` in
+    the dataset directory) from its users file, mention network and home
+    location files, including any appended deltas.  The store is written to a
+    temporary file and moved into place once complete.
+    """
+    if db_fname is None:
+        db_fname = os.path.join(dataset_dir, SQLITE_FNAME)
+    tmp_fname = db_fname + '.tmp'
+    if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
+
+    ds = SparseDataset(dataset_dir)
+    user_ids = ds.user_ids()
+    conn = sqlite3.connect(tmp_fname)
+    conn.text_factory = str
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.executescript(SCHEMA)
+
+    logger.info('writing the posts of %s to %s' % (dataset_dir, db_fname))
+    num_posts = {}
+    rows = []
+    for user in ds.user_iter():
+        idx = user_ids.intern(user['user_id'])
+        num_posts[idx] = len(user['posts'])
+        for seq, post in enumerate(user['posts']):
+            rows.append(_post_row(idx, seq, post))
+        if len(rows) >= SQLITE_BATCH_SIZE:
+            conn.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            rows = []
+    conn.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    logger.info('writing the mention network to %s' % db_fname)
+    if len(ds.deltas()) > 0:
+        network_fname = ds._merged_network('mention_network.elist')
+    else:
+        network_fname = os.path.join(dataset_dir, 'mention_network.elist')
+    edges, weights = read_edges(network_fname, user_ids)
+    conn.executemany('INSERT INTO edges VALUES (?, ?, ?)',
+                     izip((edges >> 32).tolist(), (edges & 0xffffffff).tolist(),
+                          weights.tolist()))
+
+    meta = { 'users': source_signature(ds._users_fname),
+             'num_deltas': len(ds.deltas()) }
+    for fname in sorted(glob.glob(os.path.join(dataset_dir, 'users.home-locations.*.tsv.gz'))):
+        source = os.path.basename(fname)
+        logger.info('writing the home locations of %s to %s' % (source, db_fname))
+        users, lats, lons = load_home_locations(fname, user_ids)
+        conn.executemany('INSERT OR REPLACE INTO home_locations VALUES (?, ?, ?, ?)',
+                         ((source, u, lat, lon) for u, lat, lon
+                          in izip(users.tolist(), lats.tolist(), lons.tolist())))
+        meta['home_locations:' + source] = source_signature(fname)
+
+    # Every user in the id table is stored, including those who were only
+    # mentioned or only have a home location, so that the other tables can
+    # be joined to their user ids
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?)',
+                     ((idx, _encode(user_ids.user_id(idx)), num_posts.get(idx, 0))
+                      for idx in xrange(len(user_ids))))
+    if user_ids.is_dirty():
+        user_ids.save()
+
+    conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                     ((key, json.dumps(value)) for key, value in meta.iteritems()))
+    logger.info('indexing %s' % db_fname)
+    conn.executescript(INDICES)
+    conn.commit()
+    conn.close()
+    os.rename(tmp_fname, db_fname)
+
+def _encode(value):
+    """
+    Returns the string as utf-8 bytes, which is how text is stored.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _post_row(user, seq, post):
+    """
+    Returns the row of the posts table for the post.
+    """
+    lat = lon = None
+    geo = post.get('geo')
+    if isinstance(geo, dict) and isinstance(geo.get('coordinates'), list) \
+            and len(geo['coordinates']) >= 2:
+        lat, lon = geo['coordinates'][:2]
+    location = None
+    if isinstance(post.get('user'), dict):
+        location = post['user'].get('location')
+    return (user, seq, _encode(post.get('text')), lat, lon, _encode(location),
+            json.dumps(post))
+
+class SqliteDataset(SparseDataset):
+    """
+    A dataset whose users, home locations and mention network neighbors are
+    read from its SQLite store (see `build_sqlite_dataset`).  The arguments
+    are those of `SparseDataset`, along with `db_fname` (by default,
+    `dataset_dir/dataset.sqlite`).
+    """
+
+    def __init__(self, dataset_dir, *args, **kwargs):
+        db_fname = kwargs.pop('db_fname', None)
+        super(SqliteDataset, self).__init__(dataset_dir, *args, **kwargs)
+        if db_fname is None:
+            db_fname = os.path.join(dataset_dir, SQLITE_FNAME)
+        self._db_fname = db_fname
+        self._conn = None
+        self._conn_pid = None
+        self._db_meta = None
+        self._store_current = None
+
+    def _db(self):
+        """
+        Returns the connection to the store, opening it in each process, since
+        a connection cannot be shared by the workers of `map_users`.
+        """
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self._db_fname)
+            self._conn.text_factory = str
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _meta(self):
+        if self._db_meta is None:
+            self._db_meta = dict((key, json.loads(value)) for key, value
+                                 in self._db().execute('SELECT key, value FROM meta'))
+        return self._db_meta
+
+    def has_store(self):
+        """
+        Returns True if the store exists and was built from the current users
+        file and deltas.
+        """
+        if self._store_current is None:
+            if not os.path.exists(self._db_fname):
+                self._store_current = False
+            else:
+                meta = self._meta()
+                self._store_current = meta['users'] == source_signature(self._users_fname) \
+                    and meta['num_deltas'] == len(self.deltas())
+                if not self._store_current:
+                    logger.warn('%s is out of date' % self._db_fname)
+        return self._store_current
+
+    def _has_home_locations(self):
+        """
+        Returns True if the store holds the current home locations of the
+        location source of this dataset.
+        """
+        fname = self._users_with_locations_fname
+        key = 'home_locations:' + os.path.basename(fname)
+        return self.has_store() and os.path.exists(fname) \
+            and self._meta().get(key) == source_signature(fname)
+
+    def num_users(self):
+        if not self.has_store():
+            return super(SqliteDataset, self).num_users()
+        return self._db().execute('SELECT COUNT(*) FROM users WHERE num_posts > 0').fetchone()[0]
+
+    def user_iter(self, fields=None, shard=None, num_shards=None):
+        if not self.has_store():
+            return super(SqliteDataset, self).user_iter(fields, shard, num_shards)
+        return self.iter_users(None, fields, shard, num_shards)
+
+    def iter_users(self, user_ids, fields=None, shard=None, num_shards=None):
+        """
+        Returns an iterator over the users with the specified ids (or all
+        users), as in `SparseDataset.iter_users`.  Users are looked up by
+        their id in the store, and shards are ranges of user indices.
+        """
+        if not self.has_store():
+            return super(SqliteDataset, self).iter_users(user_ids, fields, shard, num_shards)
+        return self._iter_db_users(user_ids, fields, shard, num_shards)
+
+    def _indexed_users_file(self, fields):
+        # Users are read from the store, so there is nothing to load before
+        # `map_users` forks its workers
+        if self.has_store():
+            return None
+        return super(SqliteDataset, self)._indexed_users_file(fields)
+
+    def _iter_db_users(self, user_ids, fields, shard, num_shards):
+        conn = self._db()
+        paths = None if fields is None else [f.split('.') for f in sorted(set(fields))]
+
+        bounds = ''
+        if shard is not None:
+            num_ids = conn.execute('SELECT MAX(id) + 1 FROM users').fetchone()[0] or 0
+            ids = numpy.array_split(numpy.arange(num_ids), num_shards)[shard]
+            if len(ids) == 0:
+                return
+            bounds = ' AND id BETWEEN %d AND %d' % (ids[0], ids[-1])
+
+        if user_ids is None:
+            batches = [conn.execute('SELECT id, user_id FROM users WHERE num_posts > 0%s '
+                                    'ORDER BY id' % bounds)]
+        else:
+            batches = self._lookup_batches(list(user_ids), bounds)
+
+        for batch in batches:
+            for idx, user_id in batch:
+                posts = [json.loads(post) for (post,) in conn.execute(
+                    'SELECT post FROM posts WHERE user = ? ORDER BY seq', (idx,))]
+                yield self._make_user(user_id.decode('utf-8'), posts, paths)
+
+    def _lookup_batches(self, user_ids, bounds=''):
+        """
+        Returns the (id, user_id) rows of the users with posts among the ids,
+        in batches ordered by index.
+        """
+        conn = self._db()
+        for i in xrange(0, len(user_ids), SQLITE_BATCH_SIZE):
+            batch = [_encode(u) for u in user_ids[i:i + SQLITE_BATCH_SIZE]]
+            yield conn.execute('SELECT id, user_id FROM users WHERE num_posts > 0%s AND user_id IN (%s) '
+                               'ORDER BY id' % (bounds, ','.join('?' * len(batch))),
+                               batch).fetchall()
+
+    def _make_user(self, user_id, posts, paths):
+        if paths is not None:
+            posts = [project_post(post, paths) for post in posts]
+        if user_id in self.excluded_users:
+            for post in posts:
+                post.pop('geo', None)
+        return { 'user_id': user_id, 'posts': posts }
+
+    def get_user(self, user_id, fields=None):
+        """
+        Returns the user with the specified id, or None if the dataset has no
+        such user.
+        """
+        for user in self.iter_users([user_id], fields):
+            return user
+        return None
+
+    def user_home_location_iter(self, interned=False):
+        """
+        Returns an iterator over all the users whose home location has been
+        already identified, as in `SparseDataset.user_home_location_iter`.
+        """
+        if not self._has_home_locations():
+            return super(SqliteDataset, self).user_home_location_iter(interned)
+        return self._iter_home_locations(interned)
+
+    def _iter_home_locations(self, interned):
+        source = os.path.basename(self._users_with_locations_fname)
+        cursor = self._db().execute(
+            'SELECT h.user, u.user_id, h.lat, h.lon FROM home_locations h '
+            'JOIN users u ON u.id = h.user WHERE h.source = ? ORDER BY h.user', (source,))
+        for idx, user_id, lat, lon in cursor:
+            user_id = user_id.decode('utf-8')
+            if user_id in self.excluded_users:
+                continue
+            yield (idx if interned else user_id), (lat, lon)
+
+    def home_location(self, user_id):
+        """
+        Returns the (lat, lon) home location of the user, or None if it is not
+        known (or the user is excluded).
+        """
+        if user_id in self.excluded_users:
+            return None
+        if not self._has_home_locations():
+            idx = self.user_ids().get(user_id)
+            users, lats, lons = self.user_home_locations()
+            found = numpy.nonzero(users == idx)[0]
+            if len(found) == 0:
+                return None
+            return (float(lats[found[0]]), float(lons[found[0]]))
+        source = os.path.basename(self._users_with_locations_fname)
+        row = self._db().execute(
+            'SELECT h.lat, h.lon FROM home_locations h JOIN users u ON u.id = h.user '
+            'WHERE h.source = ? AND u.user_id = ?', (source, _encode(user_id))).fetchone()
+        return row
+
+    def neighbors(self, user_id, direction='out', mutual=False):
+        """
+        Returns the {user id: weight} of the user's neighbors in the directed,
+        weighted mention network: the users they mentioned ('out'), the users
+        who mentioned them ('in') or both ('both', with the weights of the two
+        directions summed).  If `mutual` is True, only users who have mentioned
+        each other are returned, as in the bidirectional mention network.
+        """
+        if not direction in ('out', 'in', 'both'):
+            raise ValueError('unknown direction: %s' % direction)
+        if not self.has_store():
+            raise Exception('%s has no current SQLite store; see build_sqlite_dataset'
+                            % self._dataset_dir)
+        conn = self._db()
+        row = conn.execute('SELECT id FROM users WHERE user_id = ?', (_encode(user_id),)).fetchone()
+        if row is None:
+            return {}
+        idx = row[0]
+
+        if mutual:
+            query = ('SELECT e.dst, e.weight + r.weight FROM edges e JOIN edges r '
+                     'ON r.src = e.dst AND r.dst = e.src WHERE e.src = ? AND e.dst != e.src')
+            if direction == 'out':
+                query = query.replace('e.weight + r.weight', 'e.weight')
+            elif direction == 'in':
+                query = query.replace('e.weight + r.weight', 'r.weight')
+            params = (idx,)
+        elif direction == 'out':
+            query, params = 'SELECT dst, weight FROM edges WHERE src = ?', (idx,)
+        elif direction == 'in':
+            query, params = 'SELECT src, weight FROM edges WHERE dst = ?', (idx,)
+        else:
+            query = ('SELECT n, SUM(w) FROM (SELECT dst AS n, weight AS w FROM edges WHERE src = ? '
+                     'UNION ALL SELECT src AS n, weight AS w FROM edges WHERE dst = ?) GROUP BY n')
+            params = (idx, idx)
+
+        neighbors = dict(conn.execute(query, params).fetchall())
+        if len(neighbors) == 0:
+            return {}
+        names = {}
+        ids = neighbors.keys()
+        for i in xrange(0, len(ids), SQLITE_BATCH_SIZE):
+            batch = ids[i:i + SQLITE_BATCH_SIZE]
+            names.update(conn.execute('SELECT id, user_id FROM users WHERE id IN (%s)'
+                                      % ','.join('?' * len(batch)), batch).fetchall())
+        return dict((names[n].decode('utf-8'), w) for n, w in neighbors.iteritems())
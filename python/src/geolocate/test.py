@@ -10,6 +10,22 @@ import logging
 from tests.dataset import *
 from tests.cmdline import *
 from tests.gimethod import *
+from tests.csr_graph import *
+from tests.mention_edges import *
+from tests.block_gzip import *
+from tests.sparse_dataset import *
+from tests.compression import *
+from tests.columnar import *
+from tests.sqlite_dataset import *
+from tests.gazetteer import *
+from tests.geocode_cache import *
+from tests.home_locations import *
+from tests.regions import *
+from tests.geodesy import *
+from tests.geometric_median import *
+from tests.spatial_label_propagation import *
+from tests.multi_location import *
+from tests.spot import *
 
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG)
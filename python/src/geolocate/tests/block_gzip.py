@@ -0,0 +1,42 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.block_gzip import *
+import unittest
+import os, os.path
+import gzip
+import shutil
+import tempfile
+
+class BlockGzipTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.tmp_dir,'users.json.gz')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_random_access(self):
+		lines = ['line %d %s' % (i,'x' * (i % 50)) for i in range(2000)]
+
+		writer = BlockGzipWriter(self.fname,block_size=1024)
+		locations = [writer.write_line(line) for line in lines]
+		writer.close()
+
+		self.assertTrue(writer.num_blocks > 1)
+
+		# the file is still readable as a single gzip stream
+		fh = gzip.open(self.fname,'r')
+		self.assertEquals([x.rstrip('\n') for x in fh],lines)
+		fh.close()
+
+		# and lines can be read directly from their locations
+		wanted = [1999,3,1000,4]
+		fh = open(self.fname,'rb')
+		found = list(read_lines(fh,[locations[i] for i in wanted]))
+		fh.close()
+		self.assertEquals(found,[lines[i] for i in sorted(wanted)])
@@ -0,0 +1,83 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.columnar import *
+import unittest
+import os, os.path
+import gzip
+import json
+import shutil
+import tempfile
+import time
+
+from geolocate.dataset import posts2dataset
+
+def make_post(user_id, i):
+	post = { 'id': i, 'text': u'post %d \u00e9' % i, 'lang': 'en',
+			 'geo': { 'type': 'Point', 'coordinates': [40.0 + i, -70.0] } if i % 2 == 0 else None,
+			 'place': { 'full_name': 'Montreal, QC' } if i % 3 == 0 else None,
+			 'user': { 'id': 10 ** 15 + int(user_id), 'id_str': user_id,
+					   'location': 'Montreal' if i % 4 else '' } }
+	if i % 5 == 0:
+		del post['place']
+	if i % 11 == 0:
+		post['user'] = None
+	return post
+
+class ColumnarTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.dataset_dir = os.path.join(self.tmp_dir,'dataset')
+		posts_fname = os.path.join(self.tmp_dir,'posts.json.gz')
+		fh = gzip.open(posts_fname,'w')
+		for i in range(60):
+			fh.write(json.dumps(make_post(str(i % 7), i)) + '\n')
+		fh.close()
+		posts2dataset(self.dataset_dir,posts_fname,lambda p: str(p['id'] % 7),
+					  lambda p: [],num_workers=2)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_export(self):
+		meta = export_columnar(self.dataset_dir,fmt='npz')
+		self.assertEquals(meta['num_posts'],60)
+		self.assertEquals(meta['kinds'],{ 'text': 'string', 'geo': 'json', 'place': 'json',
+										  'user.id': 'int', 'user.id_str': 'string',
+										  'user.location': 'string' })
+
+		sparse = SparseDataset(self.dataset_dir)
+		ds = ColumnarDataset(self.dataset_dir,excluded_users=set(['3']))
+		self.assertTrue(ds.has_columns(['geo.coordinates','user.location']))
+		self.assertFalse(ds.has_columns(['lang']))
+
+		# posts with a null user keep it, as in the projections of SparseDataset
+		for fields in [DEFAULT_FIELDS, ['geo.coordinates','user.id'], ['user.location'], ['lang']]:
+			expected = dict((u['user_id'],u) for u in sparse.user_iter(fields=fields))
+			for user in expected['3']['posts']:
+				user.pop('geo',None)
+			users = dict((u['user_id'],u) for u in ds.user_iter(fields=fields))
+			self.assertEquals(users,expected)
+
+		shards = [[u['user_id'] for u in ds.user_iter(fields=['text'],shard=i,num_shards=3)]
+				  for i in range(3)]
+		self.assertEquals(sorted(sum(shards,[])),sorted(str(u) for u in range(7)))
+		self.assertEquals(ds.map_users(lambda u: len(u['posts']),fields=['text'],num_workers=2),
+						  dict((str(u),len(range(u,60,7))) for u in range(7)))
+
+		users, lats, lons = ds.gps_points()
+		self.assertEquals(len(users),sum(1 for i in range(0,60,2) if i % 7 != 3))
+		self.assertEquals(sorted(lats.tolist()),
+						  sorted(40.0 + i for i in range(0,60,2) if i % 7 != 3))
+		self.assertEquals(ds.user_table()['location'][0],u'Montreal')
+
+		# the columns are not used once the users file changes
+		time.sleep(1)
+		fh = gzip.open(os.path.join(self.dataset_dir,'users.json.gz'),'a')
+		fh.write(json.dumps({ 'user_id': 'new', 'posts': [] }) + '\n')
+		fh.close()
+		self.assertFalse(ColumnarDataset(self.dataset_dir).has_columns(['text']))
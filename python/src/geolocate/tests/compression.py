@@ -0,0 +1,67 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.compression import *
+import unittest
+import os, os.path
+import gzip
+import shutil
+import tempfile
+
+class CompressionTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.lines = ['line %d %s\n' % (i, 'x' * (i % 50)) for i in range(20000)]
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def check_codec(self, ext, threads):
+		fname = os.path.join(self.tmp_dir, 'data.tsv' + ext)
+		with open_file(fname, 'w', threads=threads) as fh:
+			for line in self.lines[:10000]:
+				fh.write(line)
+		with open_file(fname, 'a', threads=threads) as fh:
+			for line in self.lines[10000:]:
+				fh.write(line)
+
+		self.assertEquals(list(open_file(fname, 'r', threads=threads)), self.lines)
+		fh = open_file(fname, 'r', threads=threads)
+		self.assertEquals(fh.readline(), self.lines[0])
+		self.assertEquals(fh.read(), ''.join(self.lines[1:]))
+		fh.close()
+
+		# stopping part way through a file is not an error
+		fh = open_file(fname, 'r', threads=threads)
+		fh.readline()
+		fh.close()
+
+	def test_gzip(self):
+		self.check_codec('.gz', 0)
+		self.check_codec('.gz', 2)
+		self.assertEquals(list(gzip.open(os.path.join(self.tmp_dir, 'data.tsv.gz'))), self.lines)
+
+	def test_plain(self):
+		self.check_codec('', 0)
+
+	def test_zstd(self):
+		if has_codec('zstd'):
+			self.check_codec('.zst', 0)
+			self.check_codec('.zst', 2)
+
+	def test_lz4(self):
+		if has_codec('lz4'):
+			self.check_codec('.lz4', 0)
+
+	def test_find_file(self):
+		base_fname = os.path.join(self.tmp_dir, 'posts.json')
+		self.assertEquals(find_file(base_fname), base_fname + '.gz')
+		open(base_fname + '.zst', 'w').close()
+		self.assertEquals(find_file(base_fname), base_fname + '.zst')
+		self.assertEquals(codec_of(find_file(base_fname)), 'zstd')
+		self.assertEquals(model_extension({ 'model_codec': 'lz4' }), '.lz4')
+		self.assertEquals(model_extension({}), '.gz')
@@ -0,0 +1,87 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.csr_graph import *
+from geolocate.user_ids import UserIdTable
+import unittest
+import os, os.path
+import shutil
+import tempfile
+
+class CSRGraphTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.elist_fname = os.path.join(self.tmp_dir,'mention_network.elist')
+		fh = open(self.elist_fname,'w')
+		fh.write('a b 1\nb a 2\na c 1\nc d 4\na b 3\n')
+		fh.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_undirected(self):
+		G = load_csr(self.elist_fname,directed=False,weighted=False)
+
+		self.assertEquals(len(G),4)
+		self.assertEquals(G.size(),3)
+		self.assertEquals(sorted(G.neighbors('a')),['b','c'])
+		self.assertTrue(G.has_edge('c','a'))
+		self.assertFalse(G.has_edge('b','d'))
+		self.assertEquals(G.degree('a'),2)
+
+	def test_directed_weighted(self):
+		G = load_csr(self.elist_fname,directed=True,weighted=True)
+
+		self.assertEquals(G.size(),4)
+		self.assertEquals(G.out_neighbors('b'),['a'])
+		self.assertEquals(G.in_neighbors('c'),['a'])
+		self.assertEquals(sorted(G.neighbors('a')),['b','c'])
+		# duplicate edges keep the first weight seen
+		self.assertEquals(G.weight('a','b'),1.0)
+
+	def test_invalidation(self):
+		G = load_csr(self.elist_fname,directed=False,weighted=False)
+		self.assertEquals(len(G),4)
+
+		fh = open(self.elist_fname,'a')
+		fh.write('x y 1\n')
+		fh.close()
+
+		G = load_csr(self.elist_fname,directed=False,weighted=False)
+		self.assertEquals(len(G),6)
+		self.assertTrue(G.has_edge('y','x'))
+
+		# A rewrite of the same size within the same second is still noticed
+		mtime = int(os.stat(self.elist_fname).st_mtime)
+		os.utime(self.elist_fname,(mtime,mtime + 0.25))
+		G = load_csr(self.elist_fname,directed=False,weighted=False)
+		fh = open(self.elist_fname,'w')
+		fh.write('a b 1\nb a 2\na c 1\nc d 4\na b 3\nx z 1\n')
+		fh.close()
+		os.utime(self.elist_fname,(mtime,mtime + 0.5))
+		G = load_csr(self.elist_fname,directed=False,weighted=False)
+		self.assertTrue(G.has_edge('z','x'))
+		self.assertFalse(G.has_edge('y','x'))
+
+	def test_shared_ids(self):
+		ids_fname = os.path.join(self.tmp_dir,'users.ids.txt.gz')
+		table = UserIdTable(['z','a'],fname=ids_fname)
+		table.save()
+
+		G = load_csr(self.elist_fname,directed=False,weighted=False,id_table=table)
+
+		# mentioned users are appended after the existing ids
+		self.assertEquals(len(table),5)
+		self.assertTrue(table.is_dirty())
+		self.assertEquals(G.node_idx('a'),1)
+		self.assertFalse('z' in G)
+		self.assertEquals(sorted(G.neighbors('a')),['b','c'])
+
+		table.save()
+		reloaded = UserIdTable.load(ids_fname)
+		self.assertEquals(list(reloaded),['z','a','b','c','d'])
+		self.assertEquals(list(reloaded.indices(['c','q'])),[3,-1])
@@ -5,10 +5,13 @@
 ##
 
 from geolocate.dataset import *
+from geolocate.sparse_dataset import SparseDataset
 import zen
 import unittest
 import os, os.path
 import gzip
+import shutil
+import tempfile
 
 post_file = os.path.join(os.path.dirname(__file__),'posts.json.gz')
 
@@ -32,6 +35,48 @@ class DatasetBuildingTestCase(unittest.TestCase):
 		# delete the users file
 		os.remove(users_file)
 
+	def test_build_users_sharded(self):
+		tmp_dir = tempfile.mkdtemp()
+		tmp_post_file = os.path.join(tmp_dir,'posts.json.gz')
+
+		# user ids need not be numeric
+		fh = gzip.open(tmp_post_file,'w')
+		for i in range(1000):
+			fh.write(json.dumps({ 'user': 'u%d' % (i % 37), 'text': 'post %d' % i }) + '\n')
+		fh.write('not json\n')
+		fh.close()
+
+		posts2users(tmp_post_file,lambda x: x['user'],max_open_temp_files=8,num_workers=3)
+
+		users = [json.loads(x) for x in gzip.open(os.path.join(tmp_dir,'users.json.gz'),'r')]
+		self.assertEquals(len(users),37)
+		self.assertEquals(sum(map(lambda x: len(x['posts']),users)),1000)
+		for user in users:
+			self.assertTrue(all(p['user'] == user['user_id'] for p in user['posts']))
+
+		# only the dataset files should be left behind
+		self.assertEquals(sorted(os.listdir(tmp_dir)),
+						  ['posts.json.gz','users.ids.txt.gz','users.index.npy','users.json.gz'])
+
+		shutil.rmtree(tmp_dir)
+
+	def test_build_users_errors(self):
+		tmp_dir = tempfile.mkdtemp()
+
+		# a missing posts file fails before any worker is started
+		self.assertRaises(IOError, lambda: posts2users(os.path.join(tmp_dir,'posts.json.gz'),
+													   lambda x: x['user'],num_workers=2))
+
+		# an unreadable one stops the workers rather than leaving them waiting
+		tmp_post_file = os.path.join(tmp_dir,'posts.json.gz')
+		fh = open(tmp_post_file,'w')
+		fh.write('not gzip\n')
+		fh.close()
+		self.assertRaises(IOError, lambda: posts2users(tmp_post_file,lambda x: x['user'],num_workers=2))
+		self.assertEquals(os.listdir(tmp_dir),['posts.json.gz'])
+
+		shutil.rmtree(tmp_dir)
+
 	def test_build_mention_network(self):
 		posts2mention_network(post_file,lambda x: str(x['user_id']),
 							  lambda x: map(str,x.get('mentions',[])))
@@ -49,6 +94,123 @@ class DatasetBuildingTestCase(unittest.TestCase):
 		# done
 		os.remove(network_fname)
 
+	def test_build_bi_mention_network(self):
+		tmp_dir = tempfile.mkdtemp()
+		tmp_post_file = os.path.join(tmp_dir,'posts.json.gz')
+
+		# a and b mention each other (a three times), and c mentions a and itself
+		fh = gzip.open(tmp_post_file,'w')
+		for uid, mentions in [('a',['b']),('a',['b','c']),('b',['a']),('a',['b']),('c',['a','c'])]:
+			fh.write(json.dumps({ 'user': uid, 'mentions': mentions }) + '\n')
+		fh.close()
+
+		posts2mention_network(tmp_post_file,lambda x: x['user'],lambda x: x['mentions'])
+
+		def read_elist(fname):
+			return sorted(tuple(line.split()) for line in open(os.path.join(tmp_dir,fname)))
+
+		self.assertEquals(read_elist('mention_network.elist'),
+						  [('a','b','3'),('a','c','1'),('b','a','1'),('c','a','1'),('c','c','1')])
+		self.assertEquals(read_elist('bi_mention_network.directed.weighted.elist'),
+						  [('a','b','3'),('a','c','1'),('b','a','1'),('c','a','1')])
+		self.assertEquals(read_elist('bi_mention_network.weighted.elist'),
+						  [('a','b','4'),('a','c','2')])
+		self.assertEquals(read_elist('bi_mention_network.elist'),
+						  [('a','b'),('a','c')])
+
+		shutil.rmtree(tmp_dir)
+
+	def test_append_and_compact(self):
+		tmp_dir = tempfile.mkdtemp()
+		dataset_dir = os.path.join(tmp_dir,'dataset')
+
+		def write_posts(fname, posts):
+			fh = gzip.open(fname,'w')
+			for uid, mentions in posts:
+				fh.write(json.dumps({ 'user': uid, 'mentions': mentions }) + '\n')
+			fh.close()
+
+		def read_elist(fname):
+			return sorted(tuple(line.split()) for line in open(fname))
+
+		extract_user_id = lambda x: x['user']
+		extract_mentions = lambda x: x['mentions']
+
+		write_posts(os.path.join(tmp_dir,'base.json.gz'),[('a',['b']),('b',[]),('c',['a'])])
+		posts2dataset(dataset_dir,os.path.join(tmp_dir,'base.json.gz'),
+					  extract_user_id,extract_mentions)
+
+		# b mentions a back, and d is a new user
+		write_posts(os.path.join(tmp_dir,'day1.json.gz'),[('b',['a']),('d',['a'])])
+		write_posts(os.path.join(tmp_dir,'day2.json.gz'),[('d',['c']),('a',['c'])])
+		for day in ['day1','day2']:
+			append_posts(dataset_dir,os.path.join(tmp_dir,day + '.json.gz'),
+						 extract_user_id,extract_mentions)
+
+		def check(ds):
+			users = dict((u['user_id'],u['posts']) for u in ds.user_iter())
+			self.assertEquals(sorted(users.keys()),['a','b','c','d'])
+			self.assertEquals([p['mentions'] for p in users['a']],[['b'],['c']])
+			self.assertEquals([p['mentions'] for p in users['d']],[['a'],['c']])
+			self.assertEquals(len(list(ds.iter_users(['b','d']))),2)
+			self.assertEquals(len(ds.get_user('d')['posts']),2)
+
+		ds = SparseDataset(dataset_dir)
+		self.assertEquals(len(ds.deltas()),2)
+		check(ds)
+		merged_bi = read_elist(ds._merged_network('bi_mention_network.elist'))
+		self.assertEquals(merged_bi,[('a','b'),('a','c')])
+
+		compact_dataset(dataset_dir)
+		self.assertFalse(os.path.exists(os.path.join(dataset_dir,'deltas')))
+		ds = SparseDataset(dataset_dir)
+		self.assertEquals(len(ds.deltas()),0)
+		check(ds)
+		self.assertEquals(read_elist(os.path.join(dataset_dir,'bi_mention_network.elist')),merged_bi)
+		self.assertEquals(len([x for x in gzip.open(os.path.join(dataset_dir,'posts.json.gz'))]),7)
+
+		shutil.rmtree(tmp_dir)
+
+	def test_manifest(self):
+		tmp_dir = tempfile.mkdtemp()
+		dataset_dir = os.path.join(tmp_dir,'dataset')
+
+		# enough posts that the users file has several blocks
+		fh = gzip.open(os.path.join(tmp_dir,'posts.json.gz'),'w')
+		for i in range(6000):
+			fh.write(json.dumps({ 'user': 'u%d' % (i % 2000), 'mentions': ['u%d' % ((i + 1) % 2000)],
+								  'text': 'post %d %s' % (i,'x' * 40) }) + '\n')
+		fh.close()
+		posts2dataset(dataset_dir,os.path.join(tmp_dir,'posts.json.gz'),
+					  lambda x: x['user'],lambda x: x['mentions'])
+
+		manifest = json.load(open(os.path.join(dataset_dir,'dataset.json')))
+		self.assertEquals(manifest['num_users'],2000)
+		self.assertEquals(manifest['num_posts'],6000)
+		self.assertEquals(manifest['user_ids']['count'],2000)
+		self.assertEquals(manifest['networks']['mention_network.elist']['num_edges'],2000)
+		self.assertEquals(manifest['networks']['bi_mention_network.elist']['num_edges'],0)
+		self.assertEquals(manifest['files']['users.json.gz']['size'],
+						  os.path.getsize(os.path.join(dataset_dir,'users.json.gz')))
+		self.assertTrue(manifest['users_blocks']['count'] > 1)
+
+		ds = SparseDataset(dataset_dir)
+		self.assertEquals(ds.num_users(),2000)
+		self.assertEquals(ds.num_posts(),6000)
+
+		# the manifest's block offsets split the users into disjoint shards
+		shards = [[u['user_id'] for u in ds.user_iter(shard=i,num_shards=3)] for i in range(3)]
+		self.assertTrue(all(len(shard) > 0 for shard in shards))
+		self.assertEquals(sorted(sum(shards,[])),sorted('u%d' % i for i in range(2000)))
+
+		# a stale manifest is ignored
+		fh = gzip.open(os.path.join(dataset_dir,'users.json.gz'),'a')
+		fh.write(json.dumps({ 'user_id': 'new', 'posts': [] }) + '\n')
+		fh.close()
+		self.assertEquals(SparseDataset(dataset_dir).num_users(),None)
+
+		shutil.rmtree(tmp_dir)
+
 	def test_build_dataset(self):
 		dataset_dir = os.path.join(os.path.dirname(__file__),'__tmp_dataset')
 
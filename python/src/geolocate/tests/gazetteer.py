@@ -0,0 +1,172 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.gazetteer import *
+import unittest
+import os, os.path
+import gzip
+import shutil
+import tempfile
+
+import geolocate.geocoder as geocoder
+
+class GazetteerTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.cwd = os.getcwd()
+
+		# The geocoder reads its resources relative to the working directory
+		resources_dir = os.path.join(self.tmp_dir, 'geolocate', 'resources')
+		os.makedirs(resources_dir)
+		shutil.copy(os.path.join(os.path.dirname(geocoder.__file__), 'resources', 'state_table.csv'),
+					resources_dir)
+		fh = gzip.open(os.path.join(resources_dir, 'geonames.exanded-cities.tsv.gz'), 'w')
+		fh.write('city\tregion\tcountry\tlat\tlon\n')
+		fh.write('Montreal\tQuebec\tCanada\t45.5\t-73.6\n')
+		fh.write('Laval\tQuebec\tCanada\t45.57\t-73.69\n')
+		fh.write('Springfield\tIllinois\tUnited States\t39.8\t-89.64\n')
+		fh.write('Springfield\tMissouri\tUnited States\t37.2\t-93.29\n')
+		fh.write('Singapore\t\tSingapore\t1.29\t103.85\n')
+		fh.write('Saint-Laurent\tQuebec\tCanada\t45.5001\t-73.6001\n')
+		fh.close()
+		os.chdir(self.tmp_dir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmp_dir)
+
+	def test_geocoder(self):
+		parsed = geocoder.Geocoder('geonames')
+		self.assertTrue(isinstance(parsed.table, InternedSettlementTable))
+
+		meta = geocoder.build_gazetteer('geonames')
+		self.assertEquals(meta['num_locations'], len(parsed.geocoder))
+		mapped = geocoder.Geocoder('geonames')
+		self.assertTrue(isinstance(mapped.table, MappedSettlementTable))
+
+		self.assertEquals(dict(mapped.geocoder.iteritems()), dict(parsed.geocoder.iteritems()))
+		self.assertEquals(set(mapped.get_cities()), set(parsed.get_cities()))
+		self.assertTrue('singapore' in mapped.get_cities())
+		for cell in [(45.5, -73.6), (45.57, -73.69), (1.29, 103.85)]:
+			self.assertEquals(mapped.reverse_geocoder[cell], parsed.reverse_geocoder[cell])
+		self.assertEquals(parsed.reverse_geocoder[(39.8, -89.64)], [(39.8, -89.64, 'springfield\tillinois\tunited states')])
+		self.assertEquals(mapped.reverse_geocoder[(0.0, 0.0)], [])
+
+		self.assertEquals(mapped.geocode('Montreal'), (45.5, -73.6))
+		self.assertEquals(mapped.geocode('springfield'), None)
+		self.assertEquals(mapped.geocode(u'springfield\tmissouri'), (37.2, -93.29))
+		for name in ['Montreal, QC', 'springfield, IL', 'Laval Quebec', 'nowhere']:
+			self.assertEquals(mapped.geocode_noisy(name), parsed.geocode_noisy(name))
+		for lat, lon in [(45.5, -73.6), (45.505, -73.605), (45.57, -73.7), (10.0, 10.0)]:
+			self.assertEquals(mapped.reverse_geocode(lat, lon), parsed.reverse_geocode(lat, lon))
+			self.assertEquals(mapped.canonicalize(lat, lon), parsed.canonicalize(lat, lon))
+
+		# the compiled gazetteer is not used once its source changes
+		os.utime(geocoder.gazetteer_source('geonames'), (0, 0))
+		self.assertTrue(isinstance(geocoder.Geocoder('geonames').table, InternedSettlementTable))
+
+	def test_shared_prefixes(self):
+		names = dict(('san francisco %d' % i, (float(i), 0.0)) for i in range(100))
+		builder = SettlementTableBuilder()
+		for name, (lat, lon) in names.iteritems():
+			builder.add_name(name, lat, lon)
+		builder.add_city('san francisco 7')
+		gazetteer_dir = os.path.join(self.tmp_dir, 'gazetteer')
+		write_gazetteer(gazetteer_dir, builder.build())
+		mapped = MappedSettlementTable(gazetteer_dir)
+		table, cells, cities = NameTable(mapped), CellIndex(mapped), CityNames(mapped)
+		self.assertEquals(len(table), 100)
+		for name, location in names.iteritems():
+			self.assertEquals(table[name], location)
+		self.assertFalse('san francisco' in table)
+		self.assertFalse('san francisco 100' in table)
+		self.assertEquals(table.get('san', 'missing'), 'missing')
+		self.assertRaises(KeyError, lambda: table['zzz'])
+		self.assertEquals(list(cities), ['san francisco 7'])
+		self.assertEquals(len(cells), 0)
+		self.assertEquals(cells[(1.0, 1.0)], [])
+
+	def test_reverse_geocode(self):
+		for use_gazetteer in [False, True]:
+			if use_gazetteer:
+				geocoder.build_gazetteer('geonames')
+			gc = geocoder.Geocoder('geonames')
+			self.assertEquals(gc.reverse_geocode(45.5, -73.6), 'montreal\tquebec\tcanada')
+			# several cells away, which is only the closest city if it is
+			# searched for further than the default distance
+			self.assertEquals(gc.reverse_geocode(45.55, -73.72), None)
+			self.assertEquals(gc.reverse_geocode(45.55, -73.72, max_distance=20), 'laval\tquebec\tcanada')
+			self.assertEquals(gc.reverse_geocode(45.7, -73.6, max_distance=20), 'laval\tquebec\tcanada')
+			self.assertEquals(gc.reverse_geocode(45.7, -73.6, max_distance=5), None)
+			self.assertEquals(gc.reverse_geocode(10.0, 10.0), None)
+			self.assertEquals(gc.reverse_geocode_many([45.5, float('nan'), 39.81, 1.3], [-73.6, 0.0, -89.65, 103.85]),
+							  ['montreal\tquebec\tcanada', None, 'springfield\tillinois\tunited states', 'singapore'])
+			self.assertEquals(gc.canonicalize(39.81, -89.65), (39.8, -89.64))
+			self.assertEquals(gc.canonicalize(0.0, 0.0), (0.0, 0.0))
+
+	def test_canonicalize_many(self):
+		gc = geocoder.Geocoder('geonames')
+		coords = [(39.81, -89.65), (0.0, 0.0), (45.5, -73.6), (39.81, -89.65), (45.4999, -73.5999)]
+		canonical, settlements = gc.canonicalize_many(coords)
+		self.assertEquals([tuple(c) for c in canonical.tolist()],
+						  [gc.canonicalize(lat, lon) for lat, lon in coords])
+		self.assertEquals(settlements[0], settlements[3])
+		self.assertEquals(settlements[2], settlements[4])
+		self.assertEquals(settlements[1], -1)
+		self.assertEquals(gc.settlement_index().name(settlements[0]), 'springfield\tillinois\tunited states')
+		self.assertEquals(len(gc.canonicalize_many([])[0]), 0)
+
+	def test_geocode_noisy_many(self):
+		gc = geocoder.Geocoder('geonames', noisy_cache_size=10)
+		names = ['Montreal, QC', ' Montreal, QC ', 'nowhere', 'Laval Quebec', 'Montreal, QC']
+		expected = [gc.geocode_noisy(name) for name in names]
+		self.assertEquals(gc.noisy_cache.stats()['misses'], 3)
+		self.assertEquals(expected[0], (45.5, -73.6))
+		self.assertEquals(gc.geocode_noisy_many(names), expected)
+		self.assertEquals(gc.noisy_cache.stats()['misses'], 3)
+
+	def test_find_mentions(self):
+		for use_gazetteer in [False, True]:
+			if use_gazetteer:
+				geocoder.build_gazetteer('geonames')
+			gc = geocoder.Geocoder('geonames')
+			text = u'From Montreal Quebec Canada to Laval Quebec, and Springfield Illinois Rocks in montreal'
+			mentions = gc.find_mentions(text, capitalized_only=True)
+			self.assertEquals([(text[start:end], name) for start, end, name, location in mentions],
+							  [(u'Montreal Quebec Canada', 'montreal\tquebec\tcanada'),
+							   (u'Laval', 'laval'),
+							   (u'Springfield Illinois', 'springfield\tillinois')])
+			self.assertEquals(mentions[0][3], (45.5, -73.6))
+			self.assertEquals(gc.find_mentions(u'Laval Quebec is near montreal')[0][2], 'laval\tquebec')
+			self.assertEquals([m[2] for m in gc.find_mentions(u'Laval Quebec is near montreal')],
+							  ['laval\tquebec', 'montreal'])
+			self.assertEquals(gc.find_mentions_many([u'', u'Singapore!', u'Singapore']),
+							  [[], [], [(0, 9, 'singapore', (1.29, 103.85))]])
+
+	def test_regions(self):
+		for use_gazetteer in [False, True]:
+			if use_gazetteer:
+				geocoder.build_gazetteer('geonames')
+			table = geocoder.Geocoder('geonames').table
+			entries = [(table.entry_name(j), table.entry_region(j), table.entry_country(j))
+					   for j in range(len(table.entry_names))]
+			self.assertTrue(('springfield\tmissouri\tunited states', 'missouri', 'united states') in entries)
+			self.assertTrue(('singapore', '', 'singapore') in entries)
+			self.assertEquals(len(table.regions), 4)
+
+	def test_memory_report(self):
+		report = geocoder.Geocoder('geonames').memory_report()
+		self.assertEquals(report['entries'], 6)
+		self.assertEquals(report['mapped'], 0)
+		self.assertTrue(report['heap'] > 0)
+		self.assertEquals(report['dicts'], sum(report['dict_parts'].itervalues()))
+
+		geocoder.build_gazetteer('geonames')
+		mapped = geocoder.Geocoder('geonames').memory_report()
+		self.assertEquals(mapped['names'], report['names'])
+		self.assertTrue(mapped['heap'] < report['heap'])
+		self.assertTrue(mapped['mapped'] > 0)
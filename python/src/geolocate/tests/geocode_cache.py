@@ -0,0 +1,57 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.geocode_cache import *
+import unittest
+import os, os.path
+import gzip
+import shutil
+import tempfile
+
+class GeocodeCacheTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_lru(self):
+		cache = GeocodeCache(max_size=2)
+		cache.put('london', (51.5, -0.13))
+		cache.put('nowhere', None)
+		self.assertEquals(cache.get('london'), (51.5, -0.13))
+		cache.put('paris', (48.86, 2.35))
+		# nowhere was the least recently used name
+		self.assertTrue(cache.get('nowhere') is MISSING)
+		self.assertEquals(cache.get('nowhere', 'default'), 'default')
+		self.assertEquals(cache.get('paris'), (48.86, 2.35))
+		self.assertEquals(cache.stats(), { 'hits': 2, 'misses': 2, 'size': 2, 'stored': 0 })
+
+	def test_file(self):
+		fname = os.path.join(self.tmp_dir, 'cache.json.gz')
+		cache = GeocodeCache(max_size=1, fname=fname)
+		cache.put('london', (51.5, -0.13))
+		cache.put('nowhere', None)
+		cache.put(u'montr\u00e9al', (45.5, -73.6))
+		# names that were evicted are still in the file
+		self.assertEquals(cache.get('london'), (51.5, -0.13))
+		cache.close()
+
+		cache = GeocodeCache(max_size=1, fname=fname)
+		self.assertEquals(cache.get('london'), (51.5, -0.13))
+		self.assertEquals(cache.get('nowhere'), None)
+		self.assertEquals(cache.get(u'montr\u00e9al'), (45.5, -73.6))
+		self.assertEquals(cache.misses, 0)
+		cache.put('paris', (48.86, 2.35))
+		cache.close()
+		self.assertEquals(len(load_cache_file(fname)), 4)
+
+		# a cut-off last line is ignored
+		fh = gzip.open(fname, 'a')
+		fh.write('["rome", [41.9')
+		fh.close()
+		self.assertEquals(len(load_cache_file(fname)), 4)
@@ -0,0 +1,59 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.geodesy import *
+import unittest
+import math
+
+import numpy
+
+class GeodesyTestCase(unittest.TestCase):
+
+	def test_haversine(self):
+		self.assertAlmostEquals(haversine(0.0, 0.0, 0.0, 90.0), EARTH_RADIUS_KM * math.pi / 2)
+		self.assertAlmostEquals(haversine(0.0, 0.0, 0.0, 90.0, miles=True),
+								EARTH_RADIUS_KM * math.pi / 2 / KM_PER_MILE)
+		self.assertEquals(haversine(45.5, -73.6, 45.5, -73.6), 0.0)
+		self.assertTrue(isinstance(haversine(1, 2, 3, 4), float))
+		self.assertEquals(haversine([0.0, 45.5], [0.0, -73.6], 0.0, 0.0).shape, (2,))
+
+	def test_vincenty(self):
+		# Flinders Peak to Buninyong, from Vincenty's paper
+		self.assertAlmostEquals(vincenty(-37.95103342, 144.42486789, -37.65282114, 143.92649554),
+								54.972271, places=5)
+		self.assertAlmostEquals(vincenty(0.0, 0.0, 0.0, 90.0), WGS84_A_KM * math.pi / 2, places=6)
+		self.assertEquals(vincenty(45.5, -73.6, 45.5, -73.6), 0.0)
+		# Nearly antipodal points do not converge, and get the haversine distance
+		self.assertEquals(vincenty(0.0, 0.0, 0.5, 179.7), haversine(0.0, 0.0, 0.5, 179.7))
+		self.assertEquals(vincenty([0.0, -37.95103342], [0.0, 144.42486789],
+								   [0.5, -37.65282114], [179.7, 143.92649554]).tolist(),
+						  [vincenty(0.0, 0.0, 0.5, 179.7),
+						   vincenty(-37.95103342, 144.42486789, -37.65282114, 143.92649554)])
+
+	def test_points(self):
+		points1 = [(45.5, -73.6), (40.7, -74.0), (51.5, -0.1)]
+		points2 = [(45.57, -73.69), (34.1, -118.2), (48.9, 2.4)]
+		for metric in ['haversine', 'vincenty']:
+			expected = [[distance(p1, p2, metric) for p2 in points2] for p1 in points1]
+			for chunk_size in [1, 4, DEFAULT_CHUNK_SIZE]:
+				matrix = many_to_many(points1, points2, metric, chunk_size=chunk_size)
+				self.assertTrue(numpy.allclose(matrix, expected, rtol=0, atol=1e-9))
+			self.assertTrue(numpy.allclose(pairwise(points1, points2, metric),
+										   [expected[i][i] for i in range(3)], rtol=0, atol=1e-9))
+			self.assertTrue(numpy.allclose(one_to_many(points1[0], points2, metric, miles=True),
+										   numpy.array(expected[0]) / KM_PER_MILE, rtol=0, atol=1e-9))
+		self.assertEquals(many_to_many([], points2).shape, (0, 3))
+		self.assertEquals(len(one_to_many(points1[0], [])), 0)
+		self.assertRaises(ValueError, lambda: distance(points1[0], points2[0], 'manhattan'))
+
+	def test_cartesian(self):
+		self.assertTrue(numpy.allclose(cartesian(0.0, 0.0), [[WGS84_A_KM, 0.0, 0.0]]))
+		self.assertTrue(numpy.allclose(cartesian([90.0], [0.0]), [[0.0, 0.0, WGS84_B_KM]]))
+		# Straight-line distances are never more than geodesic ones
+		points = numpy.array([(45.5, -73.6), (45.57, -73.69), (-37.95, 144.42), (10.0, 179.99)])
+		xyz = cartesian(points[:,0], points[:,1])
+		chords = numpy.sqrt(((xyz[:,numpy.newaxis] - xyz[numpy.newaxis]) ** 2).sum(axis=2))
+		self.assertTrue((chords <= many_to_many(points, points, 'vincenty') + 1e-9).all())
@@ -0,0 +1,44 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.geometric_median import *
+import unittest
+
+from geolocate.geodesy import one_to_many
+
+class GeometricMedianTestCase(unittest.TestCase):
+
+	def test_gps_points(self):
+		user = { 'posts': [{ 'geo': { 'coordinates': [45.5, -73.6] } },
+						   { 'coordinates': { 'type': 'Point', 'coordinates': [-73.69, 45.57] } },
+						   { 'geo': None, 'coordinates': None }, { 'geo': { 'coordinates': [None, 1] } },
+						   { 'coordinates': { 'type': 'Polygon', 'coordinates': [] } }, {}] }
+		self.assertEquals(gps_points(user), [(45.5, -73.6), (45.57, -73.69)])
+
+	def test_snapped_median(self):
+		points = [(45.5, -73.6), (45.51, -73.61), (45.52, -73.62), (40.7, -74.0)]
+		sums = [one_to_many(p, points, 'vincenty').sum() for p in points]
+		self.assertEquals(snapped_median(points), sums.index(min(sums)))
+		self.assertEquals(snapped_median(points), 1)
+		# Ties go to the first point
+		self.assertEquals(snapped_median([(1.0, 2.0), (1.0, 2.0)]), 0)
+
+	def test_weiszfeld_median(self):
+		self.assertEquals(weiszfeld_median([(1.0, 2.0), (1.0, 2.0)]), (1.0, 2.0))
+		# The median of points at the corners of a small square is near its center
+		median = weiszfeld_median([(0.0, 0.0), (0.0, 0.1), (0.1, 0.0), (0.1, 0.1)])
+		self.assertAlmostEquals(median[0], 0.05, places=3)
+		self.assertAlmostEquals(median[1], 0.05, places=3)
+
+	def test_home_location(self):
+		points = [(45.5, -73.6), (45.51, -73.61), (45.52, -73.62)]
+		self.assertEquals(home_location(points), (45.51, -73.61))
+		self.assertEquals(home_location(points[:2]), None)
+		self.assertEquals(home_location(points[:2], min_points=2), (45.5, -73.6))
+		median = home_location(points, snap=False)
+		self.assertAlmostEquals(median[0], 45.51, places=3)
+		# Points too far from each other have no home location
+		self.assertEquals(home_location([(45.5, -73.6), (40.7, -74.0), (34.1, -118.2)]), None)
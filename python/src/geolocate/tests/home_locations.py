@@ -0,0 +1,143 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.home_locations import *
+import unittest
+import os, os.path
+import gzip
+import json
+import shutil
+import tempfile
+
+import geolocate.geocoder as geocoder
+from geolocate.dataset import posts2dataset
+from geolocate.sparse_dataset import SparseDataset
+
+class HomeLocationsTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.cwd = os.getcwd()
+
+		# The geocoder reads its resources relative to the working directory
+		resources_dir = os.path.join(self.tmp_dir, 'geolocate', 'resources')
+		os.makedirs(resources_dir)
+		shutil.copy(os.path.join(os.path.dirname(geocoder.__file__), 'resources', 'state_table.csv'),
+					resources_dir)
+		fh = gzip.open(os.path.join(resources_dir, 'geonames.exanded-cities.tsv.gz'), 'w')
+		fh.write('city\tregion\tcountry\tlat\tlon\n')
+		fh.write('Montreal\tQuebec\tCanada\t45.5\t-73.6\n')
+		fh.write('Laval\tQuebec\tCanada\t45.57\t-73.69\n')
+		fh.close()
+		os.chdir(self.tmp_dir)
+
+		# a moves from Laval to Montreal, b has no location, and c's is unknown
+		posts = [('a','Laval, QC'),('b',None),('a','Montreal, QC'),('c','nowhere'),
+				 ('a',' Montreal, QC '),('b','  '),('d','Montreal Quebec')]
+		posts_fname = os.path.join(self.tmp_dir,'posts.json.gz')
+		fh = gzip.open(posts_fname,'w')
+		for i, (uid, location) in enumerate(posts):
+			post = { 'id': i, 'text': 'post %d' % i, 'user': { 'id_str': uid, 'location': location } }
+			fh.write(json.dumps(post) + '\n')
+		fh.close()
+		self.dataset_dir = os.path.join(self.tmp_dir,'dataset')
+		posts2dataset(self.dataset_dir,posts_fname,lambda p: p['user']['id_str'],
+					  lambda p: [],num_workers=1)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmp_dir)
+
+	def test_profile_location(self):
+		user = { 'posts': [{ 'user': { 'location': '' } }, { 'user': { 'location': ' b ' } },
+						   { 'user': { 'location': 'c' } }, { 'user': { 'location': 'c' } }, {}] }
+		self.assertEquals(profile_location(user), 'b')
+		self.assertEquals(profile_location(user, 'most-frequent'), 'c')
+		self.assertEquals(profile_location({ 'posts': [{ 'user': None }] }), None)
+
+	def test_build_home_locations(self):
+		cache_fname = os.path.join(self.tmp_dir,'cache.json.gz')
+		for policy, num_workers, a_location in [('first', 2, (45.57, -73.69)),
+												('most-frequent', 1, (45.5, -73.6))]:
+			stats = build_home_locations(self.dataset_dir,policy=policy,
+										 num_workers=num_workers,cache_fname=cache_fname)
+			self.assertEquals(stats['users'], 4)
+			self.assertEquals(stats['with_location'], 3)
+			self.assertEquals(stats['located'], 2)
+
+			ds = SparseDataset(self.dataset_dir,default_location_source='loc-field')
+			self.assertEquals(dict(ds.user_home_location_iter()),
+							  { 'a': a_location, 'd': (45.5, -73.6) })
+
+		# The strings geocoded by the first run are reused by the second
+		self.assertEquals(stats['cached'], 2)
+		self.assertEquals(stats['geocoded'], 1)
+
+	def test_geo_median(self):
+		# e has a home, f is too spread out, g has too few points, and h has none
+		posts = [('e',[45.5,-73.6]),('f',[45.5,-73.6]),('e',[45.51,-73.61]),('g',[40.7,-74.0]),
+				 ('e',[45.52,-73.62]),('f',[40.7,-74.0]),('f',[34.1,-118.2]),('h',None)]
+		posts_fname = os.path.join(self.tmp_dir,'gps-posts.json.gz')
+		fh = gzip.open(posts_fname,'w')
+		for i, (uid, coordinates) in enumerate(posts):
+			post = { 'id': i, 'text': 'post %d' % i, 'user': { 'id_str': uid } }
+			if coordinates is not None:
+				post['geo'] = { 'type': 'Point', 'coordinates': coordinates }
+			fh.write(json.dumps(post) + '\n')
+		fh.close()
+		dataset_dir = os.path.join(self.tmp_dir,'gps-dataset')
+		posts2dataset(dataset_dir,posts_fname,lambda p: p['user']['id_str'],
+					  lambda p: [],num_workers=1)
+
+		for num_workers in [1, 2]:
+			stats = build_home_locations(dataset_dir,source='geo-median',num_workers=num_workers)
+			self.assertEquals(stats['users'], 4)
+			self.assertEquals(stats['located'], 1)
+			self.assertEquals(stats['resumed'], 0)
+			self.assertFalse(os.path.exists(checkpoint_dir(dataset_dir,'geo-median')))
+			ds = SparseDataset(dataset_dir)
+			self.assertEquals(dict(ds.user_home_location_iter()), { 'e': (45.51, -73.61) })
+
+	def test_geo_median_resume(self):
+		posts_fname = os.path.join(self.tmp_dir,'gps-posts.json.gz')
+		fh = gzip.open(posts_fname,'w')
+		for i, uid in enumerate(['e','f','e','f','e','f']):
+			post = { 'id': i, 'user': { 'id_str': uid }, 'geo': { 'coordinates': [45.5 + i * 0.01, -73.6] } }
+			fh.write(json.dumps(post) + '\n')
+		fh.close()
+		dataset_dir = os.path.join(self.tmp_dir,'gps-dataset')
+		posts2dataset(dataset_dir,posts_fname,lambda p: p['user']['id_str'],
+					  lambda p: [],num_workers=1)
+
+		# An interrupted run finished e, and was killed while writing f
+		checkpoint = checkpoint_dir(dataset_dir,'geo-median')
+		os.makedirs(checkpoint)
+		fh = open(os.path.join(checkpoint,'part-0-1.tsv'),'w')
+		fh.write('e\t1.5\t2.5\nf\t1.')
+		fh.close()
+		self.assertEquals(read_checkpoint(checkpoint), { 'e': (1.5, 2.5) })
+
+		stats = build_home_locations(dataset_dir,source='geo-median',num_workers=1)
+		self.assertEquals(stats['resumed'], 1)
+		self.assertEquals(stats['computed'], 1)
+		ds = SparseDataset(dataset_dir)
+		self.assertEquals(dict(ds.user_home_location_iter()),
+						  { 'e': (1.5, 2.5), 'f': (45.53, -73.6) })
+
+		# A restart recomputes every user
+		os.makedirs(checkpoint)
+		fh = open(os.path.join(checkpoint,'part-0-1.tsv'),'w')
+		fh.write('e\t1.5\t2.5\n')
+		fh.close()
+		stats = build_home_locations(dataset_dir,source='geo-median',num_workers=1,restart=True)
+		self.assertEquals(stats['resumed'], 0)
+		ds = SparseDataset(dataset_dir)
+		self.assertEquals(dict(ds.user_home_location_iter())['e'], (45.52, -73.6))
+
+	def test_geocode_parallel(self):
+		gc = geocoder.Geocoder('geonames')
+		names = ['Laval, QC', 'nowhere', 'Montreal'] * 1000
+		self.assertEquals(geocode_parallel(gc, names, 3), [gc.geocode_noisy(name) for name in names])
@@ -0,0 +1,49 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.mention_edges import *
+from geolocate.user_ids import UserIdTable
+import unittest
+import os, os.path
+import shutil
+import tempfile
+
+import numpy
+
+class MentionEdgesTestCase(unittest.TestCase):
+
+	def test_runs(self):
+		rng = numpy.random.RandomState(0)
+		srcs = rng.randint(0, 20, 5000)
+		dsts = rng.randint(0, 20, 5000)
+		runs = []
+		for i in range(0, 5000, 97):
+			add_run(runs, aggregate_edges(srcs[i:i+97], dsts[i:i+97]))
+		add_run(runs, empty_edges())
+		# Only logarithmically many runs are kept
+		self.assertTrue(len(runs) <= 8, len(runs))
+
+		edges, weights = merge_runs(runs)
+		expected, counts = numpy.unique((srcs.astype(numpy.int64) << 32) | dsts, return_counts=True)
+		self.assertEquals(edges.tolist(), expected.tolist())
+		self.assertEquals(weights.tolist(), counts.tolist())
+		self.assertEquals(weights.dtype, numpy.int64)
+		self.assertEquals(len(merge_runs([])[0]), 0)
+
+	def test_read_edges(self):
+		tmp_dir = tempfile.mkdtemp()
+		elist_fname = os.path.join(tmp_dir,'mention_network.elist')
+		fh = open(elist_fname,'w')
+		fh.write('a b 1\nb a 2.0\na b 3\nc d\n\n')
+		fh.close()
+
+		user_ids = UserIdTable()
+		edges, weights = read_edges(elist_fname, user_ids)
+		a, b, c, d = [user_ids.get(u) for u in 'abcd']
+		self.assertEquals(dict(zip(edges.tolist(), weights.tolist())),
+						  { (a << 32) | b: 4, (b << 32) | a: 2, (c << 32) | d: 1 })
+
+		shutil.rmtree(tmp_dir)
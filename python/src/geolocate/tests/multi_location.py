@@ -0,0 +1,56 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.gimethods.multi_location.method import *
+import unittest
+import random
+
+import numpy as np
+
+class FakeNetwork(object):
+	"""
+	The located users' part of a mention network, which counts how many of
+	the pairs looked up are edges.
+	"""
+
+	def __init__(self, locations, edges):
+		self.locations = locations
+		self.edges = edges
+		self.lookups = 0
+		self.found = 0
+
+	def node_data(self, node):
+		return self.locations[node]
+
+	def has_edge(self, u, v):
+		self.lookups += 1
+		found = (u, v) in self.edges or (v, u) in self.edges
+		self.found += found
+		return found
+
+class MultiLocationTestCase(unittest.TestCase):
+
+	def test_following_fraction(self):
+		rng = random.Random(0)
+		np.random.seed(0)
+		locations = dict(('user%d' % i, (rng.uniform(30, 45), rng.uniform(-120, -75)))
+						 for i in range(40))
+		users = sorted(locations)
+		edges = set((u, v) for u in users for v in users if u < v and rng.random() < 0.2)
+
+		# The model is only given the state that compute_coefficients reads
+		model = MultiLocation.__new__(MultiLocation)
+		model.mention_network = FakeNetwork(locations, edges)
+		model.u_star = set(users)
+		model.N_squared = 0
+		model.S = 0
+		model.compute_coefficients(n=20000)
+
+		network = model.mention_network
+		self.assertEquals(model.N_squared, network.lookups)
+		self.assertEquals(model.S, network.found)
+		self.assertEquals(model.F_r, float(network.found) / network.lookups)
+		self.assertTrue(0.1 < model.F_r < 0.3, model.F_r)
@@ -0,0 +1,59 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.regions import *
+import unittest
+import os, os.path
+import gzip
+import json
+import shutil
+import tempfile
+
+import geolocate.regions as regions
+
+def square(min_lon, min_lat, size):
+	return { 'type': 'Polygon',
+			 'coordinates': [[[min_lon, min_lat], [min_lon + size, min_lat], [min_lon + size, min_lat + size],
+							  [min_lon, min_lat + size], [min_lon, min_lat]]] }
+
+@unittest.skipIf(regions.STRtree is None, 'requires shapely')
+class RegionsTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		features = [{ 'type': 'Feature', 'properties': { 'FIPS': '01001' }, 'geometry': square(-90.0, 30.0, 1.0) },
+					{ 'type': 'Feature', 'properties': { 'FIPS': '01003' }, 'geometry': square(-89.0, 30.0, 1.0) },
+					{ 'type': 'Feature', 'properties': { 'FIPS': '99999' }, 'geometry': None }]
+		self.counties_fname = os.path.join(self.tmp_dir, 'counties.geojson')
+		with open(self.counties_fname, 'w') as fh:
+			json.dump({ 'type': 'FeatureCollection', 'features': features }, fh)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_assign_regions(self):
+		ids, polygons = load_regions(self.counties_fname, 'FIPS')
+		self.assertEquals(ids, ['01001', '01003'])
+		points = [(30.5, -89.5), (30.5, -88.5), (30.5, -89.0), (45.5, -73.6), (31.5, -89.5)]
+		self.assertEquals(assign_regions(points, polygons).tolist(), [0, 1, 0, -1, -1])
+		self.assertEquals(len(assign_regions([], polygons)), 0)
+
+		points = points * 5000
+		index = RegionIndex(polygons)
+		self.assertEquals(assign_regions(points, index, num_workers=2).tolist(),
+						  assign_regions(points, index, num_workers=1).tolist())
+
+	def test_assign_counties(self):
+		dataset_dir = os.path.join(self.tmp_dir, 'dataset')
+		os.mkdir(dataset_dir)
+		fh = gzip.open(os.path.join(dataset_dir, 'users.home-locations.loc-field.tsv.gz'), 'w')
+		fh.write('user_id\tlat\tlon\n')
+		fh.write('a\t30.5\t-89.5\nb\t45.5\t-73.6\nc\t30.2\t-88.1\n')
+		fh.close()
+		self.assertEquals(assign_counties(dataset_dir, self.counties_fname, source='loc-field'), (3, 2))
+		fh = gzip.open(os.path.join(dataset_dir, 'users.home-locations.loc-field.counties.tsv.gz'), 'r')
+		self.assertEquals(fh.read(), 'user_id\tcounty\na\t01001\nc\t01003\n')
+		fh.close()
@@ -0,0 +1,161 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.sparse_dataset import *
+import unittest
+import os, os.path
+import gzip
+import json
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from geolocate.block_gzip import BlockGzipWriter
+from geolocate.user_ids import UserIdTable
+
+def make_post(user_id, i):
+	return { 'id': i, 'text': 'post %d' % i, 'lang': 'en',
+			 'geo': { 'type': 'Point', 'coordinates': [40.0 + i, -70.0] },
+			 'place': None,
+			 'user': { 'id_str': user_id, 'location': 'Montreal',
+					   'description': 'x' * 100 } }
+
+class ProjectionTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.users = [{ 'user_id': str(u), 'posts': [make_post(str(u), 10 * u + i) for i in range(3)] }
+					  for u in range(5)]
+		self.write_users(self.users)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def write_users(self, users):
+		fh = gzip.open(os.path.join(self.tmp_dir,'users.json.gz'),'w')
+		for user in users:
+			fh.write(json.dumps(user) + '\n')
+		fh.close()
+
+	def test_project_post(self):
+		post = make_post('1', 1)
+		p = project_post(post,[['text'],['user','location'],['place','full_name'],['missing']])
+		self.assertEquals(p,{ 'text': 'post 1', 'user': { 'location': 'Montreal' }, 'place': None })
+
+	def test_user_iter(self):
+		ds = SparseDataset(self.tmp_dir)
+		users = list(ds.user_iter(fields=['text','geo.coordinates']))
+		self.assertEquals(len(users),5)
+		for user, expected in zip(users,self.users):
+			self.assertEquals(user['user_id'],expected['user_id'])
+			self.assertEquals(user['posts'],
+							  [{ 'text': p['text'], 'geo': { 'coordinates': p['geo']['coordinates'] } }
+							   for p in expected['posts']])
+		self.assertEquals(len(list(ds.post_iter(fields=['id']))),15)
+
+	def test_iter_users(self):
+		ds = SparseDataset(self.tmp_dir,excluded_users=set(['3']))
+		users = list(ds.iter_users(['3','1','unknown'],fields=['geo','user.id_str']))
+		self.assertEquals([u['user_id'] for u in users],['1','3'])
+		self.assertTrue('geo' in users[0]['posts'][0])
+		self.assertFalse('geo' in users[1]['posts'][0])
+		self.assertEquals(ds.get_user('4',fields=['id'])['posts'][0],{ 'id': 40 })
+
+	def test_invalidation(self):
+		ds = SparseDataset(self.tmp_dir)
+		self.assertEquals(len(list(ds.post_iter(fields=['text']))),15)
+
+		# Rewriting the users file should cause the projection to be rebuilt
+		time.sleep(1)
+		self.write_users(self.users[:2])
+		ds = SparseDataset(self.tmp_dir)
+		self.assertEquals(len(list(ds.post_iter(fields=['text']))),6)
+
+class ShardingTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.user_ids = [str(u) for u in range(200)]
+
+		# write an indexed users file with small blocks, so that it can be
+		# sharded by block
+		writer = BlockGzipWriter(os.path.join(self.tmp_dir,'users.json.gz'),block_size=512)
+		locations = [writer.write_line(json.dumps({ 'user_id': u, 'posts': [make_post(u, int(u))] }))
+					 for u in self.user_ids]
+		writer.close()
+		UserIdTable(self.user_ids).save(os.path.join(self.tmp_dir,'users.ids.txt.gz'))
+		numpy.save(os.path.join(self.tmp_dir,'users.index.npy'),numpy.array(locations,dtype=numpy.int64))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def check_shards(self, ds, **kwargs):
+		shards = [[u['user_id'] for u in ds.user_iter(shard=i,num_shards=3,**kwargs)]
+				  for i in range(3)]
+		self.assertEquals(sorted(sum(shards,[])),sorted(self.user_ids))
+		return shards
+
+	def test_user_iter_shards(self):
+		ds = SparseDataset(self.tmp_dir)
+		self.assertTrue(all(len(shard) > 0 for shard in self.check_shards(ds)))
+
+		# the projection is written in larger blocks, so some shards may be empty
+		self.check_shards(ds,fields=['text'])
+
+		# without an index, users are sharded by hash
+		os.remove(os.path.join(self.tmp_dir,'users.index.npy'))
+		self.check_shards(SparseDataset(self.tmp_dir))
+
+	def test_map_users(self):
+		ds = SparseDataset(self.tmp_dir)
+		lengths = ds.map_users(lambda user: len(user['posts'][0]['text']),num_workers=3)
+		self.assertEquals(lengths,dict((u,len('post %s' % u)) for u in self.user_ids))
+
+		wanted = set(['3','50','199'])
+		texts = ds.map_users(lambda user: user['posts'][0]['text'] if user['user_id'] != '3' else None,
+							 user_ids=wanted,fields=['text'],num_workers=2)
+		self.assertEquals(texts,{ '50': 'post 50', '199': 'post 199' })
+
+class HomeLocationsTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		gzip.open(os.path.join(self.tmp_dir,'users.json.gz'),'w').close()
+		self.locations_fname = os.path.join(self.tmp_dir,'users.home-locations.geo-median.tsv.gz')
+		self.write_locations([('a',1.5,2.5),('b',-3.0,4.0),('c',5.0,-6.0)])
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def write_locations(self, locations):
+		fh = gzip.open(self.locations_fname,'w')
+		fh.write('user_id\tlat\tlon\n')
+		for loc in locations:
+			fh.write('%s\t%f\t%f\n' % loc)
+		fh.write('malformed row\n')
+		fh.close()
+
+	def test_home_locations(self):
+		ds = SparseDataset(self.tmp_dir,excluded_users=set(['b','unknown']))
+		self.assertEquals(list(ds.user_home_location_iter()),[('a',(1.5,2.5)),('c',(5.0,-6.0))])
+
+		users, lats, lons = ds.user_home_locations()
+		self.assertEquals(ds.user_ids().user_ids(users),['a','c'])
+		self.assertEquals(lats.tolist(),[1.5,5.0])
+		self.assertTrue(os.path.exists(self.locations_fname + '.npz'))
+
+		# the cache is used by other datasets over the same files
+		ds = SparseDataset(self.tmp_dir)
+		self.assertEquals(dict(ds.user_home_location_iter(interned=True)),
+						  { 0: (1.5,2.5), 1: (-3.0,4.0), 2: (5.0,-6.0) })
+
+		# and is rebuilt when the file changes
+		time.sleep(1)
+		self.write_locations([('d',7.0,8.0)])
+		ds = SparseDataset(self.tmp_dir)
+		self.assertEquals(list(ds.user_home_location_iter()),[('d',(7.0,8.0))])
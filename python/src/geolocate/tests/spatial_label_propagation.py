@@ -0,0 +1,52 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.gimethods.spatial_label_propagation.method import *
+import unittest
+import random
+
+from geolocate.gimethods.spatial_label_propagation.compare_homes import reference_has_home
+
+class HasHomeTestCase(unittest.TestCase):
+
+	def random_user(self, rng):
+		# Points scattered around a few centers, at scales on either side of
+		# the 15km limit
+		centers = [(rng.uniform(-80, 80), rng.uniform(-180, 180)) for i in range(rng.randint(1, 3))]
+		spread = rng.choice([0.02, 0.05, 0.1, 0.2])
+		locations = []
+		for i in range(rng.randint(5, 14)):
+			lat, lon = rng.choice(centers)
+			locations.append((lat + rng.gauss(0, spread), lon + rng.gauss(0, spread)))
+		return locations
+
+	def test_matches_backtracking(self):
+		rng = random.Random(0)
+		homes = 0
+		for i in range(300):
+			locations = self.random_user(rng)
+			self.assertEquals(has_home(locations), reference_has_home(locations), locations)
+			homes += has_home(locations)
+		# Both decisions are well represented in the sample
+		self.assertTrue(50 < homes < 250, homes)
+
+	def test_has_home(self):
+		self.assertFalse(has_home([(45.5, -73.6)] * 4))
+		self.assertTrue(has_home([(45.5, -73.6)] * 5))
+		# Five points along a line, the outermost 16km apart
+		line = [(45.5, -73.6 + 0.05 * i) for i in range(5)]
+		self.assertFalse(has_home(line))
+		self.assertTrue(has_home(line[:4] + [(45.51, -73.55)]))
+		# Points across the antimeridian and around the pole
+		self.assertTrue(has_home([(10.0, 179.98), (10.0, -179.98), (10.01, 179.99),
+								  (10.0, -179.99), (10.01, 180.0)]))
+		self.assertTrue(has_home([(89.99, lon) for lon in range(0, 360, 72)]))
+
+	def test_get_home_location(self):
+		posts = [{ 'coordinates': { 'type': 'Point', 'coordinates': [45.5 + 0.01 * i, -73.6] } }
+				 for i in range(5)] + [{ 'coordinates': None }, {}]
+		self.assertEquals(get_home_location(posts), Point(45.52, -73.6))
+		self.assertEquals(get_home_location(posts[:4]), None)
@@ -0,0 +1,66 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.gimethods.spot.method import *
+import unittest
+import math
+from collections import defaultdict
+
+from geolocate.geodesy import distance
+
+class FakeNetwork(object):
+
+	def __init__(self, locations, edges):
+		self.locations = locations
+		self.adjacent = defaultdict(list)
+		for u, v in edges:
+			self.adjacent[u].append(v)
+			if u != v:
+				self.adjacent[v].append(u)
+
+	def node_data(self, node):
+		return self.locations[node]
+
+	def neighbors(self, node):
+		return list(self.adjacent[node])
+
+	def neighbors_iter(self, node):
+		return iter(self.adjacent[node])
+
+class SpotEnergyTestCase(unittest.TestCase):
+
+	def test_energy_generated(self):
+		locations = { 'a': (45.5, -73.6), 'b': (45.57, -73.69), 'c': (43.7, -79.4),
+					  'd': (40.7, -74.0) }
+		# a mentioned themselves
+		edges = [('a', 'a'), ('a', 'b'), ('a', 'c'), ('b', 'c'), ('c', 'd')]
+		sij = defaultdict(lambda: defaultdict(float))
+		for (u, v), s in zip(edges, [0.5, 0.5, 0.25, 0.8, 0.51]):
+			sij[u][v] = s
+			sij[v][u] = s
+
+		spot = Spot_Energy.__new__(Spot_Energy)
+		spot.mention_network = FakeNetwork(locations, edges)
+		spot.users_with_location = set(locations)
+		spot.sij = sij
+		spot.dr = defaultdict(float)
+		spot.g_ui = defaultdict(float)
+		spot.energy_generated()
+
+		# The average distance of each social similarity, not counting a
+		# user's mentions of themselves
+		self.assertEquals(sorted(spot.dr), [0.3, 0.5, 0.8])
+		self.assertAlmostEquals(spot.dr[0.5], (distance(locations['a'], locations['b'], 'vincenty')
+											   + distance(locations['c'], locations['d'], 'vincenty')) / 2)
+
+		# Mentions of themselves add a user's full similarity to their energy
+		for user in locations:
+			expected = 0.0
+			for neighbor in spot.mention_network.neighbors(user):
+				d = distance(locations[user], locations[neighbor], 'vincenty')
+				expected += sij[user][neighbor] * math.exp(-d / spot.dr[round(sij[user][neighbor], 1)])
+			self.assertAlmostEquals(spot.g_ui[user], expected)
+		self.assertTrue(spot.g_ui['a'] > 1.0)
@@ -0,0 +1,81 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+from geolocate.sqlite_dataset import *
+import unittest
+import os, os.path
+import gzip
+import json
+import shutil
+import tempfile
+
+from geolocate.dataset import posts2dataset, append_posts
+
+class SqliteDatasetTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.dataset_dir = os.path.join(self.tmp_dir,'dataset')
+
+		# a and b mention each other, c mentions a, and d is only mentioned
+		posts = [('a',['b'],[45.5,-73.6]),('b',['a','d'],None),('a',['b'],None),('c',['a'],[40.7,-74.0])]
+		self.posts_fname = os.path.join(self.tmp_dir,'posts.json.gz')
+		fh = gzip.open(self.posts_fname,'w')
+		for i, (uid, mentions, coords) in enumerate(posts):
+			post = { 'id': i, 'user': uid, 'mentions': mentions, 'text': u'post \u00e9 %d' % i,
+					 'geo': { 'coordinates': coords } if coords else None }
+			fh.write(json.dumps(post) + '\n')
+		fh.close()
+		posts2dataset(self.dataset_dir,self.posts_fname,lambda p: p['user'],
+					  lambda p: p['mentions'],num_workers=1)
+
+		fh = gzip.open(os.path.join(self.dataset_dir,'users.home-locations.geo-median.tsv.gz'),'w')
+		fh.write('user_id\tlat\tlon\n')
+		fh.write('a\t45.5\t-73.6\nc\t40.7\t-74.0\n')
+		fh.close()
+		build_sqlite_dataset(self.dataset_dir)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_users(self):
+		sparse = SparseDataset(self.dataset_dir)
+		ds = SqliteDataset(self.dataset_dir,excluded_users=set(['c']))
+		self.assertTrue(ds.has_store())
+		self.assertEquals(ds.num_users(),3)
+		self.assertEquals(list(ds.user_iter(fields=['text'])),list(sparse.user_iter(fields=['text'])))
+		self.assertEquals(ds.get_user('a'),sparse.get_user('a'))
+		self.assertEquals(ds.get_user('c')['posts'][0].get('geo'),None)
+		self.assertEquals(ds.get_user('d'),None)
+		self.assertEquals(sorted(u['user_id'] for u in ds.iter_users(['c','b','unknown'])),['b','c'])
+
+		shards = [[u['user_id'] for u in ds.user_iter(shard=i,num_shards=2)] for i in range(2)]
+		self.assertEquals(sorted(sum(shards,[])),['a','b','c'])
+		self.assertEquals(ds.map_users(lambda u: len(u['posts']),num_workers=2),{ 'a': 2, 'b': 1, 'c': 1 })
+
+	def test_home_locations(self):
+		ds = SqliteDataset(self.dataset_dir,excluded_users=set(['c']))
+		self.assertEquals(list(ds.user_home_location_iter()),[('a',(45.5,-73.6))])
+		self.assertEquals(ds.home_location('a'),(45.5,-73.6))
+		self.assertEquals(ds.home_location('b'),None)
+		self.assertEquals(ds.home_location('c'),None)
+
+	def test_neighbors(self):
+		ds = SqliteDataset(self.dataset_dir)
+		self.assertEquals(ds.neighbors('a'),{ 'b': 2 })
+		self.assertEquals(ds.neighbors('a',direction='in'),{ 'b': 1, 'c': 1 })
+		self.assertEquals(ds.neighbors('a',direction='both'),{ 'b': 3, 'c': 1 })
+		self.assertEquals(ds.neighbors('a',mutual=True),{ 'b': 2 })
+		self.assertEquals(ds.neighbors('a',direction='both',mutual=True),{ 'b': 3 })
+		self.assertEquals(ds.neighbors('d',direction='in'),{ 'b': 1 })
+		self.assertEquals(ds.neighbors('unknown'),{})
+
+	def test_out_of_date(self):
+		append_posts(self.dataset_dir,self.posts_fname,lambda p: p['user'],
+					 lambda p: p['mentions'],num_workers=1)
+		ds = SqliteDataset(self.dataset_dir)
+		self.assertFalse(ds.has_store())
+		self.assertEquals(len(ds.get_user('a')['posts']),4)
@@ -0,0 +1,140 @@
+##
+#  Copyright (c) 2015, David Jurgens
+#
+#  All rights reserved. See LICENSE file for details
+##
+
+"""
+A dataset-level table that interns the string user ids into dense integer
+indices, so that per-user state can be kept in numpy arrays indexed by int
+rather than in dicts keyed by string.  The table is stored next to the users
+file as `users.ids.txt.gz`, with one user id per line, where the (0-based) line
+number is the user's index.
+
+The table is append-only: ids are never removed or reordered, so an index
+handed out once (e.g., one stored in a cached network) stays valid as more ids
+are interned.  New ids are appended to the file as an additional gzip member,
+rather than rewriting the whole table.
+"""
+
+import os, os.path
+import gzip
+import logging
+import zlib
+
+import numpy
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+class UserIdTable(object):
+    """
+    A bidirectional mapping between string user ids and dense int32 indices.
+    """
+
+    def __init__(self, user_ids=(), fname=None):
+        self._ids = []
+        self._index = {}
+        for user_id in user_ids:
+            self.intern(user_id)
+        self._fname = fname
+        self._num_saved = 0
+
+    @staticmethod
+    def load(fname):
+        """
+        Loads the table stored in the file.
+        """
+        table = UserIdTable(fname=fname)
+        fh = gzip.open(fname, 'r')
+        for line in fh:
+            table.intern(line.rstrip('\n'))
+        fh.close()
+        table._num_saved = len(table._ids)
+        return table
+
+    def save(self, fname=None):
+        """
+        Writes any ids not yet saved to the table's file, or to `fname` if
+        specified, in which case the full table is written.
+        """
+        if fname is not None and fname != self._fname:
+            self._fname = fname
+            self._num_saved = 0
+        if self._fname is None:
+            raise ValueError('no file was specified for the user id table')
+
+        # Append only the ids interned since the last save.  Concatenated gzip
+        # members read back as a single stream.
+        mode = 'a' if self._num_saved > 0 else 'w'
+        fh = gzip.open(self._fname, mode)
+        for user_id in self._ids[self._num_saved:]:
+            fh.write('%s\n' % user_id)
+        fh.close()
+        self._num_saved = len(self._ids)
+
+    def is_dirty(self):
+        """
+        Returns True if ids have been interned since the table was last saved.
+        """
+        return self._num_saved < len(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def intern(self, user_id):
+        """
+        Returns the index of the user id, assigning it the next free index if
+        it has not been seen before.
+        """
+        idx = self._index.get(user_id)
+        if idx is None:
+            idx = len(self._ids)
+            self._index[user_id] = idx
+            self._ids.append(user_id)
+        return idx
+
+    def index(self, user_id):
+        """
+        Returns the index of the user id, raising a KeyError if it is unknown.
+        """
+        return self._index[user_id]
+
+    def get(self, user_id, default=-1):
+        return self._index.get(user_id, default)
+
+    def user_id(self, idx):
+        """
+        Returns the user id with the specified index.
+        """
+        return self._ids[idx]
+
+    def indices(self, user_ids):
+        """
+        Returns an int32 array with the indices of the user ids, where unknown
+        ids are given an index of -1.
+        """
+        get = self._index.get
+        return numpy.fromiter((get(u, -1) for u in user_ids), dtype=numpy.int32)
+
+    def user_ids(self, indices):
+        """
+        Returns the list of user ids for the array of indices.
+        """
+        ids = self._ids
+        return [ids[i] for i in indices]
+
+def shard_of(user_id, num_shards):
+    """
+    Returns the shard that the user id is assigned to.  Any string id may be
+    used, since the shard is taken from a hash of the id rather than from its
+    numeric value.
+    """
+    if isinstance(user_id, unicode):
+        user_id = user_id.encode('utf-8')
+    return (zlib.crc32(str(user_id)) & 0xffffffff) % num_shards
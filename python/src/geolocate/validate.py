@@ -10,11 +10,10 @@ import abc
 import argparse
 import json
 
-from haversine import haversine
-
 sys.path.insert(0, '../')
 from geolocate import dataset
 from geolocate import geocoder
+from geolocate.geodesy import distance
 
 def iter_user_post(dataset_obj, mode):
 	# mode = true if by_user
@@ -44,6 +43,8 @@ def validate(dataset_dir, result_file, mode='dist'):
 	else:
 		res['match'] = 0.0
 		res['gg'] = geocoder.Geocoder()
+		res['true'] = []
+		res['pred'] = []
 		if mode == 'name-city':
 			res['gran'] = 0
 		elif mode == 'name-reg':
@@ -77,21 +78,26 @@ def validate(dataset_dir, result_file, mode='dist'):
 			assert int(_id_res) == _id
 			
 			if mode == 'dist':
-				d = haversine(true_coord, coord)
+				d = distance(true_coord, coord)
 				res['dist'].append(d)
 				res['mean'] += (d-res['mean'])/n
 			else:
-				d = res['gg'].reverse_geocode(true_coord[0], true_coord[1])
-				if d: d = d[res['gran']]
-				pre_d = res['gg'].reverse_geocode(coord[0], coord[1])
-				if pre_d: pre_d = pre_d[res['gran']]
-				n = count.downdate(d and pre_d)
-				if not d or not pre_d: continue
-				m = 0
-				if d == pre_d:
-					m = 1
-				res['match'] += (m-res['match'])/n
-
+				res['true'].append(true_coord)
+				res['pred'].append(coord)
+
+	if mode != 'dist':
+		# reverse geocode all of the posts' locations at once
+		true_names = res['gg'].reverse_geocode_many([c[0] for c in res['true']], [c[1] for c in res['true']])
+		pred_names = res['gg'].reverse_geocode_many([c[0] for c in res['pred']], [c[1] for c in res['pred']])
+		for d, pre_d in zip(true_names, pred_names):
+			if d: d = d[res['gran']]
+			if pre_d: pre_d = pre_d[res['gran']]
+			n = count.downdate(d and pre_d)
+			if not d or not pre_d: continue
+			m = 0
+			if d == pre_d:
+				m = 1
+			res['match'] += (m-res['match'])/n
 
 	count.output()
 	if mode == 'dist':